@@ -0,0 +1,76 @@
+import os
+import argparse
+import sys
+import time
+import pandas as pd
+from fitting.roi_statistics import ROIStatistics, load_label_map, load_label_names, default_percentiles
+from utils_io.parametric_maps import load_fit_pd_from_maps
+
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Compute the statistics of the fitted quantities in each region of '
+                                                 'interest (label) of a label map.')
+    parser.add_argument('--fit-files',
+                        dest='fit_files', type=str, nargs="+", action='store', required=True,
+                        help='Fit files to get the statistics of, as saved by process_saved_data.py: fits '
+                             '(fit_pd*.csv, e.g. of each slice) or parametric maps (fit_maps*.npz)')
+    parser.add_argument('--labels',
+                        dest='labels', type=str, action='store', required=True,
+                        help='Label map of the same size as the fits, as an (nx, ny, nslc) integer array in a .npy '
+                             'file, or the labels array of a .npz file (e.g. ground_truth.npz from '
+                             'generate_synthetic_data.py)')
+    parser.add_argument('--label-names',
+                        dest='label_names', type=str, action='store',
+                        help='(Optional) csv file with the name of each label, in label and name columns (e.g. '
+                             'ground_truth_compartments.csv from generate_synthetic_data.py)')
+    parser.add_argument('--datatype',
+                        dest='datatype', type=str, action='store',
+                        help='(Optional) Datatype of the fits, to get the statistics of all of its fitted quantities '
+                             '(e.g. T1, Si and delta for t1). Either this or --quantities must be given')
+    parser.add_argument('--quantities',
+                        dest='quantities', type=str, nargs="+", action='store',
+                        help='(Optional) Columns of the fits to get the statistics of (e.g. T1)')
+    parser.add_argument('--percentiles',
+                        dest='percentiles', type=float, nargs="+", default=list(default_percentiles), action='store',
+                        help='(Optional) Percentiles to report, along with the median. The default values are '
+                             f'{" ".join([str(p) for p in default_percentiles])}')
+    parser.add_argument('--ignore-labels',
+                        dest='ignore_labels', type=int, nargs="*", default=[0], action='store',
+                        help='(Optional) Labels to leave out (e.g. background). The default value is 0')
+    parser.add_argument('--output',
+                        dest='output', type=str, action='store', required=True,
+                        help='csv file to save the statistics to, with one row per quantity and label')
+    args = parser.parse_args(args)
+    if (args.datatype is None) and (args.quantities is None):
+        parser.error("Either --datatype or --quantities must be given")
+    return args
+
+
+def load_fit_file(filename):
+    if filename.endswith(".npz"):
+        return load_fit_pd_from_maps(filename)
+    return pd.read_csv(filename)
+
+
+def main(args):
+    start_time = time.time()
+    label_names = load_label_names(args.label_names) if args.label_names is not None else None
+    roi_statistics = ROIStatistics(load_label_map(args.labels), datatype=args.datatype, quantities=args.quantities,
+                                   percentiles=args.percentiles, ignore_labels=args.ignore_labels,
+                                   label_names=label_names)
+    for filename in args.fit_files:
+        print("Adding fits from:", filename)
+        roi_statistics.add_fits(load_fit_file(filename))
+    stats_pd = roi_statistics.get_statistics()
+    output_dir = os.path.dirname(args.output)
+    if len(output_dir) > 0:
+        os.makedirs(output_dir, exist_ok=True)
+    stats_pd.to_csv(args.output, index=False)
+    print(f"Saved the statistics of {roi_statistics.num_voxels} voxels in {stats_pd['label'].nunique()} labels to: "
+          f"{args.output} ({time.time() - start_time:.2f} s)")
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+from fitting.batched_fitting import get_padded_arrays
+
+# Columns of the diffusion direction, which are averaged over for each b-value
+direction_cols = ["b_vec_0", "b_vec_1", "b_vec_2"]
+
+
+def average_diffusion_directions(data_pd, group_cols):
+    """ Average the data of each group over the diffusion directions of each (target) b-value, with the geometric
+    mean, which is the trace-weighted signal exp(-b * ADC) of anisotropic voxels for orthogonal directions. The
+    measured b-values are averaged, and the number of averaged directions is stored in num_directions """
+    key_cols = [c for c in data_pd.columns if c not in ["data", "b_value"] + direction_cols]
+    if "target_b_value" not in key_cols:
+        key_cols.append("b_value")
+    data_pd = data_pd.assign(log_data=np.log(data_pd["data"].where(data_pd["data"] > 0)))
+    averaged_pd = data_pd.groupby(key_cols, dropna=False, sort=False).agg(
+        log_data=pd.NamedAgg(column="log_data", aggfunc="mean"),
+        b_value=pd.NamedAgg(column="b_value", aggfunc="mean"),
+        num_directions=pd.NamedAgg(column="data", aggfunc="size"),
+    ).reset_index()
+    averaged_pd["data"] = np.exp(averaged_pd["log_data"])
+    averaged_pd = averaged_pd.drop(columns="log_data")
+    return averaged_pd.sort_values(group_cols + ["b_value"], kind="stable").reset_index(drop=True)
+
+
+def fit_adc_log_linear(b_values, data, mask):
+    """ Fit log(data) = log(Si) - b * ADC for all voxels at once with a closed-form weighted least squares solve,
+    with weights data^2 (the inverse variance of the log of the data). b_values, data and mask are (n, m) arrays
+    of n voxels and m b-values. Returns the ADC, Si, their standard errors and the reduced chi-square of each voxel """
+    valid = mask & (data > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_data = np.where(valid, np.log(np.where(valid, data, 1.)), 0.)
+    weights = np.where(valid, data ** 2, 0.)
+    sum_w = np.sum(weights, axis=1)
+    sum_wb = np.sum(weights * b_values, axis=1)
+    sum_wbb = np.sum(weights * b_values ** 2, axis=1)
+    sum_wy = np.sum(weights * log_data, axis=1)
+    sum_wby = np.sum(weights * b_values * log_data, axis=1)
+    determinant = sum_w * sum_wbb - sum_wb ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (sum_w * sum_wby - sum_wb * sum_wy) / determinant
+        intercept = (sum_wy - slope * sum_wb) / sum_w
+        ADC = -slope
+        Si = np.exp(intercept)
+
+        # Standard errors from the weighted residuals of the log data
+        n_free = np.sum(valid, axis=1) - 2
+        log_residuals = np.where(valid, log_data - intercept[:, None] - slope[:, None] * b_values, 0.)
+        log_redchi = np.where(n_free > 0, np.sum(weights * log_residuals ** 2, axis=1) / n_free, np.nan)
+        stderr_ADC = np.sqrt(log_redchi * sum_w / determinant)
+        stderr_Si = Si * np.sqrt(log_redchi * sum_wbb / determinant)
+
+        # Reduced chi-square of the mono-exponential model, as for the other fits
+        residuals = np.where(valid, Si[:, None] * np.exp(-b_values * ADC[:, None]) - data, 0.)
+        redchi = np.where(n_free > 0, np.sum(residuals ** 2, axis=1) / n_free, np.nan)
+    return ADC, Si, stderr_ADC, stderr_Si, redchi
+
+
+def estimate_ADC(data_pd, group_cols, b_col="b_value", data_col="data"):
+    """ Estimate ADC and Si for every group at once with the weighted log-linear fit of direction-averaged data.
+    Returns one row per group """
+    group_pd = data_pd.drop_duplicates(subset=group_cols)[group_cols].sort_values(group_cols)
+    x, data, mask = get_padded_arrays(data_pd, group_cols, [b_col], data_col=data_col)
+    ADC, Si, stderr_ADC, stderr_Si, redchi = fit_adc_log_linear(x[b_col], data, mask)
+    fit_pd = group_pd.reset_index(drop=True)
+    fit_pd["ADC"] = ADC
+    fit_pd["Si"] = Si
+    fit_pd["stderr_ADC"] = stderr_ADC
+    fit_pd["stderr_Si"] = stderr_Si
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fit_pd["norm_redchi"] = redchi / Si / Si
+    fit_pd["valid_fit_by_stderr_ADC"] = fit_pd["stderr_ADC"] < fit_pd["ADC"]
+    return fit_pd
+
+
+def get_adc_estimates_for_data_by_group(data_pd, group_cols):
+    """ Get the log-linear ADC estimates for each group, merged back into the direction-averaged data """
+    fit_pd = estimate_ADC(data_pd, group_cols)
+    cols_to_remove = [c for c in fit_pd.columns if (c in data_pd.columns) and (c not in group_cols)]
+    fit_pd = pd.merge(data_pd.drop(columns=cols_to_remove),
+                      fit_pd,
+                      on=group_cols,
+                      how="left")
+    return fit_pd
@@ -0,0 +1,158 @@
+import numpy as np
+
+
+def get_padded_arrays(data_pd, group_cols, independent_cols, data_col="data"):
+    """ Get the data and independent variables of all groups as (n_groups, n_rows) arrays, in the order of
+    data_pd.groupby(group_cols), with a mask of the rows that each group has. Missing rows are padded with the first
+    row of the group, so the padded values are valid model inputs """
+    grouped_pd = data_pd.groupby(group_cols, sort=True)
+    group_idx = grouped_pd.ngroup().to_numpy()
+    row_idx = grouped_pd.cumcount().to_numpy()
+    n_groups = int(group_idx.max()) + 1
+    n_rows = int(row_idx.max()) + 1
+    mask = np.zeros((n_groups, n_rows), dtype=bool)
+    mask[group_idx, row_idx] = True
+
+    def to_padded(values):
+        padded = np.zeros((n_groups, n_rows))
+        padded[group_idx, row_idx] = values
+        return np.where(mask, padded, padded[:, :1])
+
+    data = to_padded(data_pd[data_col].to_numpy(dtype=float))
+    x = {c: to_padded(data_pd[c].to_numpy(dtype=float)) for c in independent_cols}
+    return x, data, mask
+
+
+def to_param_dict(model, params):
+    return {name: params[:, idx:idx + 1] for idx, name in enumerate(model.param_names)}
+
+
+def project_to_bounds(new_params, params, lower, upper):
+    """ Keep the parameters within the bounds, by moving at most halfway from the current parameters to a bound """
+    new_params = np.where(new_params < lower, (params + lower) / 2, new_params)
+    new_params = np.where(new_params > upper, (params + upper) / 2, new_params)
+    return new_params
+
+
+def get_residuals(model, params, x, data, mask):
+    with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        residuals = (model.forward(to_param_dict(model, params), x) - data) * mask
+    return np.where(np.isfinite(residuals), residuals, np.inf)
+
+
+def get_jacobian(model, params, x, mask, relative_step=1e-6):
+    """ Get the (n, m, n_params) Jacobian of the masked residuals, and the number of model evaluations it took """
+    if model.jacobian is not None:
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            jacobian = model.jacobian(to_param_dict(model, params), x)
+        n_evaluations = 1
+    else:
+        # Forward differences, stepping away from the upper bound
+        _, upper = model.get_bounds()
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            signal = model.forward(to_param_dict(model, params), x)
+        jacobian = np.zeros(signal.shape + (params.shape[1],))
+        for idx in range(params.shape[1]):
+            step = relative_step * np.maximum(np.abs(params[:, idx]), 1e-3)
+            step = np.where(params[:, idx] + step > upper[idx], -step, step)
+            stepped_params = params.copy()
+            stepped_params[:, idx] += step
+            with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+                stepped_signal = model.forward(to_param_dict(model, stepped_params), x)
+            jacobian[:, :, idx] = (stepped_signal - signal) / step[:, None]
+        n_evaluations = params.shape[1] + 1
+    with np.errstate(invalid="ignore"):
+        # Masked (e.g. padded) values may have infinite derivatives, which are zeroed below
+        jacobian = jacobian * mask[:, :, None]
+    return np.where(np.isfinite(jacobian), jacobian, 0.), n_evaluations
+
+
+def solve_damped(jtj, gradient, damping):
+    """ Solve the damped normal equations (J^T J + damping * diag(J^T J)) step = -J^T r of each voxel """
+    diagonal = np.diagonal(jtj, axis1=1, axis2=2)
+    scale = np.maximum(diagonal, 1e-12 * np.max(diagonal, axis=1, keepdims=True) + 1e-300)
+    damped = jtj + damping[:, None, None] * (scale[:, :, None] * np.eye(jtj.shape[1]))
+    return -np.linalg.solve(damped, gradient[:, :, None])[:, :, 0]
+
+
+def fit_batched(model, x, data, mask, init_params, max_iterations=200, ftol=1e-8, xtol=1e-8, initial_damping=1e-2,
+                return_status=False):
+    """ Fit the model to all voxels at once with a vectorized Levenberg-Marquardt solver, where each voxel has its
+    own damping and stops once it converges. x and data are (n, m) arrays, for n voxels and m acquisitions, and
+    init_params is an (n, n_params) array. Returns the fitted parameters, their standard errors, the reduced
+    chi-square and the number of model evaluations of each voxel, and if return_status, why the solver stopped for
+    each voxel (ftol, xtol, zero_cost, max_damping, max_iterations or nonfinite_start) """
+    lower, upper = model.get_bounds()
+    params = np.clip(np.array(init_params, dtype=float), lower, upper)
+    n_voxels, n_params = params.shape
+    residuals = get_residuals(model, params, x, data, mask)
+    cost = np.sum(residuals ** 2, axis=1)
+    damping = np.full(n_voxels, initial_damping)
+    nfev = np.ones(n_voxels, dtype=int)
+    active = np.isfinite(cost)
+    status = np.where(active, "max_iterations", "nonfinite_start").astype(object)
+
+    for _ in range(max_iterations):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        x_active = {c: v[idx] for c, v in x.items()}
+        jacobian, n_evaluations = get_jacobian(model, params[idx], x_active, mask[idx])
+        nfev[idx] += n_evaluations
+        jtj = np.einsum("nmp,nmq->npq", jacobian, jacobian)
+        gradient = np.einsum("nmp,nm->np", jacobian, residuals[idx])
+        try:
+            step = solve_damped(jtj, gradient, damping[idx])
+        except np.linalg.LinAlgError:
+            step = -np.einsum("npq,nq->np", np.linalg.pinv(jtj), gradient)
+        new_params = project_to_bounds(params[idx] + step, params[idx], lower, upper)
+        new_residuals = get_residuals(model, new_params, x_active, data[idx], mask[idx])
+        new_cost = np.sum(new_residuals ** 2, axis=1)
+        nfev[idx] += 1
+
+        # Accept the steps that lower the cost, and move towards gradient descent for the others
+        improved = new_cost < cost[idx]
+        params_change = np.abs(new_params - params[idx])
+        small_step = np.all(params_change <= xtol * (np.abs(params[idx]) + xtol), axis=1)
+        small_reduction = (cost[idx] - new_cost) <= ftol * cost[idx]
+        accept_idx = idx[improved]
+        params[accept_idx] = new_params[improved]
+        residuals[accept_idx] = new_residuals[improved]
+        cost[accept_idx] = new_cost[improved]
+        damping[idx] = np.where(improved, np.maximum(damping[idx] / 10, 1e-12), damping[idx] * 10)
+        converged = (improved & (small_reduction | small_step)) | (cost[idx] == 0) | (damping[idx] > 1e12)
+        active[idx[converged]] = False
+        status[idx[converged]] = np.select([cost[idx] == 0, improved & small_reduction, improved & small_step],
+                                           ["zero_cost", "ftol", "xtol"], default="max_damping")[converged]
+
+    # Standard errors from the covariance at the solution, scaled by the reduced chi-square, as lmfit does
+    n_free = np.sum(mask, axis=1) - n_params
+    with np.errstate(divide="ignore", invalid="ignore"):
+        redchi = np.where(n_free > 0, cost / n_free, np.nan)
+    jacobian, _ = get_jacobian(model, params, x, mask)
+    covariance = np.linalg.pinv(np.einsum("nmp,nmq->npq", jacobian, jacobian))
+    with np.errstate(invalid="ignore"):
+        stderr = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2) * redchi[:, None])
+    if return_status:
+        return params, stderr, redchi, nfev, status
+    return params, stderr, redchi, nfev
+
+
+def fit_batched_multistart(model, x, data, mask, init_params, start_scales=(1.,), return_status=False):
+    """ Fit the model with fit_batched from each start, where the first parameter (the quantitative variable) of the
+    initial parameters is scaled by each start scale, and keep the fit with the lowest cost of each voxel. The
+    number of model evaluations is summed over all starts. If return_status, why the solver stopped for the kept fit
+    of each voxel is returned too """
+    best_fit = None
+    for start_scale in start_scales:
+        start_params = np.array(init_params, dtype=float)
+        start_params[:, 0] *= start_scale
+        params, stderr, redchi, nfev, status = fit_batched(model, x, data, mask, start_params, return_status=True)
+        if best_fit is None:
+            best_fit = [params, stderr, redchi, nfev, status]
+            continue
+        better = redchi < best_fit[2]
+        for best_values, values in zip(best_fit[:3] + best_fit[4:], [params, stderr, redchi, status]):
+            best_values[better] = values[better]
+        best_fit[3] = best_fit[3] + nfev
+    return tuple(best_fit) if return_status else tuple(best_fit[:4])
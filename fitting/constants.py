@@ -1,6 +1,8 @@
 quantitative_variable_names = {
     "t1": "T1",
     "t2": "T2",
+    "t2_epg": "T2",
+    "adc": "ADC",
     "t2_map": "T2",
     "t2_map_20_echos": "T2",
     "t2_map_30_echos": "T2"
@@ -10,6 +12,8 @@ quantitative_variable_names = {
 other_quantitative_variable_names = {
     "t1": ["Si", "delta"],
     "t2": ["Si"],
+    "t2_epg": ["Si", "B1"],
+    "adc": ["Si"],
     "t2_map": [],
     "t2_map_20_echos": [],
     "t2_map_30_echos": []
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from fitting.constants import get_all_quantitative_variables
+from fitting.models import get_model
+from fitting.batched_fitting import get_padded_arrays
+from fitting.overall_fitting import get_measurement_estimates_for_data_by_group, prepare_groups_for_fit, \
+    get_batched_problem, get_fit_cols, merge_fits
+from profiling.run_report import optional_stage, add_counts
+
+# Default quantization step of the normalized signal curves, as a fraction of the max of each curve
+default_cluster_tolerance = 0.05
+
+
+def get_curve_clusters(data_pd, independent_cols, group_cols, tolerance=default_cluster_tolerance):
+    """ Cluster the signal curves of the groups (e.g. voxels) by hashing them: each curve is normalized by its max,
+    and quantized in steps of tolerance, and groups with the same quantized curve (and the same acquisitions) are in
+    the same cluster. A larger tolerance gives fewer clusters, and so fewer fits, but less accurate representatives.
+    Returns the groups (in the order of group_cols) with their cluster and the max of their curve, and the padded
+    curves and independent variables of the groups """
+    x, data, mask = get_padded_arrays(data_pd, group_cols, independent_cols)
+    with np.errstate(invalid="ignore"):
+        scale = np.nanmax(np.where(mask, np.abs(data), np.nan), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalized = np.where(scale[:, None] > 0, data / scale[:, None], 0.)
+    keys = [np.where(mask & np.isfinite(normalized), np.round(normalized / tolerance), -1).astype(np.int64), mask]
+    # Only group curves with the same acquisitions
+    keys.extend([np.round(x[c], 6) for c in independent_cols])
+    _, cluster = np.unique(np.concatenate(keys, axis=1), axis=0, return_inverse=True)
+    groups_pd = data_pd[group_cols].drop_duplicates().sort_values(group_cols).reset_index(drop=True)
+    groups_pd["cluster"] = cluster.ravel()
+    groups_pd["scale"] = scale
+    return groups_pd, normalized, mask
+
+
+def get_representative_data(data_pd, groups_pd, normalized, mask, group_cols):
+    """ Get the data of the representative of each cluster: the rows of the first group of the cluster, with the mean
+    normalized curve of the cluster, scaled by the mean max of its curves. The representatives are numbered by
+    cluster in the x column """
+    n_clusters = int(groups_pd["cluster"].max()) + 1
+    counts = np.bincount(groups_pd["cluster"], minlength=n_clusters)
+    mean_curve = np.zeros((n_clusters, normalized.shape[1]))
+    np.add.at(mean_curve, groups_pd["cluster"].to_numpy(), np.where(mask, normalized, 0.))
+    mean_scale = np.bincount(groups_pd["cluster"], weights=np.nan_to_num(groups_pd["scale"].to_numpy()),
+                             minlength=n_clusters) / counts
+    representative_curve = mean_curve / counts[:, None] * mean_scale[:, None]
+
+    first_groups_pd = groups_pd.drop_duplicates(subset="cluster")
+    representative_pd = pd.merge(data_pd, first_groups_pd[group_cols + ["cluster"]], on=group_cols, how="inner")
+    representative_pd = representative_pd.sort_values(group_cols, kind="stable")
+    row_idx = representative_pd.groupby(group_cols, sort=False).cumcount().to_numpy()
+    representative_pd["data"] = representative_curve[representative_pd["cluster"].to_numpy(), row_idx]
+    representative_pd["x"] = representative_pd["cluster"]
+    representative_pd["y"] = 0
+    return representative_pd.drop(columns="cluster")
+
+
+def assign_cluster_fits(data_pd, datatype, groups_pd, representative_fit_pd, group_cols):
+    """ Assign the fit of its cluster's representative to each group, with the signal scale (Si, and its initial
+    value and stderr) scaled by the least-squares scale of the group's data to the representative's modelled curve,
+    and the norm_redchi of the group's data. Returns the fits merged into the data, as
+    get_measurement_estimates_for_data_by_group does """
+    model = get_model(datatype)
+    quant_cols = get_all_quantitative_variables(datatype)
+    data_pd = prepare_groups_for_fit(data_pd, datatype, group_cols=group_cols)
+    if model.prepare_data is not None:
+        data_pd = model.prepare_data(data_pd, group_cols)
+    all_grouped_data, x, data, mask, _ = get_batched_problem(data_pd, datatype, group_cols)
+
+    # Get the fit of the cluster of each group
+    representative_fit_pd = representative_fit_pd.drop_duplicates(subset="x").set_index("x")
+    cluster = pd.merge(all_grouped_data.drop_duplicates(subset="group")[group_cols], groups_pd,
+                       on=group_cols, how="left")["cluster"].to_numpy()
+    fit_pd = representative_fit_pd.loc[cluster, get_fit_cols(datatype)].reset_index(drop=True)
+    params = {c: fit_pd[c].to_numpy(dtype=float)[:, None] for c in quant_cols}
+    with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        modelled = model.forward(params, x) * mask
+        scale = np.sum(data * modelled, axis=1) / np.sum(modelled * modelled, axis=1)
+        scale = np.where(np.isfinite(scale), scale, 1.)
+        residuals = (scale[:, None] * modelled - data) * mask
+        n_free = np.sum(mask, axis=1) - len(quant_cols)
+        redchi = np.where(n_free > 0, np.sum(residuals ** 2, axis=1) / n_free, np.nan)
+    for c in ["Si", "init_Si", "stderr_Si"]:
+        fit_pd[c] = fit_pd[c].to_numpy(dtype=float) * scale
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fit_pd["norm_redchi"] = redchi / fit_pd["Si"].to_numpy() / fit_pd["Si"].to_numpy()
+    # The solver evaluations are those of the representatives
+    fit_pd["nfev"] = 0
+    fit_pd.insert(0, "group", np.arange(1, len(fit_pd) + 1))
+    return merge_fits(all_grouped_data, fit_pd, datatype)
+
+
+def get_clustered_estimates(data_pd, datatype, tolerance=default_cluster_tolerance, polish=True, group_cols=None,
+                            run_report=None, fit_engine="lmfit", n_workers=1, record_telemetry=False):
+    """ Fit the groups (e.g. voxels) by clusters of near-duplicate signal curves (see get_curve_clusters): the
+    representative curve of each cluster is fit once, and then each group is either fit again from the fit of its
+    cluster (polish), or assigned it with its own signal scale (see assign_cluster_fits), which skips fitting each
+    group. The fits have the cluster of each group. Returns the fits (as get_measurement_estimates_for_data_by_group)
+    and a summary of the clusters and the solver evaluations of the representative and polishing fits """
+    if group_cols is None:
+        group_cols = ["slc", "x", "y"]
+    model = get_model(datatype)
+    with optional_stage(run_report, "cluster") as stage:
+        groups_pd, normalized, mask = get_curve_clusters(data_pd, model.independent_cols, group_cols,
+                                                         tolerance=tolerance)
+        representative_pd = get_representative_data(data_pd, groups_pd, normalized, mask, group_cols)
+        n_clusters = int(groups_pd["cluster"].max()) + 1
+        add_counts(stage, voxels=len(groups_pd), clusters=n_clusters)
+    with optional_stage(run_report, "fit_representatives") as stage:
+        representative_fit_pd = get_measurement_estimates_for_data_by_group(representative_pd, datatype,
+                                                                            group_cols=group_cols,
+                                                                            fit_engine=fit_engine,
+                                                                            n_workers=n_workers)
+        representative_nfev = int(np.sum(representative_fit_pd.drop_duplicates(subset="x")["nfev"]))
+        add_counts(stage, voxels=n_clusters, nfev=representative_nfev)
+
+    if polish:
+        with optional_stage(run_report, "polish") as stage:
+            init_pd = pd.merge(groups_pd[group_cols + ["cluster"]],
+                               representative_fit_pd.drop_duplicates(subset="x")[["x"] + model.param_names].rename(
+                                   columns={"x": "cluster"}), on="cluster", how="left")
+            # The signal scale of each group is its own, not that of the representative
+            representative_scale = representative_pd.groupby("x")["data"].max().to_numpy()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                init_pd["Si"] = init_pd["Si"] * groups_pd["scale"] / representative_scale[init_pd["cluster"]]
+            fit_pd = get_measurement_estimates_for_data_by_group(data_pd, datatype, group_cols=group_cols,
+                                                                 init_pd=init_pd.drop(columns="cluster"),
+                                                                 run_report=run_report, fit_engine=fit_engine,
+                                                                 n_workers=n_workers,
+                                                                 record_telemetry=record_telemetry)
+            polish_nfev = int(np.sum(fit_pd.drop_duplicates(subset=group_cols)["nfev"]))
+            add_counts(stage, voxels=len(groups_pd), nfev=polish_nfev)
+    else:
+        with optional_stage(run_report, "assign") as stage:
+            fit_pd = assign_cluster_fits(data_pd, datatype, groups_pd, representative_fit_pd, group_cols)
+            polish_nfev = 0
+            add_counts(stage, voxels=len(groups_pd))
+    fit_pd = pd.merge(fit_pd, groups_pd[group_cols + ["cluster"]], on=group_cols, how="left")
+    return fit_pd, {"num_voxels": len(groups_pd), "num_clusters": n_clusters, "tolerance": tolerance,
+                    "polish": polish, "representative_nfev": representative_nfev, "polish_nfev": polish_nfev}
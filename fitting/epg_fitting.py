@@ -0,0 +1,180 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Dictionary grid: T2 values log-spaced over the range of tissues and vials (ms), and relative B1 (refocusing angle
+# scale) values
+default_t2_values = np.geomspace(5., 3000., 400)
+default_b1_values = np.linspace(0.5, 1.3, 81)
+
+# Dictionaries computed in this process, by protocol and grid, and the directory to also cache them in
+_epg_dictionaries = {}
+_epg_cache_dir = {"dir": None}
+
+
+def set_epg_cache_dir(cache_dir):
+    """ Set the directory to cache EPG dictionaries in, so they are only computed once for each protocol """
+    _epg_cache_dir["dir"] = cache_dir
+
+
+def get_refocusing_matrix(refocusing_angle):
+    """ Get the (n, 3, 3) EPG rotation matrices of CPMG refocusing pulses (about the axis orthogonal to the
+    excitation), for (n,) refocusing angles in radians, acting on real (F+, F-, Z) states """
+    cos_half_2 = np.cos(refocusing_angle / 2) ** 2
+    sin_half_2 = np.sin(refocusing_angle / 2) ** 2
+    sin_a = np.sin(refocusing_angle)
+    cos_a = np.cos(refocusing_angle)
+    return np.stack([np.stack([cos_half_2, sin_half_2, sin_a], axis=-1),
+                     np.stack([sin_half_2, cos_half_2, -sin_a], axis=-1),
+                     np.stack([-0.5 * sin_a, 0.5 * sin_a, cos_a], axis=-1)], axis=-2)
+
+
+def simulate_cpmg_epg(T2, B1, echo_spacing, n_echos, T1=1000., refocusing_angle=180.):
+    """ Simulate the CPMG echo train of each (T2, B1) pair with the extended phase graph (EPG) model, for all pairs at
+    once. T2, T1 and echo_spacing are in ms, refocusing_angle in degrees, and B1 scales the refocusing angle.
+    Returns the (n, n_echos) echo amplitudes for a unit proton density signal """
+    T2 = np.atleast_1d(np.asarray(T2, dtype=float))
+    B1 = np.broadcast_to(np.asarray(B1, dtype=float), T2.shape)
+    n = len(T2)
+    n_states = 2 * n_echos + 2
+    e2 = np.exp(-echo_spacing / 2 / T2)
+    e1 = np.exp(-echo_spacing / 2 / T1)
+    rotation = get_refocusing_matrix(np.deg2rad(refocusing_angle) * B1)
+
+    # States are stored as (order, n), so that the orders are contiguous. Ideal 90 degree excitation along the
+    # refocusing axis
+    f_plus = np.zeros((n_states, n))
+    f_minus = np.zeros((n_states, n))
+    z = np.zeros((n_states, n))
+    f_plus[0] = 1.
+    echos = np.zeros((n_echos, n))
+
+    def relax_and_dephase(n_active):
+        # Only the first n_active orders can be non-zero, so only they need to be updated
+        f_plus[:n_active] *= e2
+        f_minus[:n_active] *= e2
+        z[:n_active] *= e1
+        z[0] += 1 - e1
+        # Dephasing shifts the F+ states up an order and the F- states down an order
+        f_plus[1:n_active + 1] = f_plus[:n_active]
+        f_plus[0] = f_minus[1]
+        f_minus[:n_active] = f_minus[1:n_active + 1]
+
+    # Apply the 3x3 rotation to all states with elementwise products, which is much faster than batched matmuls
+    r = [[rotation[:, row, col] for col in range(3)] for row in range(3)]
+    for echo_idx in range(n_echos):
+        n_active = 2 * echo_idx + 1
+        relax_and_dephase(n_active)
+        n_active += 1
+        f_plus_active = f_plus[:n_active].copy()
+        f_minus_active = f_minus[:n_active].copy()
+        z_active = z[:n_active].copy()
+        f_plus[:n_active] = r[0][0] * f_plus_active + r[0][1] * f_minus_active + r[0][2] * z_active
+        f_minus[:n_active] = r[1][0] * f_plus_active + r[1][1] * f_minus_active + r[1][2] * z_active
+        z[:n_active] = r[2][0] * f_plus_active + r[2][1] * f_minus_active + r[2][2] * z_active
+        relax_and_dephase(n_active)
+        echos[echo_idx] = f_plus[0]
+    return np.abs(echos.T)
+
+
+def get_echo_indices(TE, echo_spacing=None):
+    """ Get the echo number (starting from 1) of each echo time, for echo times at multiples of the echo spacing.
+    By default, the echo spacing is the first echo time """
+    TE = np.asarray(TE, dtype=float)
+    if echo_spacing is None:
+        echo_spacing = np.min(TE)
+    echo_indices = np.round(TE / echo_spacing).astype(int)
+    if np.any(np.abs(echo_indices * echo_spacing - TE) > 1e-3 * echo_spacing) or np.any(echo_indices < 1):
+        raise Exception(f"Echo times must be multiples of the echo spacing {echo_spacing} ms for EPG fitting, "
+                        f"found: {np.unique(TE)}")
+    return echo_indices, echo_spacing
+
+
+def get_epg_dictionary(echo_spacing, n_echos, t2_values=None, b1_values=None, T1=1000., refocusing_angle=180.,
+                       cache_dir=None):
+    """ Get the EPG dictionary (n_entries, n_echos) over the T2 x B1 grid for a protocol, with the T2 and B1 value
+    of each entry. Dictionaries are cached in memory, and in cache_dir (by default, the directory set with
+    set_epg_cache_dir) if given """
+    if cache_dir is None:
+        cache_dir = _epg_cache_dir["dir"]
+    t2_values = default_t2_values if t2_values is None else np.asarray(t2_values, dtype=float)
+    b1_values = default_b1_values if b1_values is None else np.asarray(b1_values, dtype=float)
+    key = (float(echo_spacing), int(n_echos), float(T1), float(refocusing_angle),
+           t2_values.tobytes(), b1_values.tobytes())
+    if key in _epg_dictionaries:
+        return _epg_dictionaries[key]
+
+    cache_filename = None
+    if cache_dir is not None:
+        key_hash = hashlib.md5(repr(key).encode()).hexdigest()[:12]
+        cache_filename = os.path.join(cache_dir, f"epg_esp{echo_spacing:g}_n{n_echos}_{key_hash}.npz")
+    if (cache_filename is not None) and os.path.exists(cache_filename):
+        with np.load(cache_filename) as f:
+            dictionary = {k: f[k] for k in f.files}
+    else:
+        entry_t2, entry_b1 = [v.ravel() for v in np.meshgrid(t2_values, b1_values, indexing="ij")]
+        signals = simulate_cpmg_epg(entry_t2, entry_b1, echo_spacing, n_echos, T1=T1,
+                                    refocusing_angle=refocusing_angle)
+        dictionary = {"signals": signals, "T2": entry_t2, "B1": entry_b1}
+        if cache_filename is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_filename, **dictionary)
+    _epg_dictionaries[key] = dictionary
+    return dictionary
+
+
+def match_epg_dictionary(data, signals, chunk_size=4096):
+    """ Find the dictionary entry that best fits each row of data (n, n_echos) in the least squares sense, with a
+    free signal scale. Returns the entry index, the signal scale and the residual sum of squares of each row """
+    norms = np.linalg.norm(signals, axis=1)
+    normalized_signals = signals / norms[:, None]
+    best_idx = np.zeros(len(data), dtype=int)
+    best_projection = np.zeros(len(data))
+    for start in range(0, len(data), chunk_size):
+        projections = data[start:start + chunk_size] @ normalized_signals.T
+        best_idx[start:start + chunk_size] = np.argmax(projections, axis=1)
+        best_projection[start:start + chunk_size] = projections[np.arange(len(projections)),
+                                                                best_idx[start:start + chunk_size]]
+    scale = best_projection / norms[best_idx]
+    residual = np.sum(data ** 2, axis=1) - best_projection ** 2
+    return best_idx, scale, residual
+
+
+def estimate_T2_EPG(data_pd, group_cols, te_col="te", data_col="data", echo_spacing=None, T1=1000.,
+                    refocusing_angle=180., cache_dir=None):
+    """ Estimate T2, Si and B1 for every group at once, by matching the mean echo train of each group against the
+    EPG dictionary. Returns one row per group """
+    # Average any repeated echoes, and get the (n_groups, n_echos) echo trains
+    mean_pd = data_pd.groupby(group_cols + [te_col])[data_col].mean().unstack(te_col)
+    mean_pd = mean_pd.dropna()
+    TE = mean_pd.columns.to_numpy(dtype=float)
+    echo_indices, echo_spacing = get_echo_indices(TE, echo_spacing=echo_spacing)
+    dictionary = get_epg_dictionary(echo_spacing, int(np.max(echo_indices)), T1=T1,
+                                    refocusing_angle=refocusing_angle, cache_dir=cache_dir)
+    signals = dictionary["signals"][:, echo_indices - 1]
+
+    data = mean_pd.to_numpy(dtype=float)
+    best_idx, scale, residual = match_epg_dictionary(data, signals)
+    n_free = max(data.shape[1] - 3, 1)
+    fit_pd = mean_pd.index.to_frame(index=False)
+    fit_pd["T2"] = dictionary["T2"][best_idx]
+    fit_pd["Si"] = scale
+    fit_pd["B1"] = dictionary["B1"][best_idx]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fit_pd["norm_redchi"] = residual / n_free / scale / scale
+    # Fits on the edge of the dictionary grid are not valid estimates
+    fit_pd["valid_fit_by_grid_T2"] = (fit_pd["T2"] > dictionary["T2"].min()) & \
+                                     (fit_pd["T2"] < dictionary["T2"].max())
+    return fit_pd
+
+
+def get_epg_estimates_for_data_by_group(data_pd, datatype, group_cols, cache_dir=None):
+    """ Get the EPG T2 and B1 estimates for each group, merged back into the data """
+    fit_pd = estimate_T2_EPG(data_pd, group_cols, te_col="te", data_col="data", cache_dir=cache_dir)
+    cols_to_remove = [c for c in fit_pd.columns if (c in data_pd.columns) and (c not in group_cols)]
+    fit_pd = pd.merge(data_pd.drop(columns=cols_to_remove),
+                      fit_pd,
+                      on=group_cols,
+                      how="left")
+    return fit_pd
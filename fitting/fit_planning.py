@@ -0,0 +1,155 @@
+import time
+import numpy as np
+import pandas as pd
+from fitting.overall_fitting import get_measurement_estimates_for_data_by_group
+from profiling.resources import get_peak_rss_mb
+
+# Number of voxels that are fit to estimate the fit time per voxel
+default_calibration_voxels = 50
+
+
+def summarize_voxels(data_pd, voxel_cols=("x", "y")):
+    """ Get the voxel of each row of the data of a slice, and the max of the data and whether any data is exactly
+    zero for each voxel """
+    row_voxel = data_pd.groupby(list(voxel_cols), sort=True).ngroup().to_numpy()
+    data = data_pd["data"].to_numpy(dtype=float)
+    n_voxels = int(row_voxel.max()) + 1 if len(data_pd) > 0 else 0
+    voxel_max = np.full(n_voxels, np.nan)
+    finite = np.isfinite(data)
+    np.fmax.at(voxel_max, row_voxel[finite], data[finite])
+    voxel_has_zero = np.zeros(n_voxels, dtype=bool)
+    voxel_has_zero[row_voxel[data == 0]] = True
+    return row_voxel, voxel_max, voxel_has_zero
+
+
+def get_rows_to_fit(voxel_summary, max_val, voxel_threshold):
+    """ Get the rows of the data of a slice that mask_slice keeps (see summarize_voxels), without masking the data,
+    and whether the slice is masked """
+    row_voxel, voxel_max, voxel_has_zero = voxel_summary
+    slc_max_val = np.nanmax(voxel_max) if np.any(np.isfinite(voxel_max)) else np.nan
+    if not (slc_max_val > (np.min([0.1, voxel_threshold]) * max_val)):
+        return np.ones(len(row_voxel), dtype=bool), False
+    with np.errstate(invalid="ignore"):
+        keep_voxels = ~voxel_has_zero & (voxel_max > slc_max_val * voxel_threshold)
+    return keep_voxels[row_voxel], True
+
+
+def get_fit_plan(data_pd_dict, voxel_thresholds, max_val=None):
+    """ Get the number of rows and voxels of each slice that would be fit with each voxel threshold, and whether the
+    slice would be masked. Returns one row per slice and threshold """
+    if max_val is None:
+        max_val = np.max([np.max(data_pd["data"]) for data_pd in data_pd_dict.values()])
+    plan = []
+    for slc, data_pd in data_pd_dict.items():
+        voxel_summary = summarize_voxels(data_pd)
+        for voxel_threshold in voxel_thresholds:
+            row_mask, masked = get_rows_to_fit(voxel_summary, max_val, voxel_threshold)
+            plan.append({"slc": slc, "voxel_threshold": voxel_threshold, "masked": masked,
+                         "rows": int(np.sum(row_mask)), "voxels": len(np.unique(voxel_summary[0][row_mask]))})
+    return pd.DataFrame(plan, columns=["slc", "voxel_threshold", "masked", "rows", "voxels"])
+
+
+def sample_voxels_to_fit(data_pd_dict, voxel_threshold, n_voxels, max_val=None, rng=None):
+    """ Randomly sample up to n_voxels of the voxels of all slices that would be fit with the voxel threshold.
+    Returns the data of the sampled voxels """
+    if rng is None:
+        rng = np.random.default_rng()
+    if max_val is None:
+        max_val = np.max([np.max(data_pd["data"]) for data_pd in data_pd_dict.values()])
+    candidates = []
+    for slc, data_pd in data_pd_dict.items():
+        voxel_summary = summarize_voxels(data_pd)
+        row_mask, _ = get_rows_to_fit(voxel_summary, max_val, voxel_threshold)
+        candidates.append((data_pd, voxel_summary[0], row_mask, np.unique(voxel_summary[0][row_mask])))
+    n_candidates = int(np.sum([len(voxels) for _, _, _, voxels in candidates]))
+    sample_idx = np.sort(rng.choice(n_candidates, size=min(n_voxels, n_candidates), replace=False))
+    sampled_data_pds = []
+    offset = 0
+    for data_pd, row_voxel, row_mask, voxels in candidates:
+        sampled_voxels = voxels[sample_idx[(sample_idx >= offset) & (sample_idx < offset + len(voxels))] - offset]
+        offset += len(voxels)
+        if len(sampled_voxels) > 0:
+            sampled_data_pds.append(data_pd[row_mask & np.isin(row_voxel, sampled_voxels)])
+    if len(sampled_data_pds) == 0:
+        return pd.DataFrame()
+    return pd.concat(sampled_data_pds, ignore_index=True)
+
+
+def time_fit(data_pd, datatype, group_cols, fit_engine="lmfit", n_workers=1):
+    start_time = time.time()
+    fit_pd = get_measurement_estimates_for_data_by_group(data_pd, datatype, group_cols=group_cols,
+                                                         fit_engine=fit_engine, n_workers=n_workers)
+    return fit_pd, time.time() - start_time
+
+
+def calibrate_fit_time(sample_pd, datatype, group_cols, fit_engine="lmfit", n_workers=1):
+    """ Fit the sampled voxels with the fit engine and workers, to get the fit time per voxel, the overhead of each
+    fit (e.g. of each slice) and the memory of the fits per row of data on this machine. A fifth of the voxels are fit
+    twice, first to time the one-off setup (e.g. computing a dictionary) and then to separate the overhead of each fit
+    from the time per voxel, which matters for the batched fit engine """
+    if len(sample_pd) == 0:
+        return {"num_voxels": 0, "wall_time": 0., "setup_time": 0., "time_per_fit": 0., "time_per_voxel": np.nan,
+                "fit_bytes_per_row": np.nan}
+    groups_pd = sample_pd[group_cols].drop_duplicates()
+    n_voxels = len(groups_pd)
+    n_small_voxels = max(1, n_voxels // 5)
+    small_sample_pd = pd.merge(sample_pd, groups_pd.iloc[:n_small_voxels], on=group_cols, how="inner")
+    _, first_time = time_fit(small_sample_pd, datatype, group_cols, fit_engine=fit_engine, n_workers=n_workers)
+    _, small_time = time_fit(small_sample_pd, datatype, group_cols, fit_engine=fit_engine, n_workers=n_workers)
+    fit_pd, wall_time = time_fit(sample_pd, datatype, group_cols, fit_engine=fit_engine, n_workers=n_workers)
+    time_per_voxel = (wall_time - small_time) / (n_voxels - n_small_voxels) if n_voxels > n_small_voxels else 0.
+    if time_per_voxel <= 0:
+        # Too noisy to separate the overhead of each fit
+        time_per_voxel = wall_time / n_voxels
+    return {"num_voxels": n_voxels,
+            "wall_time": wall_time,
+            "setup_time": max(first_time - small_time, 0.),
+            "time_per_fit": max(wall_time - time_per_voxel * n_voxels, 0.),
+            "time_per_voxel": time_per_voxel,
+            "fit_bytes_per_row": float(fit_pd.memory_usage(deep=True).sum() / len(sample_pd))}
+
+
+def summarize_fit_plan(plan_pd, calibration, keep_fits=True):
+    """ Estimate the fit time and peak memory of fitting with each voxel threshold, from the fit plan and the
+    calibration fit (see calibrate_fit_time), and of sweeping over all of them (see fit_slices_by_thresholds). The
+    peak memory is estimated as the peak memory so far (with all data loaded) and the fits of all slices (or of the
+    largest slice if they are not kept) """
+    peak_rss_mb = get_peak_rss_mb()
+    summary = {"calibration": calibration, "peak_rss_mb_before_fit": peak_rss_mb, "by_threshold": {}}
+
+    def estimate(n_voxels, n_rows, max_slice_rows, n_fits):
+        fits_mb = calibration["fit_bytes_per_row"] * (n_rows if keep_fits else max_slice_rows) / 1024 / 1024
+        return {"voxels": int(n_voxels),
+                "rows": int(n_rows),
+                "wall_time": float(calibration["setup_time"] + calibration["time_per_fit"] * n_fits +
+                                   calibration["time_per_voxel"] * n_voxels),
+                "fits_mb": float(fits_mb),
+                "peak_rss_mb": float(peak_rss_mb + fits_mb) if peak_rss_mb is not None else None}
+
+    for voxel_threshold, threshold_pd in plan_pd.groupby("voxel_threshold", sort=True):
+        summary["by_threshold"][str(voxel_threshold)] = estimate(threshold_pd["voxels"].sum(),
+                                                                 threshold_pd["rows"].sum(),
+                                                                 threshold_pd["rows"].max(),
+                                                                 np.sum(threshold_pd["voxels"] > 0))
+    if plan_pd["voxel_threshold"].nunique() > 1:
+        # Each slice is fit once unmasked (if any threshold does not mask it) and once with the lowest threshold that
+        # masks it
+        fits_pd = plan_pd.sort_values("voxel_threshold").drop_duplicates(subset=["slc", "masked"])
+        slice_rows = fits_pd.groupby("slc")["rows"].sum()
+        summary["sweep"] = estimate(fits_pd["voxels"].sum(), slice_rows.sum(), slice_rows.max(),
+                                    np.sum(fits_pd["voxels"] > 0))
+    return summary
+
+
+def print_fit_plan(plan_pd, summary):
+    """ Print the voxels to fit of each slice and the estimated fit time and peak memory of each voxel threshold """
+    calibration = summary["calibration"]
+    print(f"\nFit plan (from a calibration fit of {calibration['num_voxels']} voxels in "
+          f"{calibration['wall_time']:.2f} s: {calibration['time_per_voxel'] * 1000:.2f} ms per voxel, "
+          f"{calibration['time_per_fit']:.2f} s per slice, {calibration['setup_time']:.2f} s setup):")
+    print(plan_pd.to_string(index=False))
+    for name, estimate in [(f"voxel threshold {t}", e) for t, e in summary["by_threshold"].items()] + \
+            ([("sweep over all voxel thresholds", summary["sweep"])] if "sweep" in summary else []):
+        peak_rss = f", peak memory ~{estimate['peak_rss_mb']:.0f} MB" if estimate["peak_rss_mb"] is not None else ""
+        print(f"Fitting with {name}: {estimate['voxels']} voxels ({estimate['rows']} rows), "
+              f"~{estimate['wall_time']:.1f} s{peak_rss}")
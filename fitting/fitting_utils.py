@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 
@@ -66,4 +67,101 @@ def limit_data_to_threshold(data_pd, slc_max_val, voxel_threshold):
                        on=["x", "y"],
                        how="inner")
     # END TODOS
-    return data_pd
\ No newline at end of file
+    return data_pd
+
+
+def limit_fits_to_threshold(fit_pd, data_pd, slc_max_val, voxel_threshold, group_cols):
+    """ Limit the fits of the (masked) data of a slice to the voxels that limit_data_to_threshold keeps for a higher
+    voxel threshold, as if only those voxels had been fit: the fits of each voxel do not depend on the other voxels,
+    except for the group numbers, which are numbered again (from the same first number, which depends on the fit
+    engine) """
+    first_group = fit_pd["group"].min() if "group" in fit_pd.columns else None
+    valid_xy = data_pd[data_pd["data"] > slc_max_val * voxel_threshold][["x", "y"]]
+    valid_xy = valid_xy.drop_duplicates()
+    fit_pd = pd.merge(fit_pd,
+                      valid_xy,
+                      on=["x", "y"],
+                      how="inner")
+    if "group" in fit_pd.columns:
+        fit_pd["group"] = fit_pd.groupby(group_cols, sort=True).ngroup() + first_group
+    return fit_pd
+
+
+def set_initial_values(params, init_values):
+    """ Override the heuristic initial parameter values with given values, where they are usable """
+    if init_values is None:
+        return params
+    for name, value in init_values.items():
+        # Fall back to the heuristic value for missing, non-finite or non-positive initial values
+        if (name not in params) or (value is None) or (not np.isfinite(value)) or (value <= 0):
+            continue
+        param = params[name]
+        param.set(value=float(np.clip(value, param.min, param.max)))
+    return params
+
+
+def summarize_fit_cost(fit_pd, wall_time, group_cols=("slc", "x", "y")):
+    """ Get the number of fitted voxels, total solver evaluations and wall time of a fit """
+    group_cols = [c for c in group_cols if c in fit_pd.columns]
+    voxels_pd = fit_pd.drop_duplicates(subset=group_cols)
+    nfev = 0
+    if "nfev" in voxels_pd.columns:
+        nfev = int(np.nansum(voxels_pd["nfev"]))
+    return {"num_voxels": len(voxels_pd), "nfev": nfev, "wall_time": wall_time}
+
+
+def add_fit_costs(fit_cost_1, fit_cost_2):
+    return {k: fit_cost_1.get(k, 0) + fit_cost_2.get(k, 0) for k in ["num_voxels", "nfev", "wall_time"]}
+
+
+def print_fit_cost_comparison(name, fit_cost, reference_name, reference_fit_cost):
+    print(f"\t{name}: {fit_cost['nfev']} solver evaluations for {fit_cost['num_voxels']} voxels "
+          f"in {fit_cost['wall_time']:.2f} s")
+    print(f"\t{reference_name}: {reference_fit_cost['nfev']} solver evaluations for "
+          f"{reference_fit_cost['num_voxels']} voxels in {reference_fit_cost['wall_time']:.2f} s")
+    if (reference_fit_cost["nfev"] > 0) and (reference_fit_cost["wall_time"] > 0):
+        print(f"\t{name} used {100 * fit_cost['nfev'] / reference_fit_cost['nfev']:.1f} % of the solver "
+              f"evaluations and {100 * fit_cost['wall_time'] / reference_fit_cost['wall_time']:.1f} % of the "
+              f"wall time of {reference_name}")
+
+
+def summarize_hybrid_fit(fit_pd, wall_time, group_cols=("slc", "x", "y")):
+    """ Get the number of fitted and refined voxels of a hybrid fit, with the lmfit time of the refined voxels and of
+    the voxels that lmfit was only timed on, and the wall time of the fit """
+    group_cols = [c for c in group_cols if c in fit_pd.columns]
+    if "refined" not in fit_pd.columns:
+        return {"num_voxels": 0, "num_refined": 0, "refined_lmfit_time": 0., "num_timed": 0, "timed_lmfit_time": 0.,
+                "wall_time": wall_time}
+    voxels_pd = fit_pd.drop_duplicates(subset=group_cols)
+    refined = voxels_pd["refined"].astype(bool)
+    timed = ~refined & voxels_pd["lmfit_time"].notna()
+    return {"num_voxels": len(voxels_pd),
+            "num_refined": int(np.sum(refined)),
+            "refined_lmfit_time": float(np.nansum(voxels_pd.loc[refined, "lmfit_time"])),
+            "num_timed": int(np.sum(timed)),
+            "timed_lmfit_time": float(np.sum(voxels_pd.loc[timed, "lmfit_time"])),
+            "wall_time": wall_time}
+
+
+def add_hybrid_fit_summaries(summary_1, summary_2):
+    return {k: summary_1.get(k, 0) + summary_2.get(k, 0) for k in summary_2.keys()}
+
+
+def print_hybrid_fit_summary(summary):
+    """ Print the fraction of voxels that a hybrid fit refined with lmfit, and the time it saved against an estimate
+    of fitting all voxels with lmfit (from the lmfit time of the refined voxels, and of the timed other voxels) """
+    if summary["num_voxels"] == 0:
+        return summary
+    num_other = summary["num_voxels"] - summary["num_refined"]
+    summary["refined_fraction"] = summary["num_refined"] / summary["num_voxels"]
+    print(f"\tRefined {summary['num_refined']} of {summary['num_voxels']} voxels "
+          f"({100 * summary['refined_fraction']:.1f} %) with lmfit")
+    if (num_other > 0) and (summary["num_timed"] == 0):
+        return summary
+    other_lmfit_time = num_other * summary["timed_lmfit_time"] / summary["num_timed"] if num_other > 0 else 0.
+    summary["estimated_lmfit_time"] = summary["refined_lmfit_time"] + other_lmfit_time
+    summary["estimated_time_saved"] = summary["estimated_lmfit_time"] - summary["wall_time"]
+    print(f"\tHybrid fit took {summary['wall_time']:.2f} s, against an estimated {summary['estimated_lmfit_time']:.2f} "
+          f"s to fit all voxels with lmfit (from {summary['num_timed']} timed voxels): "
+          f"{summary['estimated_time_saved']:.2f} s saved")
+    return summary
@@ -0,0 +1,266 @@
+import numpy as np
+from fitting.constants import quantitative_variable_names, other_quantitative_variable_names
+from fitting.t1_fitting import estimate_T1, model_T1_2
+from fitting.t2_fitting import estimate_T2, model_T2
+from fitting.epg_fitting import get_epg_estimates_for_data_by_group, get_echo_indices, get_epg_dictionary, \
+    match_epg_dictionary, simulate_cpmg_epg
+from fitting.adc_fitting import average_diffusion_directions, fit_adc_log_linear, get_adc_estimates_for_data_by_group
+
+
+class FitModel:
+    """ A quantitative model that the generic fitting machinery can fit to any datatype it is registered for.
+
+    param_names: Names of the fitted parameters, with the quantitative variable first and the signal scale "Si"
+        among them (used to normalize the reduced chi-square)
+    independent_cols: Data columns that the model depends on (e.g. ["te"]), with one value per acquisition
+    bounds: Dictionary of (min, max) bounds of each parameter
+    forward: Vectorized forward model forward(params, x), where params maps each parameter name to an (n, 1) array
+        and x maps each independent column to an (n, m) array, for n voxels and m acquisitions. Returns the (n, m)
+        modelled signal
+    jacobian: (Optional) Jacobian jacobian(params, x) of the forward model, as an (n, m, n_params) array in the
+        order of param_names. If not given, the Jacobian is computed with finite differences
+    initializer: Batched initializer initializer(x, data, mask) of the parameters from the (n, m) data, where mask
+        marks the acquisitions that each voxel has. Returns a dictionary of (n,) initial values of each parameter
+    estimate_group: (Optional) Reference estimate_group(group_pd, init_values) fit of the data of one group with
+        lmfit, returning the lmfit output and initial parameters
+    estimate_all_groups: (Optional) estimate_all_groups(data_pd, group_cols) estimate of all groups at once that is
+        not iterative (e.g. dictionary matching), and is used in place of the lmfit fit of each group
+    start_scales: (Optional) Scales of the initial value of the quantitative variable to start the batched fit from,
+        keeping the best fit of each voxel, for models with local minima
+    prepare_data: (Optional) prepare_data(data_pd, group_cols) preparation of the data of all groups before fitting
+        with any engine (e.g. averaging over diffusion directions)
+    """
+    def __init__(self, datatype, param_names, independent_cols, bounds, forward, initializer, jacobian=None,
+                 estimate_group=None, estimate_all_groups=None, start_scales=(1.,), prepare_data=None):
+        self.datatype = datatype
+        self.param_names = list(param_names)
+        self.independent_cols = list(independent_cols)
+        self.bounds = {name: bounds.get(name, (-np.inf, np.inf)) for name in self.param_names}
+        self.forward = forward
+        self.jacobian = jacobian
+        self.initializer = initializer
+        self.estimate_group = estimate_group
+        self.estimate_all_groups = estimate_all_groups
+        self.start_scales = tuple(start_scales)
+        self.prepare_data = prepare_data
+
+    def get_bounds(self):
+        """ Get the lower and upper bounds of the parameters, as (n_params,) arrays in the order of param_names """
+        lower = np.array([self.bounds[name][0] for name in self.param_names], dtype=float)
+        upper = np.array([self.bounds[name][1] for name in self.param_names], dtype=float)
+        return lower, upper
+
+
+# Registered models, by datatype
+fit_models = {}
+
+
+def register_model(model):
+    """ Register a model for its datatype. The quantitative variables of the datatype are added to the constants if
+    they are not there yet, and must match the parameters of the model otherwise """
+    if "Si" not in model.param_names:
+        raise Exception(f"The model for datatype {model.datatype} must have a signal scale parameter Si")
+    if model.datatype not in quantitative_variable_names:
+        quantitative_variable_names[model.datatype] = model.param_names[0]
+        other_quantitative_variable_names[model.datatype] = model.param_names[1:]
+    quant_cols = [quantitative_variable_names[model.datatype]] + \
+        list(other_quantitative_variable_names[model.datatype])
+    if quant_cols != model.param_names:
+        raise Exception(f"The parameters of the model for datatype {model.datatype} ({model.param_names}) do not "
+                        f"match its quantitative variables ({quant_cols})")
+    fit_models[model.datatype] = model
+    return model
+
+
+def get_model(datatype):
+    if datatype not in fit_models:
+        raise Exception(f"No model is registered for datatype: {datatype}")
+    return fit_models[datatype]
+
+
+def supports_initial_values(datatype, fit_engine="lmfit"):
+    """ Whether the fits of the datatype with the fit engine are iterative, and so can use initial values (e.g. from
+    a coarser fit) """
+    if datatype not in fit_models:
+        return False
+    model = fit_models[datatype]
+    if fit_engine == "batched":
+        return model.forward is not None
+    if fit_engine == "hybrid":
+        # The initial values are used by the batched fit, and models that are not iterative are not fit by it
+        return (model.forward is not None) and (model.estimate_all_groups is None)
+    return (model.estimate_all_groups is None) and (model.estimate_group is not None)
+
+
+def has_reference_fit(datatype):
+    """ Whether the datatype has a reference lmfit fit of each group, to validate other fits against """
+    return (datatype in fit_models) and (fit_models[datatype].estimate_group is not None)
+
+
+def get_masked_min_max(values, mask):
+    """ Get the index of the min and max of each row of values, only over the acquisitions in mask """
+    min_idx = np.argmin(np.where(mask, values, np.inf), axis=1)
+    max_idx = np.argmax(np.where(mask, values, -np.inf), axis=1)
+    return min_idx, max_idx
+
+
+def take_rows(values, idx):
+    return np.take_along_axis(values, idx[:, None], axis=1)[:, 0]
+
+
+########################################################################################################################
+# T1: inversion recovery, abs(Si * (1 - (1 + delta) * exp(-TI / T1) + exp(-TR / T1)))
+def forward_T1(params, x):
+    return model_T1_2(Si=params["Si"], delta=params["delta"], TI=x["ti"], T1=params["T1"], TR=x["tr"])
+
+
+def jacobian_T1(params, x):
+    T1, Si, delta = params["T1"], params["Si"], params["delta"]
+    e_ti = np.exp(-x["ti"] / T1)
+    e_tr = np.exp(-x["tr"] / T1)
+    recovery = 1 - (1 + delta) * e_ti + e_tr
+    sign = np.sign(Si * recovery)
+    d_T1 = sign * Si * (-(1 + delta) * e_ti * x["ti"] + e_tr * x["tr"]) / T1 ** 2
+    d_Si = sign * recovery
+    d_delta = -sign * Si * e_ti
+    return np.stack([d_T1, d_Si, d_delta], axis=-1)
+
+
+def init_T1_batched(x, data, mask, delta_init=0.9, n_iterations=20):
+    """ Batched version of the heuristic initialization of t1_fitting.init: the T1 guess is the null point of the
+    model at the inversion time with the minimum signal, found with Newton iterations instead of scipy.minimize """
+    TI, TR = x["ti"], x["tr"][:, 0]
+    min_idx, max_idx = get_masked_min_max(data, mask)
+    min_data, max_data = take_rows(data, min_idx), take_rows(data, max_idx)
+    TI_init = take_rows(TI, min_idx)
+
+    t1_guess = TI_init / np.log(2)
+    for _ in range(n_iterations):
+        e_ti = np.exp(-TI_init / t1_guess)
+        e_tr = np.exp(-TR / t1_guess)
+        value = 1 - (1 + delta_init) * e_ti + e_tr
+        derivative = (-(1 + delta_init) * e_ti * TI_init + e_tr * TR) / t1_guess ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            new_t1_guess = t1_guess - value / derivative
+        # Stay positive, by moving at most halfway to zero
+        t1_guess = np.where(np.isfinite(new_t1_guess), np.maximum(new_t1_guess, t1_guess / 2), t1_guess)
+    # If the total data variation is less than 80%, guess the first TI since it could be a very short T1
+    first_TI = np.min(np.where(mask, TI, np.inf), axis=1)
+    t1_guess = np.where(min_data > max_data * .8, first_TI / np.log(2), t1_guess)
+
+    # Estimate Si based on the last TI
+    last_idx = np.argmax(np.where(mask, TI, -np.inf), axis=1)
+    si_init = take_rows(data, last_idx) / model_T1_2(Si=1, delta=delta_init, TI=take_rows(TI, last_idx),
+                                                     T1=t1_guess, TR=TR)
+    return {"T1": t1_guess, "Si": si_init, "delta": np.full(len(data), delta_init)}
+
+
+def estimate_T1_group(group_pd, init_values=None):
+    return estimate_T1(group_pd, ti_col="ti", data_col="data", tr_col="tr", init_values=init_values)
+
+
+########################################################################################################################
+# T2: mono-exponential decay, Si * exp(-TE / T2)
+def forward_T2(params, x):
+    return model_T2(Si=params["Si"], TE=x["te"], T2=params["T2"])
+
+
+def jacobian_T2(params, x):
+    decay = np.exp(-x["te"] / params["T2"])
+    d_T2 = params["Si"] * decay * x["te"] / params["T2"] ** 2
+    return np.stack([d_T2, decay], axis=-1)
+
+
+def init_T2_batched(x, data, mask):
+    """ Batched version of the heuristic initialization of t2_fitting.init_T2 """
+    TE = x["te"]
+    _, max_idx = get_masked_min_max(data, mask)
+    si_init = take_rows(data, max_idx)
+    te_init = take_rows(TE, max_idx)
+    # The closest echo to half the initial signal
+    target_idx = np.argmin(np.where(mask, np.abs(data - si_init[:, None] / 2), np.inf), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t2_init = (take_rows(TE, target_idx) - te_init) / np.log(si_init / take_rows(data, target_idx))
+    # Fall back to the mean echo time where the heuristic fails (e.g. flat data)
+    mean_TE = np.sum(TE * mask, axis=1) / np.sum(mask, axis=1)
+    t2_init = np.where(np.isfinite(t2_init) & (t2_init > 0), t2_init, mean_TE)
+    return {"T2": t2_init, "Si": si_init}
+
+
+def estimate_T2_group(group_pd, init_values=None):
+    return estimate_T2(group_pd, te_col="te", data_col="data", init_values=init_values)
+
+
+########################################################################################################################
+# T2 (EPG): CPMG echo train with stimulated echoes, Si * EPG(T2, B1)
+def forward_T2_EPG(params, x):
+    TE = x["te"]
+    echo_indices, echo_spacing = get_echo_indices(TE)
+    signals = simulate_cpmg_epg(params["T2"][:, 0], params["B1"][:, 0], echo_spacing, int(np.max(echo_indices)))
+    return params["Si"] * np.take_along_axis(signals, echo_indices - 1, axis=1)
+
+
+def init_T2_EPG_batched(x, data, mask):
+    """ Initialize with the best match of the mean echo train of each voxel in the EPG dictionary """
+    echo_indices, echo_spacing = get_echo_indices(x["te"])
+    n_echos = int(np.max(echo_indices))
+    echo_sums = np.zeros((len(data), n_echos))
+    echo_counts = np.zeros((len(data), n_echos))
+    rows = np.broadcast_to(np.arange(len(data))[:, None], data.shape)
+    np.add.at(echo_sums, (rows[mask], echo_indices[mask] - 1), data[mask])
+    np.add.at(echo_counts, (rows[mask], echo_indices[mask] - 1), 1)
+    # Only match the echoes that all voxels have
+    measured_echos = np.all(echo_counts > 0, axis=0)
+    dictionary = get_epg_dictionary(echo_spacing, n_echos)
+    best_idx, scale, _ = match_epg_dictionary(echo_sums[:, measured_echos] / echo_counts[:, measured_echos],
+                                              dictionary["signals"][:, measured_echos])
+    return {"T2": dictionary["T2"][best_idx], "Si": scale, "B1": dictionary["B1"][best_idx]}
+
+
+def estimate_T2_EPG_all_groups(data_pd, group_cols):
+    return get_epg_estimates_for_data_by_group(data_pd, "t2_epg", group_cols)
+
+
+########################################################################################################################
+# ADC: mono-exponential diffusion decay of the direction-averaged data, Si * exp(-b * ADC)
+def forward_ADC(params, x):
+    return params["Si"] * np.exp(-x["b_value"] * params["ADC"])
+
+
+def jacobian_ADC(params, x):
+    decay = np.exp(-x["b_value"] * params["ADC"])
+    return np.stack([-x["b_value"] * params["Si"] * decay, decay], axis=-1)
+
+
+def init_ADC_batched(x, data, mask):
+    """ Initialize with the closed-form weighted log-linear fit """
+    ADC, Si, _, _, _ = fit_adc_log_linear(x["b_value"], data, mask)
+    # Fall back to a typical tissue ADC (mm^2/s) and the maximum signal where the log-linear fit fails
+    usable = np.isfinite(ADC) & (ADC > 0) & np.isfinite(Si) & (Si > 0)
+    Si = np.where(usable, Si, np.max(np.where(mask, data, -np.inf), axis=1))
+    ADC = np.where(usable, ADC, 1e-3)
+    return {"ADC": ADC, "Si": Si}
+
+
+def estimate_ADC_all_groups(data_pd, group_cols):
+    return get_adc_estimates_for_data_by_group(data_pd, group_cols)
+
+
+register_model(FitModel("t1", param_names=["T1", "Si", "delta"], independent_cols=["ti", "tr"],
+                        bounds={"T1": (0, np.inf), "Si": (0, np.inf), "delta": (0, 1)},
+                        forward=forward_T1, jacobian=jacobian_T1, initializer=init_T1_batched,
+                        estimate_group=estimate_T1_group,
+                        # The absolute value in the model gives local minima near the null point
+                        start_scales=(0.8, 1., 1.25)))
+register_model(FitModel("t2", param_names=["T2", "Si"], independent_cols=["te"],
+                        bounds={"T2": (0, np.inf), "Si": (0, np.inf)},
+                        forward=forward_T2, jacobian=jacobian_T2, initializer=init_T2_batched,
+                        estimate_group=estimate_T2_group))
+register_model(FitModel("t2_epg", param_names=["T2", "Si", "B1"], independent_cols=["te"],
+                        bounds={"T2": (0, np.inf), "Si": (0, np.inf), "B1": (0.3, 1.5)},
+                        forward=forward_T2_EPG, initializer=init_T2_EPG_batched,
+                        estimate_all_groups=estimate_T2_EPG_all_groups))
+register_model(FitModel("adc", param_names=["ADC", "Si"], independent_cols=["b_value"],
+                        bounds={"ADC": (0, np.inf), "Si": (0, np.inf)},
+                        forward=forward_ADC, jacobian=jacobian_ADC, initializer=init_ADC_batched,
+                        estimate_all_groups=estimate_ADC_all_groups, prepare_data=average_diffusion_directions))
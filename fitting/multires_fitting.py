@@ -0,0 +1,88 @@
+import time
+import numpy as np
+import pandas as pd
+from fitting.constants import get_all_quantitative_variables, get_quantitative_variable
+from fitting.fitting_utils import summarize_fit_cost
+from fitting.overall_fitting import get_measurement_estimates_for_data_by_group
+
+
+def check_multiresolution_factors(factors):
+    """ Get the coarse-to-fine downsampling factors, checking that each factor divides the previous one """
+    factors = sorted([int(f) for f in factors if int(f) > 1], reverse=True)
+    for coarse_factor, fine_factor in zip(factors[:-1], factors[1:]):
+        if coarse_factor % fine_factor != 0:
+            raise Exception(f"Each multiresolution factor must divide the previous one, got: {factors}")
+    return factors
+
+
+def downsample_data_pd(data_pd, factor):
+    """ Block-average the data over factor x factor in-plane blocks, for each slice and acquisition """
+    data_pd = data_pd.copy()
+    # Keep repeated acquisitions of the same voxel separate, as they are in the full resolution data
+    acquisition_cols = [c for c in data_pd.columns if c not in ["x", "y", "data"]]
+    data_pd["repeat"] = data_pd.groupby(["x", "y"] + acquisition_cols, dropna=False).cumcount()
+    data_pd["x"] = data_pd["x"] // factor
+    data_pd["y"] = data_pd["y"] // factor
+    # Round up without negating, which would wrap around for unsigned (compact) dtypes
+    data_pd["nx"] = (data_pd["nx"] + factor - 1) // factor
+    data_pd["ny"] = (data_pd["ny"] + factor - 1) // factor
+    block_cols = [c for c in data_pd.columns if c != "data"]
+    data_pd = data_pd.groupby(block_cols, dropna=False, sort=False)["data"].mean().reset_index()
+    data_pd = data_pd.drop(columns="repeat")
+    return data_pd
+
+
+def upsample_fit_to_init_pd(fit_pd, datatype, voxels_pd, factor, group_cols=("slc", "x", "y")):
+    """ Get initial values for each voxel in voxels_pd from a fit that was done on data downsampled by factor.
+    Voxels with invalid or missing coarse fits get no initial values (NaN), so the heuristic is used instead """
+    group_cols = list(group_cols)
+    quant_cols = get_all_quantitative_variables(datatype)
+    coarse_pd = fit_pd.drop_duplicates(subset=group_cols)
+    valid_col = "valid_fit_by_stderr_" + get_quantitative_variable(datatype)
+    coarse_pd = coarse_pd[group_cols + quant_cols + [valid_col]].copy()
+    coarse_pd.loc[~coarse_pd[valid_col].astype(bool), quant_cols] = np.nan
+    coarse_pd = coarse_pd.drop(columns=valid_col)
+    coarse_pd = coarse_pd.rename(columns={"x": "x_coarse", "y": "y_coarse"})
+
+    init_pd = voxels_pd[group_cols].drop_duplicates().copy()
+    init_pd["x_coarse"] = init_pd["x"] // factor
+    init_pd["y_coarse"] = init_pd["y"] // factor
+    coarse_group_cols = [{"x": "x_coarse", "y": "y_coarse"}.get(c, c) for c in group_cols]
+    init_pd = pd.merge(init_pd,
+                       coarse_pd,
+                       on=coarse_group_cols,
+                       how="left")
+    init_pd = init_pd.drop(columns=["x_coarse", "y_coarse"])
+    return init_pd
+
+
+def get_multiresolution_estimates(data_pd, datatype, factors, group_cols=None, run_report=None, fit_engine="lmfit",
+                                  n_workers=1, record_telemetry=False):
+    """ Fit the data coarse-to-fine: fit block-averaged data for each downsampling factor (e.g. [4, 2]), using the
+    upsampled fit of each level as the initial values of the next one, and finish with a full resolution fit. Each
+    level is fit with the fit engine over n_workers worker processes. If record_telemetry, the full resolution fit has
+    the solver telemetry of each group.
+    Returns the full resolution fit and the fit cost (voxels, solver evaluations, wall time) of each level """
+    if group_cols is None:
+        group_cols = ["slc", "x", "y"]
+    factors = check_multiresolution_factors(factors)
+    level_fit_costs = {}
+    previous_fit_pd = None
+    previous_factor = None
+    for factor in factors + [1]:
+        start_time = time.time()
+        level_data_pd = data_pd if factor == 1 else downsample_data_pd(data_pd, factor)
+        level_init_pd = None
+        if previous_fit_pd is not None:
+            level_init_pd = upsample_fit_to_init_pd(previous_fit_pd, datatype, level_data_pd,
+                                                    previous_factor // factor, group_cols=group_cols)
+        fit_pd = get_measurement_estimates_for_data_by_group(level_data_pd, datatype, group_cols=group_cols,
+                                                             init_pd=level_init_pd, run_report=run_report,
+                                                             fit_engine=fit_engine, n_workers=n_workers,
+                                                             record_telemetry=record_telemetry and (factor == 1))
+        level_fit_costs[factor] = summarize_fit_cost(fit_pd, time.time() - start_time, group_cols=group_cols)
+        print(f"Multiresolution level {factor}x{factor}: fit {level_fit_costs[factor]['num_voxels']} voxels with "
+              f"{level_fit_costs[factor]['nfev']} solver evaluations in {level_fit_costs[factor]['wall_time']:.2f} s")
+        previous_fit_pd = fit_pd
+        previous_factor = factor
+    return previous_fit_pd, level_fit_costs
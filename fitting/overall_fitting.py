@@ -1,21 +1,44 @@
+import time
+import functools
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from fitting.constants import get_all_quantitative_variables, get_quantitative_variable
-from fitting.t1_fitting import estimate_T1
-from fitting.t2_fitting import estimate_T2
+from fitting.models import get_model
+from fitting.batched_fitting import get_padded_arrays, fit_batched_multistart
+from fitting.solver_telemetry import telemetry_cols, add_batched_telemetry
+from profiling.run_report import optional_stage, add_counts
+from utils_io.compact_dtypes import expand_categorical_columns
 
+# Engines to fit iterative models with: lmfit for each group, a vectorized solver for all groups at once, or the
+# vectorized solver followed by lmfit for only the groups whose vectorized fit looks unreliable (hybrid)
+fit_engines = ["lmfit", "batched", "hybrid"]
 
-def get_limited_values(data_pd,
-                       datatype,
-                       values_to_use):
+# Hybrid fits refine the groups with a norm_redchi above this factor times the median norm_redchi. To estimate the
+# time saved against fitting all groups with lmfit, lmfit is timed on this many of the other groups of a run (see
+# time_lmfit_groups)
+hybrid_redchi_factor = 3.
+hybrid_calibration_groups = 10
+
+
+def get_limited_value_column(datatype):
+    """ Get the column of the values (e.g. inversion times) that the data of the datatype can be limited to """
     if datatype == "t1":
         value_column_name = "ti"
-    elif datatype == "t2":
+    elif datatype in ["t2", "t2_epg"]:
         value_column_name = "te"
+    elif datatype == "adc":
+        value_column_name = "target_b_value"
     else:
         raise Exception(f"Cannot limit data for datatype {datatype}")
         # Note, can't do this for "map", since it's already mapped
+    return value_column_name
 
+
+def get_limited_values(data_pd,
+                       datatype,
+                       values_to_use):
+    value_column_name = get_limited_value_column(datatype)
     unique_values = np.unique(data_pd[value_column_name])
     data_pd = data_pd[data_pd[value_column_name].isin(values_to_use)]
 
@@ -32,10 +55,105 @@ def get_limited_values(data_pd,
 
 def get_measurement_estimates_for_data_by_group(data_pd,
                                                 datatype,
-                                                group_cols=None):
-    """ Get measurement fits for the datatype, by grouping a certain way """
-    # Get information on valid rows
-    data_pd = data_pd.copy()
+                                                group_cols=None,
+                                                init_pd=None,
+                                                run_report=None,
+                                                fit_engine="lmfit",
+                                                n_workers=1,
+                                                record_telemetry=False):
+    """ Get measurement fits for the datatype, by grouping a certain way, with the model registered for the datatype.
+    Iterative models are fit with the fit engine (see fit_engines), split over n_workers worker processes if
+    n_workers > 1. If init_pd is given, its quantitative values (by group_cols) are used as initial values in place
+    of the heuristic initial values. If record_telemetry, the fits of iterative models have the solver telemetry of
+    each group (see telemetry_cols). If run_report is given, the time spent preparing the groups, fitting them, and
+    merging the fits is recorded in it """
+    if fit_engine not in fit_engines:
+        raise Exception(f"Unknown fit engine: {fit_engine}")
+    with optional_stage(run_report, "prepare_groups") as stage:
+        data_pd = prepare_groups_for_fit(data_pd, datatype, group_cols=group_cols)
+        add_counts(stage, rows=len(data_pd))
+    if group_cols is None:
+        group_cols = ["dummy"]
+
+    # Process the map data right away and return
+    if "map" in datatype:
+        with optional_stage(run_report, "map_groups") as stage:
+            fit_pd = get_map_estimates_for_data_by_group(data_pd, datatype, group_cols)
+            add_counts(stage, rows=len(data_pd), voxels=len(fit_pd.drop_duplicates(subset=group_cols)))
+        return fit_pd
+
+    model = get_model(datatype)
+    if model.prepare_data is not None:
+        with optional_stage(run_report, "prepare_data") as stage:
+            data_pd = model.prepare_data(data_pd, group_cols)
+            add_counts(stage, rows=len(data_pd))
+
+    # Estimate all groups at once for models that are not iterative (e.g. matching against the EPG dictionary)
+    if (model.estimate_all_groups is not None) and (fit_engine != "batched"):
+        with optional_stage(run_report, "estimate_all_groups") as stage:
+            fit_pd = model.estimate_all_groups(data_pd, group_cols)
+            add_counts(stage, rows=len(data_pd), voxels=len(fit_pd.drop_duplicates(subset=group_cols)))
+        return fit_pd
+
+    # Otherwise, fit the groups with the fit engine
+    with optional_stage(run_report, "fit_groups", fit_engine=fit_engine) as stage:
+        if fit_engine == "hybrid":
+            all_grouped_data, fit_pd, estimate_time = fit_groups_hybrid(data_pd, datatype, group_cols,
+                                                                        init_pd=init_pd, n_workers=n_workers,
+                                                                        record_telemetry=record_telemetry)
+            add_counts(stage, refined_voxels=int(np.sum(fit_pd["refined"])),
+                       lmfit_time=float(np.nansum(fit_pd.loc[fit_pd["refined"], "lmfit_time"])))
+        else:
+            all_grouped_data, fit_pd, estimate_time = fit_groups_with_engine(data_pd, datatype, group_cols,
+                                                                             init_pd=init_pd, fit_engine=fit_engine,
+                                                                             n_workers=n_workers,
+                                                                             record_telemetry=record_telemetry)
+        add_counts(stage, rows=len(all_grouped_data), voxels=len(fit_pd), nfev=int(np.sum(fit_pd["nfev"])),
+                   estimate_time=estimate_time)
+
+    with optional_stage(run_report, "merge_fits") as stage:
+        fit_pd = merge_fits(all_grouped_data, fit_pd, datatype)
+        add_counts(stage, rows=len(fit_pd))
+    return fit_pd
+
+
+def get_measurement_estimates_for_data_subsets(data_pds, datatype, group_cols, run_report=None, fit_engine="lmfit",
+                                               n_workers=1):
+    """ Get the measurement fits of several datasets (e.g. the same slice limited to different subsets of inversion
+    times), as get_measurement_estimates_for_data_by_group does for each of them. With the batched fit engine, the
+    groups of all datasets are fit in one pass of the vectorized solver. Returns the fits of each dataset """
+    model = get_model(datatype) if "map" not in datatype else None
+    if (fit_engine != "batched") or (model is None):
+        return [get_measurement_estimates_for_data_by_group(data_pd, datatype, group_cols=group_cols,
+                                                            run_report=run_report, fit_engine=fit_engine,
+                                                            n_workers=n_workers)
+                for data_pd in data_pds]
+
+    with optional_stage(run_report, "prepare_groups") as stage:
+        prepared_data_pds = []
+        for data_pd in data_pds:
+            data_pd = prepare_groups_for_fit(data_pd, datatype, group_cols=group_cols)
+            if model.prepare_data is not None:
+                data_pd = model.prepare_data(data_pd, group_cols)
+            prepared_data_pds.append(data_pd)
+            add_counts(stage, rows=len(data_pd))
+
+    with optional_stage(run_report, "fit_groups", fit_engine=fit_engine) as stage:
+        results, estimate_time = fit_subsets_batched(prepared_data_pds, datatype, group_cols)
+        add_counts(stage, rows=int(np.sum([len(result[0]) for result in results])),
+                   voxels=int(np.sum([len(result[1]) for result in results])),
+                   nfev=int(np.sum([np.sum(result[1]["nfev"]) for result in results])), estimate_time=estimate_time)
+
+    with optional_stage(run_report, "merge_fits") as stage:
+        fit_pds = [merge_fits(all_grouped_data, fit_pd, datatype) for all_grouped_data, fit_pd in results]
+        add_counts(stage, rows=int(np.sum([len(fit_pd) for fit_pd in fit_pds])))
+    return fit_pds
+
+
+def prepare_groups_for_fit(data_pd, datatype, group_cols=None):
+    """ Add the group information (number of voxels with data) and remove invalid rows before fitting """
+    # Get information on valid rows. The models compute with the values of categorical (compact) columns
+    data_pd = expand_categorical_columns(data_pd.copy())
     data_pd["valid"] = ~data_pd["data"].isna()
     if "map" in datatype:
         data_pd["valid"] = data_pd["valid"] & (data_pd["data"] != 0)
@@ -60,36 +178,94 @@ def get_measurement_estimates_for_data_by_group(data_pd,
     else:
         data_pd = data_pd[data_pd["valid"]]
     data_pd = data_pd.drop(columns="valid")
+    return data_pd
 
-    # Process the map data right away and return
-    if "map" in datatype:
-        grouped_pd = data_pd.groupby(group_cols)
-        map_colname = datatype.split("_map")[0].upper()
-        agg_grouped_pd = grouped_pd.agg(
-            map_colname=pd.NamedAgg(column="data", aggfunc=np.nanmean)
-        )
-        agg_grouped_pd = agg_grouped_pd.rename(columns={"map_colname": map_colname})
-        fit_pd = pd.merge(data_pd,
-                          agg_grouped_pd.reset_index(),
-                          on=group_cols,
-                          how="left")
-        return fit_pd
 
-    # Otherwise, process each group individually. First add the columns for fitting
+def get_map_estimates_for_data_by_group(data_pd, datatype, group_cols):
+    """ Get the mean mapped value (e.g. from scanner T2 maps) for each group """
+    grouped_pd = data_pd.groupby(group_cols)
+    map_colname = datatype.split("_map")[0].upper()
+    agg_grouped_pd = grouped_pd.agg(
+        map_colname=pd.NamedAgg(column="data", aggfunc=np.nanmean)
+    )
+    agg_grouped_pd = agg_grouped_pd.rename(columns={"map_colname": map_colname})
+    fit_pd = pd.merge(data_pd,
+                      agg_grouped_pd.reset_index(),
+                      on=group_cols,
+                      how="left")
+    return fit_pd
+
+
+def get_fit_cols(datatype):
+    """ Get the columns that a fit adds to the data """
+    fit_cols = []
+    for quant_c in get_all_quantitative_variables(datatype):
+        fit_cols.append(quant_c)
+        fit_cols.append("init_" + quant_c)
+        fit_cols.append("stderr_" + quant_c)
+    fit_cols.append("norm_redchi")
+    fit_cols.append("nfev")
+    return fit_cols
+
+
+def get_init_values_by_group(init_pd, datatype, group_cols):
+    """ Get the given initial values of each group, keyed by the tuple of its group_cols values """
+    if init_pd is None:
+        return {}
+    init_cols = [c for c in get_all_quantitative_variables(datatype) if c in init_pd.columns]
+    init_keys = init_pd[group_cols].itertuples(index=False, name=None)
+    return dict(zip(init_keys, init_pd[init_cols].to_dict("records")))
+
+
+def fit_groups_with_engine(data_pd, datatype, group_cols, init_pd=None, fit_engine="lmfit", n_workers=1,
+                           **fit_kwargs):
+    """ Fit the groups with the fit engine (lmfit or batched), in parallel over n_workers worker processes if
+    n_workers > 1. Other keyword arguments are passed on to the fit function. Returns the grouped data, the fits by
+    group and the time spent in the fit engine """
+    fit_function = fit_groups_batched if fit_engine == "batched" else fit_groups
+    if len(fit_kwargs) > 0:
+        fit_function = functools.partial(fit_function, **fit_kwargs)
+    n_groups = int(data_pd["group"].nunique())
+    if (n_workers is None) or (n_workers <= 1) or (n_groups < 2 * n_workers):
+        return fit_function(data_pd, datatype, group_cols, init_pd=init_pd)
+
+    # Split the groups into one contiguous chunk per worker, and number the groups of each chunk after the groups of
+    # the previous chunks
+    group_chunks = np.array_split(np.sort(data_pd["group"].unique()), n_workers)
+    data_chunks = [data_pd[data_pd["group"].isin(group_chunk)] for group_chunk in group_chunks]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(fit_function, data_chunks, [datatype] * n_workers, [group_cols] * n_workers,
+                                    [init_pd] * n_workers))
+    all_grouped_data_chunks, fit_pd_chunks = [], []
+    group_offset = 0
+    for all_grouped_data, fit_pd, _ in results:
+        all_grouped_data_chunks.append(all_grouped_data.assign(group=all_grouped_data["group"] + group_offset))
+        fit_pd_chunks.append(fit_pd.assign(group=fit_pd["group"] + group_offset))
+        group_offset += len(fit_pd)
+    estimate_time = float(np.sum([result[2] for result in results]))
+    return pd.concat(all_grouped_data_chunks), pd.concat(fit_pd_chunks, ignore_index=True), estimate_time
+
+
+def fit_groups(data_pd, datatype, group_cols, init_pd=None, record_fit_time=False, record_telemetry=False):
+    """ Fit each group individually with lmfit. Returns the grouped data, the fits by group and the time spent in the
+    model's estimate_group calls (initialization and solver). If record_fit_time, the fits by group also have the
+    time spent on each group (fit_time), and if record_telemetry, whether lmfit converged and its message about why
+    the solver stopped too (see telemetry_cols) """
+    model = get_model(datatype)
+    if model.estimate_group is None:
+        raise Exception(f"The model for datatype {datatype} cannot be fit with lmfit")
+    # First add the columns for fitting
     quant_cols = get_all_quantitative_variables(datatype)
-    cols_to_add = []
-    for quant_c in quant_cols:
-        cols_to_add.append(quant_c)
-        cols_to_add.append("init_" + quant_c)
-        cols_to_add.append("stderr_" + quant_c)
-    cols_to_add.append("norm_redchi")
     fit_dict = {"group": []}
-    for c in cols_to_add:
+    for c in get_fit_cols(datatype):
         fit_dict[c] = []
         # Remove these columns if they are already there
         if c in data_pd.columns:
             data_pd = data_pd.drop(columns=c)
 
+    # Get the initial values for each group, if given
+    init_values_by_group = get_init_values_by_group(init_pd, datatype, group_cols)
+
     # Then, process the data
     grouped_pd = data_pd.groupby(group_cols)
     print_status = True
@@ -98,23 +274,26 @@ def get_measurement_estimates_for_data_by_group(data_pd,
     num_groups = len(grouped_pd)
     percent_done = 0
     current_group_count = 0
-    all_grouped_data = pd.DataFrame()
+    estimate_time = 0.
+    fit_times = []
+    successes = []
+    fit_statuses = []
+    grouped_data = []
     for name, group in grouped_pd:
         current_group_count += 1
         group["group"] = current_group_count
-        all_grouped_data = pd.concat([all_grouped_data, group])
+        grouped_data.append(group)
         if print_status:
             if current_group_count / num_groups * 100 >= percent_done:
                 print(percent_done, "% done")
                 percent_done += 10
 
         # Fit the models
-        if datatype == "t1":
-            out1, params = estimate_T1(group, ti_col="ti", data_col="data", tr_col="tr")
-        elif datatype == "t2":
-            out1, params = estimate_T2(group, te_col="te", data_col="data")
-        else:
-            raise Exception(f"Unknown data type: {datatype}")
+        init_values = init_values_by_group.get(name if isinstance(name, tuple) else (name,))
+        start_time = time.perf_counter()
+        out1, params = model.estimate_group(group, init_values=init_values)
+        fit_times.append(time.perf_counter() - start_time)
+        estimate_time += fit_times[-1]
 
         # Save results
         for quant_c in quant_cols:
@@ -122,7 +301,11 @@ def get_measurement_estimates_for_data_by_group(data_pd,
             fit_dict["stderr_" + quant_c].extend([out1.params[quant_c].stderr])
             fit_dict["init_" + quant_c].extend([params[quant_c].value])
         fit_dict["norm_redchi"].extend([out1.redchi / out1.params['Si'].value / out1.params['Si'].value])
+        fit_dict["nfev"].extend([out1.nfev])
         fit_dict["group"].extend([current_group_count])
+        if record_telemetry:
+            successes.append(bool(out1.success))
+            fit_statuses.append(str(out1.message))
 
     # Create the dataframe, but first make sure the dictionary has the correct form
     col_lens = []
@@ -132,7 +315,188 @@ def get_measurement_estimates_for_data_by_group(data_pd,
         col_len_vals[c] = len(v)
     assert len(np.unique(col_lens)) == 1, f"All columns must be same length, found: {col_len_vals}"
     fit_pd = pd.DataFrame(fit_dict)
+    if record_fit_time or record_telemetry:
+        fit_pd["fit_time"] = fit_times
+    if record_telemetry:
+        fit_pd["success"] = successes
+        fit_pd["fit_status"] = fit_statuses
+    # Concatenating once at the end, instead of for each group, keeps this linear in the number of groups
+    all_grouped_data = pd.concat(grouped_data) if len(grouped_data) > 0 else pd.DataFrame()
+    return all_grouped_data, fit_pd, estimate_time
+
+
+def get_batched_problem(data_pd, datatype, group_cols, init_pd=None):
+    """ Get the grouped data (numbered as by fit_groups), and the padded independent variables, data, mask and
+    initial parameters of all groups to fit with the vectorized solver """
+    model = get_model(datatype)
+    if model.forward is None:
+        raise Exception(f"The model for datatype {datatype} has no forward model to fit with the batched engine")
+    data_pd = data_pd.drop(columns=[c for c in get_fit_cols(datatype) if c in data_pd.columns])
+    data_pd = data_pd.sort_values(group_cols, kind="stable")
+    data_pd["group"] = data_pd.groupby(group_cols, sort=True).ngroup() + 1
+    x, data, mask = get_padded_arrays(data_pd, group_cols, model.independent_cols)
+    init_values = model.initializer(x, data, mask)
+
+    # Override the heuristic initial values with the given initial values, where they are usable
+    if init_pd is not None:
+        groups_pd = data_pd.drop_duplicates(subset="group")[group_cols]
+        given_init_pd = pd.merge(groups_pd, init_pd, on=group_cols, how="left")
+        lower, upper = model.get_bounds()
+        for idx, name in enumerate(model.param_names):
+            if name not in given_init_pd.columns:
+                continue
+            values = given_init_pd[name].to_numpy(dtype=float)
+            usable = np.isfinite(values) & (values > 0)
+            init_values[name] = np.where(usable, np.clip(values, lower[idx], upper[idx]), init_values[name])
+    init_params = np.stack([init_values[name] for name in model.param_names], axis=1)
+    return data_pd, x, data, mask, init_params
+
+
+def get_batched_fit_pd(datatype, params, init_params, stderr, redchi, nfev):
+    """ Get the fits by group (numbered as by fit_groups) from the results of the vectorized solver """
+    model = get_model(datatype)
+    fit_dict = {"group": np.arange(1, len(params) + 1)}
+    for idx, quant_c in enumerate(model.param_names):
+        fit_dict[quant_c] = params[:, idx]
+        fit_dict["init_" + quant_c] = init_params[:, idx]
+        fit_dict["stderr_" + quant_c] = stderr[:, idx]
+    si = params[:, model.param_names.index("Si")]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fit_dict["norm_redchi"] = redchi / si / si
+    fit_dict["nfev"] = nfev
+    return pd.DataFrame(fit_dict)[["group"] + get_fit_cols(datatype)]
+
+
+def fit_groups_batched(data_pd, datatype, group_cols, init_pd=None, record_telemetry=False):
+    """ Fit all groups at once with the vectorized solver, using the model's forward model, Jacobian and batched
+    initializer. Returns the grouped data, the fits by group (numbered as by fit_groups) and the time spent in the
+    initializer and solver. If record_telemetry, the fits by group have the solver telemetry (see
+    add_batched_telemetry) """
+    model = get_model(datatype)
+    start_time = time.perf_counter()
+    data_pd, x, data, mask, init_params = get_batched_problem(data_pd, datatype, group_cols, init_pd=init_pd)
+    params, stderr, redchi, nfev, status = fit_batched_multistart(model, x, data, mask, init_params,
+                                                                  start_scales=model.start_scales,
+                                                                  return_status=True)
+    estimate_time = time.perf_counter() - start_time
+    fit_pd = get_batched_fit_pd(datatype, params, init_params, stderr, redchi, nfev)
+    if record_telemetry:
+        fit_pd = add_batched_telemetry(fit_pd, status, estimate_time)
+    return data_pd, fit_pd, estimate_time
+
+
+def fit_subsets_batched(data_pds, datatype, group_cols):
+    """ Fit the groups of several datasets (e.g. the same voxels with different subsets of inversion times) in one
+    pass of the vectorized solver, by stacking the padded arrays of all of them. Returns the grouped data and the fits
+    by group of each dataset, as fit_groups_batched does, and the time spent in the initializer and solver """
+    model = get_model(datatype)
+    start_time = time.perf_counter()
+    problems = [get_batched_problem(data_pd, datatype, group_cols) for data_pd in data_pds]
+    n_rows = max([problem[2].shape[1] for problem in problems])
+
+    def pad_columns(values, constant=None):
+        # Pad with the last column, so the padded values are valid model inputs, unless a constant is given
+        padding = ((0, 0), (0, n_rows - values.shape[1]))
+        if constant is None:
+            return np.pad(values, padding, mode="edge")
+        return np.pad(values, padding, constant_values=constant)
+
+    x = {c: np.concatenate([pad_columns(problem[1][c]) for problem in problems]) for c in model.independent_cols}
+    data = np.concatenate([pad_columns(problem[2]) for problem in problems])
+    mask = np.concatenate([pad_columns(problem[3], constant=False) for problem in problems])
+    init_params = np.concatenate([problem[4] for problem in problems])
+    params, stderr, redchi, nfev = fit_batched_multistart(model, x, data, mask, init_params,
+                                                          start_scales=model.start_scales)
+    estimate_time = time.perf_counter() - start_time
+
+    results = []
+    offsets = np.cumsum([0] + [len(problem[4]) for problem in problems])
+    for problem, start, end in zip(problems, offsets[:-1], offsets[1:]):
+        fit_pd = get_batched_fit_pd(datatype, params[start:end], init_params[start:end], stderr[start:end],
+                                    redchi[start:end], nfev[start:end])
+        results.append((problem[0], fit_pd))
+    return results, estimate_time
+
+
+def get_groups_to_refine(fit_pd, datatype, redchi_factor=hybrid_redchi_factor):
+    """ Flag the fits by group that are unreliable: with a non-finite parameter or standard error, a standard error of
+    the quantitative variable that is not below its value (as for valid_fit_by_stderr_*), or a norm_redchi above
+    redchi_factor times the median norm_redchi of all groups """
+    quant_cols = get_all_quantitative_variables(datatype)
+    map_colname = get_quantitative_variable(datatype)
+    finite = np.all(np.isfinite(fit_pd[quant_cols + ["stderr_" + c for c in quant_cols]].to_numpy(dtype=float)),
+                    axis=1)
+    valid_stderr = (fit_pd["stderr_" + map_colname] < fit_pd[map_colname]).to_numpy()
+    norm_redchi = fit_pd["norm_redchi"].to_numpy(dtype=float)
+    max_norm_redchi = redchi_factor * np.nanmedian(norm_redchi) if np.any(np.isfinite(norm_redchi)) else np.inf
+    with np.errstate(invalid="ignore"):
+        small_redchi = np.isfinite(norm_redchi) & (norm_redchi <= max_norm_redchi)
+    return ~(finite & valid_stderr & small_redchi)
+
+
+def fit_groups_hybrid(data_pd, datatype, group_cols, init_pd=None, n_workers=1, redchi_factor=hybrid_redchi_factor,
+                      record_telemetry=False):
+    """ Fit all groups with the batched engine, and refit only the groups flagged by get_groups_to_refine with lmfit
+    (from the heuristic initial values), replacing their batched fits. The fits by group have whether each group was
+    refined, and the lmfit time (lmfit_time) of the refined groups. If record_telemetry, the fits by group have the
+    solver telemetry of the engine that fit each group last, with the fit time of both engines. Returns the grouped
+    data, the fits by group and the time spent in both fit engines """
+    all_grouped_data, fit_pd, estimate_time = fit_groups_with_engine(data_pd, datatype, group_cols, init_pd=init_pd,
+                                                                     fit_engine="batched", n_workers=n_workers,
+                                                                     record_telemetry=record_telemetry)
+    fit_pd["refined"] = get_groups_to_refine(fit_pd, datatype, redchi_factor=redchi_factor)
+    fit_pd["lmfit_time"] = np.nan
+
+    def fit_with_lmfit(groups, n_workers):
+        # Groups are numbered in the order of group_cols by both engines, so the k-th lmfit group is the k-th group
+        groups = np.sort(groups)
+        _, lmfit_pd, lmfit_time = fit_groups_with_engine(all_grouped_data[all_grouped_data["group"].isin(groups)],
+                                                         datatype, group_cols, fit_engine="lmfit",
+                                                         n_workers=n_workers, record_fit_time=True,
+                                                         record_telemetry=record_telemetry)
+        lmfit_pd["group"] = groups[lmfit_pd["group"].to_numpy() - 1]
+        return lmfit_pd.set_index("group"), lmfit_time
+
+    refined_groups = fit_pd.loc[fit_pd["refined"], "group"].to_numpy()
+    if len(refined_groups) > 0:
+        refined_pd, refine_time = fit_with_lmfit(refined_groups, n_workers)
+        estimate_time += refine_time
+        refined_rows = fit_pd["refined"].to_numpy()
+        batched_nfev = fit_pd.loc[refined_rows, "nfev"].to_numpy()
+        batched_fit_time = fit_pd.loc[refined_rows, "fit_time"].to_numpy() if record_telemetry else None
+        for c in get_fit_cols(datatype) + (telemetry_cols if record_telemetry else []):
+            fit_pd.loc[refined_rows, c] = refined_pd.loc[refined_groups, c].to_numpy()
+        # Count the solver evaluations (and fit time) of both engines
+        fit_pd.loc[refined_rows, "nfev"] = batched_nfev + refined_pd.loc[refined_groups, "nfev"].to_numpy()
+        if record_telemetry:
+            fit_pd.loc[refined_rows, "fit_time"] = batched_fit_time + refined_pd.loc[refined_groups,
+                                                                                     "fit_time"].to_numpy()
+        fit_pd.loc[refined_rows, "lmfit_time"] = refined_pd.loc[refined_groups, "fit_time"].to_numpy()
+    return all_grouped_data, fit_pd, estimate_time
+
+
+def time_lmfit_groups(data_pd, fit_pd, datatype, group_cols, n_groups=hybrid_calibration_groups, seed=0):
+    """ Time lmfit on n_groups groups of a hybrid fit (as merged into the data) that were not refined, sampled at
+    random, to estimate the time of fitting all groups with lmfit. This is separate from the hybrid fit, so its time
+    is not part of the fit time. Returns the fits with the lmfit time (lmfit_time) of the timed groups """
+    other_groups_pd = fit_pd.loc[~fit_pd["refined"].astype(bool), group_cols].drop_duplicates()
+    if (n_groups <= 0) or (len(other_groups_pd) == 0):
+        return fit_pd
+    rng = np.random.default_rng(seed)
+    sample_idx = rng.choice(len(other_groups_pd), size=min(n_groups, len(other_groups_pd)), replace=False)
+    timed_groups_pd = other_groups_pd.iloc[np.sort(sample_idx)]
+    timed_data_pd = pd.merge(data_pd, timed_groups_pd, on=group_cols, how="inner")
+    lmfit_pd = get_measurement_estimates_for_data_by_group(timed_data_pd, datatype, group_cols=group_cols,
+                                                           fit_engine="lmfit", record_telemetry=True)
+    lmfit_time_pd = lmfit_pd.drop_duplicates(subset=group_cols)[group_cols + ["fit_time"]].rename(
+        columns={"fit_time": "timed_lmfit_time"})
+    fit_pd = pd.merge(fit_pd, lmfit_time_pd, on=group_cols, how="left")
+    fit_pd["lmfit_time"] = fit_pd["lmfit_time"].where(fit_pd["timed_lmfit_time"].isna(), fit_pd["timed_lmfit_time"])
+    return fit_pd.drop(columns="timed_lmfit_time")
+
 
+def merge_fits(all_grouped_data, fit_pd, datatype):
+    """ Merge the fits by group back into the grouped data, and label valid fits based on stderrs """
     # Merge it back into the original data
     fit_pd = pd.merge(all_grouped_data,
                       fit_pd,
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+from fitting.constants import get_all_quantitative_variables
+
+# Percentiles of each quantity that are reported for each label, along with the median
+default_percentiles = (5, 25, 75, 95)
+
+
+def load_label_map(filename):
+    """ Load an (nx, ny, nslc) label map, from a .npy file or the labels of a .npz file (e.g. the ground truth saved by
+    generate_synthetic_data.py) """
+    if filename.endswith(".npz"):
+        with np.load(filename) as f:
+            if "labels" not in f.files:
+                raise Exception(f"No labels found in {filename}, found: {f.files}")
+            label_map = f["labels"]
+    else:
+        label_map = np.load(filename)
+    if label_map.ndim == 2:
+        label_map = label_map[:, :, None]
+    if (label_map.ndim != 3) or (not np.issubdtype(label_map.dtype, np.integer)):
+        raise Exception(f"The label map must be a 2D or 3D integer array, found: {label_map.dtype} {label_map.shape}")
+    return label_map
+
+
+def load_label_names(filename):
+    """ Load the name of each label from a csv file with label and name columns (e.g. the compartments saved by
+    generate_synthetic_data.py) """
+    names_pd = pd.read_csv(filename)
+    return dict(zip(names_pd["label"].astype(int), names_pd["name"].astype(str)))
+
+
+def get_label_statistics(labels, values, percentiles=default_percentiles):
+    """ Get the number of values, mean, std, min, percentiles, median and max of the values of each label, for all
+    labels at once: the values are sorted by label and then value, so the percentiles of each label are read from its
+    contiguous run of sorted values. Returns one row per label """
+    percentiles = sorted(set(percentiles) | {50})
+    labels = np.asarray(labels)
+    values = np.asarray(values, dtype=float)
+    order = np.lexsort((values, labels))
+    sorted_labels = labels[order]
+    sorted_values = values[order]
+    unique_labels, starts, counts = np.unique(sorted_labels, return_index=True, return_counts=True)
+
+    stats = {"label": unique_labels, "num_valid": counts}
+    label_idx = np.repeat(np.arange(len(unique_labels)), counts)
+    stats["mean"] = np.bincount(label_idx, weights=sorted_values, minlength=len(unique_labels)) / counts
+    squared_deviation = (sorted_values - stats["mean"][label_idx]) ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["std"] = np.sqrt(np.bincount(label_idx, weights=squared_deviation, minlength=len(unique_labels)) /
+                               (counts - 1))
+    stats["min"] = sorted_values[starts] if len(starts) > 0 else np.array([])
+    for percentile in percentiles:
+        # Linear interpolation between the closest ranks, as numpy.percentile does
+        position = percentile / 100 * (counts - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.ceil(position).astype(int)
+        lower_values = sorted_values[starts + lower]
+        upper_values = sorted_values[starts + upper]
+        name = "median" if percentile == 50 else f"p{percentile:g}"
+        stats[name] = lower_values + (upper_values - lower_values) * (position - lower)
+    stats["max"] = sorted_values[starts + counts - 1] if len(starts) > 0 else np.array([])
+    return pd.DataFrame(stats)
+
+
+class ROIStatistics:
+    """ Statistics of the fitted quantities in each region of interest (label) of a label map, which the fits of each
+    slice can be added to as they are fit. Only voxels with finite values and valid fits (by all valid_fit_by_*
+    columns of the fits) are included in the statistics of a label, and labels in ignore_labels (e.g. background) are
+    left out. Each slice should only be added once """
+    def __init__(self, label_map, datatype=None, quantities=None, percentiles=default_percentiles, ignore_labels=(0,),
+                 label_names=None):
+        if (datatype is None) and (quantities is None):
+            raise Exception("Either the datatype or the quantities to get statistics of must be given")
+        self.label_map = label_map
+        self.quantities = list(quantities) if quantities is not None else get_all_quantitative_variables(datatype)
+        self.percentiles = percentiles
+        self.ignore_labels = list(ignore_labels)
+        self.label_names = label_names
+        self.num_voxels = 0
+        self.labels = []
+        self.values = {quantity: [] for quantity in self.quantities}
+        self.valid = []
+
+    def add_fits(self, fit_pd, voxel_cols=("x", "y", "slc")):
+        """ Add the fits of some voxels (e.g. of a slice), with one or more rows per voxel """
+        voxel_cols = list(voxel_cols)
+        for c in ["nx", "ny", "nslc"]:
+            if (c in fit_pd.columns) and (len(fit_pd) > 0):
+                size = int(fit_pd[c].values[0])
+                if size != self.label_map.shape[["nx", "ny", "nslc"].index(c)]:
+                    raise Exception(f"The label map of shape {self.label_map.shape} does not match the fits, with "
+                                    f"{c} = {size}")
+        fit_pd = fit_pd.drop_duplicates(subset=voxel_cols)
+        x, y, slc = [fit_pd[c].to_numpy(dtype=int) for c in voxel_cols]
+        labels = self.label_map[x, y, slc]
+        in_roi = ~np.isin(labels, self.ignore_labels)
+        valid = np.ones(len(fit_pd), dtype=bool)
+        for c in [c for c in fit_pd.columns if c.startswith("valid_fit_by_")]:
+            valid &= fit_pd[c].to_numpy(dtype=bool)
+        missing_quantities = [quantity for quantity in self.quantities if quantity not in fit_pd.columns]
+        if len(missing_quantities) > 0:
+            raise Exception(f"The fits do not have the quantities: {missing_quantities}")
+
+        self.num_voxels += int(np.sum(in_roi))
+        self.labels.append(labels[in_roi])
+        self.valid.append(valid[in_roi])
+        for quantity in self.quantities:
+            self.values[quantity].append(pd.to_numeric(fit_pd[quantity]).to_numpy(dtype=float)[in_roi])
+        return self
+
+    def get_statistics(self):
+        """ Get the statistics of each quantity and label, with one row per quantity and label, and the number of
+        voxels of the label that were fit (num_voxels) and that were valid (num_valid) """
+        labels = np.concatenate(self.labels) if len(self.labels) > 0 else np.array([], dtype=int)
+        valid = np.concatenate(self.valid) if len(self.valid) > 0 else np.array([], dtype=bool)
+        unique_labels, num_voxels = np.unique(labels, return_counts=True)
+        stats_pds = []
+        for quantity in self.quantities:
+            values = np.concatenate(self.values[quantity]) if len(self.values[quantity]) > 0 else np.array([])
+            use = valid & np.isfinite(values)
+            stats_pd = pd.merge(pd.DataFrame({"label": unique_labels, "num_voxels": num_voxels}),
+                                get_label_statistics(labels[use], values[use], percentiles=self.percentiles),
+                                on="label",
+                                how="left")
+            stats_pd["num_valid"] = stats_pd["num_valid"].fillna(0).astype(int)
+            stats_pd.insert(1, "quantity", quantity)
+            stats_pds.append(stats_pd)
+        stats_pd = pd.concat(stats_pds, ignore_index=True) if len(stats_pds) > 0 else pd.DataFrame()
+        if (self.label_names is not None) and (len(stats_pd) > 0):
+            stats_pd.insert(1, "name", stats_pd["label"].map(self.label_names))
+        return stats_pd
+
+
+def get_roi_statistics(fit_pd, label_map, datatype=None, quantities=None, percentiles=default_percentiles,
+                       ignore_labels=(0,), label_names=None):
+    """ Get the statistics of the fitted quantities in each label of the label map, see ROIStatistics """
+    roi_statistics = ROIStatistics(label_map, datatype=datatype, quantities=quantities, percentiles=percentiles,
+                                   ignore_labels=ignore_labels, label_names=label_names)
+    return roi_statistics.add_fits(fit_pd).get_statistics()
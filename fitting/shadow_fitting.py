@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from fitting.constants import get_all_quantitative_variables
+from fitting.overall_fitting import get_measurement_estimates_for_data_by_group
+
+# Default time budget of the shadow fit, as a fraction of the time of the fit it validates
+default_shadow_time_budget = 0.05
+
+# Fewest sampled voxels for the shadow fit to give meaningful error statistics
+min_shadow_voxels = 5
+
+
+def get_shadow_max_groups(max_groups, fit_time, shadow_time, shadow_groups, time_budget=default_shadow_time_budget):
+    """ Get the most groups (e.g. voxels) of a slice to re-fit with the reference fit so that the shadow fits stay
+    within the time budget: the time left of time_budget times the fit time so far (less the shadow fit time so far),
+    at the shadow fit time per group measured so far. Until it is measured, a single group is fit to measure it """
+    if time_budget is None:
+        return max_groups
+    budget_groups = 1 if shadow_groups == 0 else \
+        int(max(np.floor((time_budget * fit_time - shadow_time) / (shadow_time / shadow_groups)), 0))
+    return budget_groups if max_groups is None else min(max_groups, budget_groups)
+
+
+def sample_fitted_groups(fit_pd, group_cols, fraction, max_groups, rng):
+    """ Randomly sample a fraction (at most max_groups) of the fitted groups """
+    groups_pd = fit_pd[group_cols].drop_duplicates()
+    n_groups = int(np.ceil(len(groups_pd) * fraction))
+    if max_groups is not None:
+        n_groups = min(n_groups, max_groups)
+    sample_idx = rng.choice(len(groups_pd), size=n_groups, replace=False)
+    return groups_pd.iloc[np.sort(sample_idx)]
+
+
+def get_shadow_comparison(data_pd, fit_pd, datatype, group_cols, fraction=0.01, max_groups=20, rng=None):
+    """ Re-fit a random sample of the groups in fit_pd with the reference fit (the lmfit fit of the model with the
+    heuristic initial values), and get the fitted and reference values of each parameter for the sampled groups """
+    if rng is None:
+        rng = np.random.default_rng()
+    sampled_groups_pd = sample_fitted_groups(fit_pd, group_cols, fraction, max_groups, rng)
+    if len(sampled_groups_pd) == 0:
+        return pd.DataFrame()
+    sampled_data_pd = pd.merge(data_pd, sampled_groups_pd, on=group_cols, how="inner")
+    reference_fit_pd = get_measurement_estimates_for_data_by_group(sampled_data_pd, datatype, group_cols=group_cols)
+
+    quant_cols = get_all_quantitative_variables(datatype)
+    comparison_pd = pd.merge(fit_pd.drop_duplicates(subset=group_cols)[group_cols + quant_cols],
+                             reference_fit_pd.drop_duplicates(subset=group_cols)[group_cols + quant_cols],
+                             on=group_cols,
+                             how="inner",
+                             suffixes=("", "_reference"))
+    return comparison_pd
+
+
+def summarize_shadow_comparison(comparison_pd, datatype, tolerance=0.01, fit_time=None, shadow_time=None,
+                                time_budget=None, budget_limited=False):
+    """ Get the deviation statistics of the fitted values from the reference values for each parameter: bias, mean and
+    max absolute error, max relative error and the fraction of groups with a relative error above tolerance. The
+    overhead is the shadow fit time as a fraction of the fit time, and budget_limited whether the time budget limited
+    the sampled groups """
+    summary = {"num_voxels": len(comparison_pd), "tolerance": tolerance, "wall_time": shadow_time,
+               "fit_wall_time": fit_time, "time_budget": time_budget,
+               "overhead": shadow_time / fit_time if (shadow_time is not None) and bool(fit_time) else None,
+               "budget_limited": budget_limited}
+    for quant_col in get_all_quantitative_variables(datatype):
+        if len(comparison_pd) == 0:
+            summary[quant_col] = {}
+            continue
+        values = comparison_pd[quant_col].to_numpy(dtype=float)
+        reference_values = comparison_pd[quant_col + "_reference"].to_numpy(dtype=float)
+        error = values - reference_values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative_error = np.abs(error) / np.abs(reference_values)
+        summary[quant_col] = {
+            "bias": float(np.nanmean(error)),
+            "mean_abs_error": float(np.nanmean(np.abs(error))),
+            "max_abs_error": float(np.nanmax(np.abs(error))),
+            "max_rel_error": float(np.nanmax(relative_error)),
+            "fraction_outside_tolerance": float(np.mean(~(relative_error <= tolerance))),
+        }
+    return summary
+
+
+def print_shadow_summary(summary):
+    print(f"Shadow fit of {summary['num_voxels']} sampled voxels against the reference fit:")
+    for quant_col, stats in summary.items():
+        if (not isinstance(stats, dict)) or (len(stats) == 0):
+            continue
+        print(f"\t{quant_col}: bias {stats['bias']:.4g}, max abs error {stats['max_abs_error']:.4g}, "
+              f"max rel error {stats['max_rel_error']:.4g}, "
+              f"{100 * stats['fraction_outside_tolerance']:.1f} % outside tolerance of {summary['tolerance']}")
+    if summary["overhead"] is not None:
+        budget = "" if summary["time_budget"] is None else f", budget {100 * summary['time_budget']:.1f} %"
+        print(f"\tShadow fit overhead: {summary['wall_time']:.2f} s ({100 * summary['overhead']:.1f} % of the fit "
+              f"time{budget})")
+    if summary["budget_limited"] and (summary["num_voxels"] < min_shadow_voxels):
+        print(f"Warning: the shadow fit time budget only held {summary['num_voxels']} voxels, which is too few for "
+              f"meaningful error statistics. Increase --shadow-time-budget to validate the fit on more voxels")
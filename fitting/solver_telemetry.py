@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+from fitting.constants import get_all_quantitative_variables
+
+# Columns of the solver telemetry of each group that the fit engines add when recording telemetry, besides nfev:
+# the wall time of the fit of the group, whether the solver converged, and why the solver stopped
+telemetry_cols = ["fit_time", "success", "fit_status"]
+
+# Reasons the batched solver stops (see fit_batched) that count as a converged fit
+batched_converged_statuses = ["ftol", "xtol", "zero_cost"]
+
+# Number of the slowest voxels to report, with their signal curves and initial values
+default_slowest_voxels = 10
+
+
+def add_batched_telemetry(fit_pd, status, wall_time):
+    """ Add the solver telemetry of the batched fits by group. The groups are fit together, so the wall time is split
+    between them by their solver evaluations """
+    nfev = fit_pd["nfev"].to_numpy(dtype=float)
+    fit_pd["fit_time"] = wall_time * nfev / np.sum(nfev) if np.sum(nfev) > 0 else 0.
+    fit_pd["success"] = np.isin(status, batched_converged_statuses)
+    fit_pd["fit_status"] = status
+    return fit_pd
+
+
+def split_solver_telemetry(fit_pd, datatype, group_cols):
+    """ Split the solver telemetry (with the solver evaluations and initial values) of each group off the fits, so
+    the saved fits keep their usual columns. Returns the fits and the telemetry, with one row per group, or None if
+    the fits have no telemetry (e.g. for models that are not iterative) """
+    if not all([c in fit_pd.columns for c in telemetry_cols]):
+        return fit_pd, None
+    init_cols = [c for c in ["init_" + q for q in get_all_quantitative_variables(datatype)] if c in fit_pd.columns]
+    telemetry_pd = fit_pd.drop_duplicates(subset=group_cols)[group_cols + ["nfev"] + telemetry_cols + init_cols]
+    return fit_pd.drop(columns=telemetry_cols), telemetry_pd.reset_index(drop=True)
+
+
+def get_slowest_voxels(fit_pd, telemetry_pd, datatype, independent_cols, group_cols, n_voxels=default_slowest_voxels):
+    """ Get the n_voxels groups of the fits with the longest fit time (and most solver evaluations), with their
+    telemetry, initial and fitted values and signal curve (the data and independent variables of each acquisition,
+    ordered by the first independent variable) """
+    if (telemetry_pd is None) or (len(telemetry_pd) == 0) or (n_voxels <= 0):
+        return []
+    slowest_pd = telemetry_pd.sort_values(["fit_time", "nfev"], ascending=False, kind="stable").head(n_voxels)
+    quant_cols = [c for c in get_all_quantitative_variables(datatype) if c in fit_pd.columns]
+    independent_cols = [c for c in independent_cols if c in fit_pd.columns]
+    rows_pd = pd.merge(slowest_pd[group_cols], fit_pd[group_cols + quant_cols + independent_cols + ["data"]],
+                       on=group_cols, how="inner")
+    slowest_voxels = []
+    for voxel in slowest_pd.to_dict("records"):
+        voxel_rows_pd = rows_pd
+        for c in group_cols:
+            voxel_rows_pd = voxel_rows_pd[voxel_rows_pd[c] == voxel[c]]
+        voxel_rows_pd = voxel_rows_pd.sort_values(independent_cols[:1], kind="stable")
+        voxel.update({c: voxel_rows_pd[c].values[0] for c in quant_cols if len(voxel_rows_pd) > 0})
+        voxel["signal"] = {c: voxel_rows_pd[c].tolist() for c in independent_cols + ["data"]}
+        slowest_voxels.append(voxel)
+    return slowest_voxels
+
+
+def get_histogram(values, n_bins=10, log=False):
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values) & ((values > 0) if log else True)]
+    if len(values) == 0:
+        return {"counts": [], "bin_edges": []}
+    if log and (np.min(values) < np.max(values)):
+        bins = np.geomspace(np.min(values), np.max(values), n_bins + 1)
+    else:
+        bins = n_bins
+    counts, bin_edges = np.histogram(values, bins=bins)
+    return {"counts": counts.tolist(), "bin_edges": bin_edges.tolist()}
+
+
+def summarize_solver_telemetry(telemetry_pd, slowest_voxels, n_slowest_voxels=default_slowest_voxels, n_bins=10):
+    """ Summarize the solver telemetry of all voxels: the number of failed fits and the reasons the solver stopped,
+    histograms of the solver evaluations and fit times, the fit time and evaluations of each slice, the fraction of
+    the fit time spent on the slowest tenth of the voxels, and the slowest voxels of all slices (see
+    get_slowest_voxels) """
+    if (telemetry_pd is None) or (len(telemetry_pd) == 0):
+        return {"num_voxels": 0}
+    fit_time = telemetry_pd["fit_time"].to_numpy(dtype=float)
+    sorted_fit_time = np.sort(fit_time)[::-1]
+    n_slowest_tenth = int(np.ceil(len(sorted_fit_time) / 10))
+    slices_pd = telemetry_pd.assign(failed=~telemetry_pd["success"].astype(bool)).groupby("slc").agg(
+        num_voxels=("nfev", "size"), nfev=("nfev", "sum"), fit_time=("fit_time", "sum"),
+        max_fit_time=("fit_time", "max"), num_failed=("failed", "sum"))
+    slowest_voxels = sorted(slowest_voxels, key=lambda v: (v["fit_time"], v["nfev"]), reverse=True)
+    return {"num_voxels": len(telemetry_pd),
+            "num_failed": int(np.sum(~telemetry_pd["success"].astype(bool))),
+            "nfev": int(telemetry_pd["nfev"].sum()),
+            "fit_time": float(np.sum(fit_time)),
+            "slowest_tenth_time_fraction": float(np.sum(sorted_fit_time[:n_slowest_tenth]) / np.sum(fit_time))
+            if np.sum(fit_time) > 0 else np.nan,
+            "statuses": {str(k): int(v) for k, v in telemetry_pd["fit_status"].value_counts().items()},
+            "nfev_histogram": get_histogram(telemetry_pd["nfev"], n_bins=n_bins),
+            "fit_time_histogram": get_histogram(fit_time, n_bins=n_bins, log=True),
+            "slices": {str(slc): {k: v.item() if hasattr(v, "item") else v for k, v in row.items()}
+                       for slc, row in slices_pd.to_dict("index").items()},
+            "slowest_voxels": slowest_voxels[:n_slowest_voxels]}
+
+
+def print_solver_telemetry(summary, group_cols=("slc", "x", "y")):
+    """ Print the solver telemetry of all voxels and the slowest voxels """
+    if summary["num_voxels"] == 0:
+        print("No solver telemetry was recorded, since no voxels were fit with an iterative solver")
+        return
+    print(f"\nSolver telemetry of {summary['num_voxels']} voxels: {summary['nfev']} solver evaluations in "
+          f"{summary['fit_time']:.2f} s, {summary['num_failed']} fits did not converge, and "
+          f"{summary['slowest_tenth_time_fraction'] * 100:.0f}% of the fit time was spent on the slowest 10% of the "
+          f"voxels")
+    print("Solver stopped because:")
+    for status, count in summary["statuses"].items():
+        print(f"\t{count} voxels: {status}")
+    print("By slice:")
+    for slc, slice_summary in summary["slices"].items():
+        print(f"\tslc {slc}: {slice_summary['num_voxels']} voxels, {slice_summary['nfev']} solver evaluations in "
+              f"{slice_summary['fit_time']:.2f} s (slowest voxel {slice_summary['max_fit_time'] * 1000:.1f} ms), "
+              f"{slice_summary['num_failed']} did not converge")
+    print("Slowest voxels:")
+    for voxel in summary["slowest_voxels"]:
+        location = ", ".join([f"{c} {voxel[c]}" for c in group_cols])
+        init_values = ", ".join([f"{c} {voxel[c]:.4g}" for c in voxel if c.startswith("init_")])
+        print(f"\t{location}: {voxel['nfev']} solver evaluations in {voxel['fit_time'] * 1000:.1f} ms "
+              f"({voxel['fit_status']}), from {init_values}")
@@ -0,0 +1,108 @@
+import itertools
+import numpy as np
+from fitting.overall_fitting import get_limited_value_column
+
+
+def get_values_str(values_to_use):
+    """ Get the suffix of the output directory of a fit limited to the values to use, e.g. _100.0_800.0 """
+    if values_to_use is None:
+        return ""
+    return f"_{'_'.join([str(m) for m in values_to_use])}"
+
+
+def parse_values_subsets(subsets):
+    """ Parse subsets of values given as comma-separated strings (e.g. "100,800") """
+    try:
+        return [[float(v) for v in subset.split(",") if len(v.strip()) > 0] for subset in subsets]
+    except ValueError:
+        raise Exception(f"Subsets of values must be comma-separated numbers (e.g. 100,800), got: {subsets}")
+
+
+def get_sweep_subsets(data_pd_dict, datatype, subsets=None, k=None, values_to_use=None):
+    """ Get the subsets of values to fit: the given subsets, and all combinations of k of the values to use (or of
+    all values of the data, if not given) """
+    all_subsets = [list(subset) for subset in subsets] if subsets is not None else []
+    if k is not None:
+        if values_to_use is None:
+            value_column_name = get_limited_value_column(datatype)
+            values_to_use = np.unique(np.concatenate([data_pd[value_column_name].unique()
+                                                      for data_pd in data_pd_dict.values()]))
+        values_to_use = sorted([float(v) for v in values_to_use])
+        if (k < 1) or (k > len(values_to_use)):
+            raise Exception(f"Cannot choose {k} of the {len(values_to_use)} values: {values_to_use}")
+        all_subsets.extend([list(subset) for subset in itertools.combinations(values_to_use, k)])
+    if len(all_subsets) == 0:
+        raise Exception("No subsets of values to sweep over")
+    # Keep the first of any repeated subsets, since they would be saved to the same directory
+    unique_subsets = {}
+    for subset in all_subsets:
+        unique_subsets.setdefault(get_values_str(subset), subset)
+    return list(unique_subsets.values())
+
+
+class SliceValueTable:
+    """ Per-voxel summary of the data of one slice for each value (e.g. inversion time): the max of the data and
+    whether any data is exactly zero. It is computed once, and gives the voxels that mask_slice would keep for the
+    data limited to any subset of the values, without masking the data again for each subset """
+    def __init__(self, data_pd, datatype, voxel_cols=("x", "y")):
+        self.value_column_name = get_limited_value_column(datatype)
+        voxel_cols = list(voxel_cols)
+        grouped_pd = data_pd.groupby(voxel_cols, sort=True)
+        self.row_voxel = grouped_pd.ngroup().to_numpy()
+        self.row_value = data_pd[self.value_column_name].to_numpy(dtype=float)
+        data = data_pd["data"].to_numpy(dtype=float)
+        self.values = np.unique(self.row_value)
+        value_idx = np.searchsorted(self.values, self.row_value)
+        n_voxels = int(self.row_voxel.max()) + 1 if len(data_pd) > 0 else 0
+        self.voxel_max = np.full((n_voxels, len(self.values)), np.nan)
+        finite = np.isfinite(data)
+        np.fmax.at(self.voxel_max, (self.row_voxel[finite], value_idx[finite]), data[finite])
+        self.voxel_has_zero = np.zeros((n_voxels, len(self.values)), dtype=bool)
+        self.voxel_has_zero[self.row_voxel[data == 0], value_idx[data == 0]] = True
+
+    def get_value_idx(self, values_to_use):
+        value_idx = np.searchsorted(self.values, values_to_use)
+        found = (value_idx < len(self.values)) & (self.values[np.minimum(value_idx, len(self.values) - 1)] ==
+                                                 np.asarray(values_to_use, dtype=float))
+        if not np.all(found):
+            raise Exception(f"Values are missing for {self.value_column_name}.\n\tExpected to find: "
+                            f"{' '.join([str(m) for m in values_to_use])}\n\tActually found: "
+                            f"{' '.join([str(m) for m in self.values])}")
+        return value_idx
+
+    def get_max_value(self, values_to_use):
+        """ Get the max of the data limited to the values """
+        with np.errstate(all="ignore"):
+            voxel_max = self.voxel_max[:, self.get_value_idx(values_to_use)]
+        return np.nanmax(voxel_max) if np.any(np.isfinite(voxel_max)) else np.nan
+
+    def get_row_mask(self, values_to_use, max_val, voxel_threshold):
+        """ Get the rows of the data that are kept when limiting it to the values, and masking it as mask_slice does
+        with the max value of all slices, and whether the slice was masked (it is not if its max value is too low) """
+        value_idx = self.get_value_idx(values_to_use)
+        rows = np.isin(self.row_value, values_to_use)
+        slc_max_val = self.get_max_value(values_to_use)
+        if not (slc_max_val > (np.min([0.1, voxel_threshold]) * max_val)):
+            return rows, False
+        # Remove the voxels with any data that is exactly zero, and keep the voxels with any data above the threshold
+        keep_voxels = ~np.any(self.voxel_has_zero[:, value_idx], axis=1)
+        with np.errstate(invalid="ignore"):
+            keep_voxels &= np.any(self.voxel_max[:, value_idx] > slc_max_val * voxel_threshold, axis=1)
+        return rows & keep_voxels[self.row_voxel], True
+
+
+def get_subset_max_values(value_tables, subsets):
+    """ Get the max value over all slices of the data limited to each subset """
+    return [np.nanmax([value_table.get_max_value(subset) for value_table in value_tables.values()])
+            for subset in subsets]
+
+
+def get_masked_subset_data(data_pd, value_table, subset, max_val, voxel_threshold, group_cols=("slc", "x", "y")):
+    """ Get the data of a slice limited to a subset of the values and masked, with the rows in the order that
+    get_limited_values and mask_slice keep them in """
+    row_mask, masked = value_table.get_row_mask(subset, max_val, voxel_threshold)
+    data_pd = data_pd[row_mask]
+    if masked:
+        # Masking keeps the rows of each voxel in order, with the voxels sorted
+        data_pd = data_pd.sort_values(list(group_cols), kind="stable")
+    return data_pd.reset_index(drop=True)
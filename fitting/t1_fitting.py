@@ -1,6 +1,7 @@
 import numpy as np
 import lmfit
 from scipy.optimize import minimize
+from fitting.fitting_utils import set_initial_values
 
 
 def model_T1_init_1(T1, delta_init, TI_init):
@@ -78,7 +79,7 @@ def objFunction2(params, TI, data, TR):
     return model - data
 
 
-def estimate_T1(filtered_pd, ti_col="inv_time", data_col="mean", tr_col=None):
+def estimate_T1(filtered_pd, ti_col="inv_time", data_col="mean", tr_col=None, init_values=None):
     TR = None
     if tr_col is not None:
         TR = np.unique(filtered_pd[tr_col])[0]
@@ -87,6 +88,7 @@ def estimate_T1(filtered_pd, ti_col="inv_time", data_col="mean", tr_col=None):
     mean_data = np.array(mean_pd[data_col])
     mean_TI = np.array(mean_pd[ti_col])
     params = init(TI=mean_TI, data=mean_data, TR=TR)
+    params = set_initial_values(params, init_values)
 
     TI = np.array(filtered_pd[ti_col])
     data = np.array(filtered_pd[data_col])
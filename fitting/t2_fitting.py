@@ -1,5 +1,6 @@
 import numpy as np
 import lmfit
+from fitting.fitting_utils import set_initial_values
 
 
 def init_T2(TE=None, data=None):
@@ -33,11 +34,12 @@ def objFunction_T2(params, TE, data):
     return (model - data)
 
 
-def estimate_T2(filtered_pd, te_col="ech_time", data_col="mean"):
+def estimate_T2(filtered_pd, te_col="ech_time", data_col="mean", init_values=None):
     mean_pd = filtered_pd.groupby(te_col).agg({data_col: np.mean, te_col: np.mean})
     mean_data = np.array(mean_pd[data_col])
     mean_TE = np.array(mean_pd[te_col])
     params = init_T2(mean_TE, mean_data)
+    params = set_initial_values(params, init_values)
 
     TE = np.array(filtered_pd[te_col])
     data = np.array(filtered_pd[data_col])
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+from fitting.constants import get_all_quantitative_variables
+from utils_io.parametric_maps import load_fit_pd_from_maps
+
+# Largest in-plane shift (in voxels) of the phantom between sessions that the alignment searches over
+default_max_shift = 4
+
+
+def load_prior_fits(filenames, datatype):
+    """ Load the fits of a previous session (fit_pd*.csv, e.g. of each slice, or fit_maps*.npz), with one row per
+    voxel. Only the voxels with finite fitted values and valid fits (by all valid_fit_by_* columns) are kept """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    prior_pds = [load_fit_pd_from_maps(f) if f.endswith(".npz") else pd.read_csv(f) for f in filenames]
+    prior_pd = pd.concat(prior_pds, ignore_index=True).drop_duplicates(subset=["slc", "x", "y"])
+    quant_cols = [c for c in get_all_quantitative_variables(datatype) if c in prior_pd.columns]
+    if len(quant_cols) == 0:
+        raise Exception(f"The prior fits have none of the fitted values of {datatype}: "
+                        f"{get_all_quantitative_variables(datatype)}")
+    valid = np.ones(len(prior_pd), dtype=bool)
+    for c in quant_cols:
+        valid &= np.isfinite(pd.to_numeric(prior_pd[c]).to_numpy(dtype=float))
+    for c in [c for c in prior_pd.columns if c.startswith("valid_fit_by_")]:
+        valid &= prior_pd[c].to_numpy(dtype=bool)
+    prior_pd = prior_pd[valid].reset_index(drop=True)
+    prior_pd[["slc", "x", "y"]] = prior_pd[["slc", "x", "y"]].astype(int)
+    return prior_pd
+
+
+def get_slice_image(voxels_pd, value_col, nx, ny):
+    """ Get an (nx, ny) image of the values of the voxels of a slice, which is zero where there is no value """
+    image = np.zeros((nx, ny))
+    values = pd.to_numeric(voxels_pd[value_col]).to_numpy(dtype=float)
+    image[voxels_pd["x"].to_numpy(dtype=int), voxels_pd["y"].to_numpy(dtype=int)] = \
+        np.where(np.isfinite(values), values, 0.)
+    return image
+
+
+def estimate_shift(image, reference, max_shift=default_max_shift):
+    """ Get the integer in-plane shift (dx, dy) of the image from the reference, of at most max_shift voxels, that
+    maximizes their cross-correlation (computed for all shifts at once with FFTs) """
+    image = image - np.mean(image)
+    reference = reference - np.mean(reference)
+    correlation = np.real(np.fft.ifft2(np.fft.fft2(image) * np.conj(np.fft.fft2(reference))))
+    shifts = np.arange(-max_shift, max_shift + 1)
+    dx, dy = np.meshgrid(shifts, shifts, indexing="ij")
+    best = np.argmax(correlation[dx % image.shape[0], dy % image.shape[1]])
+    return int(dx.ravel()[best]), int(dy.ravel()[best])
+
+
+def match_prior_slice(prior_pd, slc, slc_location=None):
+    """ Get the slice of the prior fits at the closest slice location (or with the same index, if the locations are
+    not known) """
+    prior_slices = prior_pd.drop_duplicates(subset="slc")
+    if (slc_location is not None) and ("slc_location" in prior_slices.columns):
+        distance = np.abs(prior_slices["slc_location"].to_numpy(dtype=float) - slc_location)
+        if np.any(np.isfinite(distance)):
+            return int(prior_slices["slc"].values[np.nanargmin(distance)])
+    return slc if slc in prior_slices["slc"].values else None
+
+
+def get_warm_start_init_pd(data_pd, prior_pd, datatype, max_shift=default_max_shift):
+    """ Get the initial values of the voxels of a slice from the prior fits: the prior slice at the closest location
+    is aligned to the data by the in-plane shift that best matches its Si map (or fitted map) to the max of the data of
+    each voxel, and the fitted values of each prior voxel are used for the voxel it is shifted to. Returns the initial
+    values by voxel (without the voxels that have no prior values, which keep the heuristic initial values) and the
+    matched prior slice and shift """
+    slc = int(data_pd["slc"].values[0])
+    slc_location = float(data_pd["slc_location"].values[0]) if "slc_location" in data_pd.columns else None
+    prior_slc = match_prior_slice(prior_pd, slc, slc_location)
+    quant_cols = [c for c in get_all_quantitative_variables(datatype) if c in prior_pd.columns]
+    if prior_slc is None:
+        return pd.DataFrame(columns=["slc", "x", "y"] + quant_cols), {"prior_slc": None, "shift": None}
+    prior_slice_pd = prior_pd[prior_pd["slc"] == prior_slc]
+    nx = int(data_pd["nx"].values[0]) if "nx" in data_pd.columns else int(data_pd["x"].max()) + 1
+    ny = int(data_pd["ny"].values[0]) if "ny" in data_pd.columns else int(data_pd["y"].max()) + 1
+    if "nx" in prior_slice_pd.columns:
+        prior_size = (int(prior_slice_pd["nx"].values[0]), int(prior_slice_pd["ny"].values[0]))
+        if prior_size != (nx, ny):
+            raise Exception(f"The prior fits of size {prior_size[0]} x {prior_size[1]} do not match the data of size "
+                            f"{nx} x {ny}")
+
+    # Align the prior slice to the data
+    voxel_max_pd = data_pd.groupby(["x", "y"], as_index=False)["data"].max()
+    align_col = "Si" if "Si" in quant_cols else quant_cols[0]
+    dx, dy = estimate_shift(get_slice_image(voxel_max_pd, "data", nx, ny),
+                            get_slice_image(prior_slice_pd, align_col, nx, ny), max_shift=max_shift)
+
+    init_pd = prior_slice_pd[["x", "y"] + quant_cols].copy()
+    init_pd["x"] += dx
+    init_pd["y"] += dy
+    init_pd = init_pd[(init_pd["x"] >= 0) & (init_pd["x"] < nx) & (init_pd["y"] >= 0) & (init_pd["y"] < ny)]
+    init_pd.insert(0, "slc", slc)
+    init_pd = pd.merge(init_pd, data_pd[["slc", "x", "y"]].drop_duplicates(), on=["slc", "x", "y"], how="inner")
+    return init_pd, {"prior_slc": prior_slc, "shift": [dx, dy]}
@@ -0,0 +1,115 @@
+import os
+import argparse
+import sys
+import numpy as np
+from utils_io.MRIData import turn_mri_data_into_dfs_by_slice
+from utils_io.synthetic_phantom import get_phantom_labels, get_synthetic_mri_data, write_synthetic_scans, \
+    save_ground_truth
+
+default_values = {
+    "t1": [50., 100., 200., 400., 800., 1600., 3200.],
+    "t2": [10., 20., 40., 80., 160., 320.],
+    "t2_epg": list(np.arange(1, 33) * 10.),
+    "adc": [0., 500., 1000., 1500.],
+}
+
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Generate a synthetic multi-slice phantom dataset with known '
+                                                 'ground truth T1, T2 and ADC values.')
+    parser.add_argument('--dataset',
+                        dest='dataset', type=str, action='store', required=True,
+                        help='Dataset name - data will be saved with this name')
+    parser.add_argument('--datatype',
+                        dest='datatype', type=str, action='store', required=True,
+                        choices=["t1", "t2", "t2_epg", "adc"],
+                        help='Type of data to generate: inversion recovery (t1), multi-echo (t2) data, a CPMG echo '
+                             'train with stimulated echoes from a non-uniform B1 (t2_epg), or diffusion weighted '
+                             'data along three orthogonal directions, with anisotropic white matter (adc)')
+    parser.add_argument('--datatype-values',
+                        dest='values', type=float, nargs="+", action='store',
+                        help='(Optional) Inversion times (t1) or echo times (t2, t2_epg) to generate data for, in ms, '
+                             'or b-values (adc) in s/mm^2. For t2_epg, echo times must be multiples of the first echo '
+                             'time (the echo spacing). The defaults are 50 100 200 400 800 1600 3200 (t1), 10 20 40 '
+                             '80 160 320 (t2), 10 20 ... 320 (t2_epg) and 0 500 1000 1500 (adc)')
+    parser.add_argument('--matrix-size',
+                        dest='matrix_size', type=int, default=64, action='store',
+                        help='(Optional) In-plane matrix size. The default value is 64')
+    parser.add_argument('--slices',
+                        dest='n_slices', type=int, default=4, action='store',
+                        help='(Optional) Number of slices. The default value is 4')
+    parser.add_argument('--tr',
+                        dest='tr', type=float, default=5000., action='store',
+                        help='(Optional) Repetition time in ms. The default value is 5000')
+    parser.add_argument('--noise-sigma',
+                        dest='noise_sigma', type=float, default=10., action='store',
+                        help='(Optional) Standard deviation of the complex Gaussian noise (the data has Rician noise), '
+                             'for a proton density signal of 1000. The default value is 10')
+    parser.add_argument('--seed',
+                        dest='seed', type=int, default=0, action='store',
+                        help='(Optional) Random seed for the noise. The default value is 0')
+    parser.add_argument('--formats',
+                        dest='formats', type=str, nargs="+", default=["dicom", "csv"], action='store',
+                        choices=["dicom", "fdf", "csv"],
+                        help='(Optional) Formats to write the data in. The defaults are dicom and csv')
+    parser.add_argument('--output-dir',
+                        dest='output_dir', action='store', required=True,
+                        help='Directory to output data to. Scans are written to '
+                             '<output-dir>/scans/<dataset>/<format>/<datatype>_<value>/, csv data to '
+                             '<output-dir>/preformat_data/<datatype>/<dataset>/raw_{slc}.csv, and ground truth '
+                             'maps to <output-dir>/ground_truth/<datatype>/<dataset>/ground_truth.npz')
+    return parser.parse_args(args)
+
+
+def generate_synthetic_data(dataset, datatype, output_dir, values=None, matrix_size=64, n_slices=4, tr=5000.,
+                            noise_sigma=10., seed=0, formats=("dicom", "csv")):
+    """ Generate and write a synthetic dataset. Returns the scan sub-directories and the number of bytes written
+    for each format """
+    if values is None:
+        values = default_values[datatype]
+    labels = get_phantom_labels(matrix_size, n_slices)
+    mri_data_objs = get_synthetic_mri_data(datatype, labels, values, tr=tr, noise_sigma=noise_sigma, seed=seed)
+
+    ground_truth_dir = os.path.join(output_dir, "ground_truth", datatype, dataset)
+    os.makedirs(ground_truth_dir, exist_ok=True)
+    save_ground_truth(labels, os.path.join(ground_truth_dir, "ground_truth.npz"))
+
+    load_subdirs = []
+    bytes_written = {}
+    for file_format in formats:
+        if file_format == "csv":
+            save_directory = os.path.join(output_dir, "preformat_data", datatype, dataset)
+            os.makedirs(save_directory, exist_ok=True)
+            print("Saving csv data to:", save_directory)
+            bytes_written[file_format] = 0
+            for slc_location, mri_df in turn_mri_data_into_dfs_by_slice(mri_data_objs).items():
+                save_filename = os.path.join(save_directory, f"raw_{mri_df['slc'].values[0]}.csv")
+                with open(save_filename, "w") as f:
+                    mri_df.to_csv(f, index=False)
+                bytes_written[file_format] += os.path.getsize(save_filename)
+        else:
+            load_dir = os.path.join(output_dir, "scans", dataset, file_format)
+            print(f"Saving {file_format} scans to:", load_dir)
+            load_subdirs, bytes_written[file_format] = write_synthetic_scans(mri_data_objs, datatype, load_dir,
+                                                                             file_format=file_format)
+    return load_subdirs, bytes_written
+
+
+def main(args):
+    print(f"\n----------------start {args.dataset}-----------------")
+    load_subdirs, bytes_written = generate_synthetic_data(args.dataset, args.datatype, args.output_dir,
+                                                          values=args.values, matrix_size=args.matrix_size,
+                                                          n_slices=args.n_slices, tr=args.tr,
+                                                          noise_sigma=args.noise_sigma, seed=args.seed,
+                                                          formats=args.formats)
+    for file_format, n_bytes in bytes_written.items():
+        print(f"Wrote {np.round(n_bytes / 1e6, 2)} MB of {file_format} data")
+    if len(load_subdirs) > 0:
+        print("Scan sub-directories (for --load-subdirs):", " ".join(load_subdirs))
+    print(f"----------------end {args.dataset}-----------------")
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import argparse
+import traceback
+import importlib
+from contextlib import redirect_stdout, redirect_stderr
+from fitting.epg_fitting import set_epg_cache_dir
+from utils_io.job_queue import make_queue_dirs, submit_job, claim_next_job, finish_job, wait_for_job
+
+# Pipeline scripts that can be run by the worker, each with parse_args(args) and main(args)
+worker_scripts = ["preformat_data", "save_data", "process_saved_data", "generate_synthetic_data"]
+
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Run pipeline scripts in a persistent worker, which keeps the '
+                                                 'interpreter and libraries loaded between jobs, or submit jobs '
+                                                 'to it.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Run jobs from the queue directory')
+    serve_parser.add_argument('--queue-dir',
+                              dest='queue_dir', action='store', required=True,
+                              help='Directory of the job queue. Jobs are read from <queue-dir>/pending/, and results '
+                                   'are written to <queue-dir>/done/ or <queue-dir>/failed/, with the output of each '
+                                   'job in <queue-dir>/logs/')
+    serve_parser.add_argument('--poll-interval',
+                              dest='poll_interval', type=float, default=0.5, action='store',
+                              help='(Optional) Time in seconds between checks for new jobs. The default value is 0.5')
+    serve_parser.add_argument('--idle-timeout',
+                              dest='idle_timeout', type=float, action='store',
+                              help='(Optional) Stop the worker after this many seconds without jobs. By default, '
+                                   'the worker runs until it is stopped')
+    serve_parser.add_argument('--with-images',
+                              dest='with_images', default=False, action='store_true',
+                              help='(Optional) Also pre-load the plotting libraries, for jobs that store images')
+    submit_parser = subparsers.add_parser('submit', help='Submit a job to the queue directory')
+    submit_parser.add_argument('--queue-dir',
+                               dest='queue_dir', action='store', required=True,
+                               help='Directory of the job queue')
+    submit_parser.add_argument('--wait',
+                               dest='wait', default=False, action='store_true',
+                               help='(Optional) Wait for the job to finish, print its output and exit with its status')
+    submit_parser.add_argument('script',
+                               type=str, choices=worker_scripts,
+                               help='Pipeline script to run')
+    submit_parser.add_argument('script_args',
+                               nargs=argparse.REMAINDER,
+                               help='Command line arguments of the pipeline script')
+    return parser.parse_args(args)
+
+
+def load_scripts(with_images=False):
+    """ Import the pipeline scripts (and their libraries) once, for all jobs """
+    modules = {script: importlib.import_module(script) for script in worker_scripts}
+    if with_images:
+        importlib.import_module("plotter.fits")
+        importlib.import_module("matplotlib.figure")
+        importlib.import_module("matplotlib.backends.backend_agg")
+    return modules
+
+
+def reset_job_state():
+    """ Reset the settings that the pipeline scripts keep in their modules, so they do not leak from one job into the
+    next. Caches that are keyed by their contents (e.g. EPG dictionaries, by protocol and grid) are kept """
+    set_epg_cache_dir(None)
+
+
+def run_job(job, modules, log_filename):
+    """ Run a job with the already imported pipeline script, logging its output. Returns whether it succeeded """
+    module = modules[job["script"]]
+    start_time = time.perf_counter()
+    succeeded = False
+    worker_dir = os.getcwd()
+    with open(log_filename, "w") as log_file:
+        with redirect_stdout(log_file), redirect_stderr(log_file):
+            try:
+                # Relative paths in the arguments are relative to where the job was submitted from
+                os.chdir(job.get("cwd", worker_dir))
+                reset_job_state()
+                module.main(module.parse_args(job["args"]))
+                succeeded = True
+            except SystemExit as e:
+                # argparse exits on invalid arguments
+                succeeded = e.code in [None, 0]
+                if not succeeded:
+                    job["error"] = f"Exited with code {e.code}"
+            except Exception as e:
+                traceback.print_exc()
+                job["error"] = repr(e)
+            finally:
+                os.chdir(worker_dir)
+    job["wall_time"] = time.perf_counter() - start_time
+    job["log"] = log_filename
+    return succeeded
+
+
+def serve(queue_dir, poll_interval=0.5, idle_timeout=None, with_images=False):
+    make_queue_dirs(queue_dir)
+    start_time = time.perf_counter()
+    modules = load_scripts(with_images=with_images)
+    print(f"Worker loaded the pipeline scripts in {time.perf_counter() - start_time:.2f} s, waiting for jobs in",
+          queue_dir)
+    last_job_time = time.time()
+    n_jobs = 0
+    while True:
+        job = claim_next_job(queue_dir)
+        if job is None:
+            if (idle_timeout is not None) and (time.time() - last_job_time > idle_timeout):
+                break
+            time.sleep(poll_interval)
+            continue
+        print(f"Running job {job['id']}: {job['script']} {' '.join(job['args'])}")
+        job["started"] = time.time()
+        succeeded = run_job(job, modules, os.path.abspath(os.path.join(queue_dir, "logs", f"{job['id']}.log")))
+        finish_job(queue_dir, job, succeeded)
+        print(f"\t{'Finished' if succeeded else 'Failed'} job {job['id']} in {job['wall_time']:.2f} s")
+        last_job_time = time.time()
+        n_jobs += 1
+    print(f"\nWorker stopped after {n_jobs} job(s)")
+
+
+def main(args):
+    if args.command == "serve":
+        serve(args.queue_dir, poll_interval=args.poll_interval, idle_timeout=args.idle_timeout,
+              with_images=args.with_images)
+    elif args.command == "submit":
+        job_id = submit_job(args.queue_dir, args.script, args.script_args)
+        print("Submitted job", job_id)
+        if args.wait:
+            job = wait_for_job(args.queue_dir, job_id, poll_interval=0.1)
+            with open(job["log"], "r") as f:
+                print(f.read())
+            if "error" in job:
+                print("Job failed:", job["error"])
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)
@@ -1,11 +1,11 @@
-from plotter.utils import colorbar
-import matplotlib.pyplot as plt
+from plotter.render import build_image, get_image_job, render_images
 import numpy as np
 import os
 
 
-def plot_data_by_scan_params(data_df, save_dir):
+def plot_data_by_scan_params(data_df, save_dir, n_workers=1, image_style="figure"):
     vmax = np.max(data_df["data"])
+    jobs = []
     for group_name, plot_df in data_df.groupby(["te", "ti", "tr", "b_value", "slc"]):
         te = group_name[0]
         ti = group_name[1]
@@ -13,15 +13,7 @@ def plot_data_by_scan_params(data_df, save_dir):
         b_value = group_name[3]
         slc = group_name[4]
 
-        plot_im = np.zeros((plot_df["nx"].values[0], plot_df["ny"].values[0]))
-        plot_im[list(plot_df["x"]), list(plot_df["y"])] = list(plot_df["data"])
-
-        f, ax = plt.subplots(1, 1)
-        im = ax.imshow(plot_im, vmin=0, vmax=vmax, interpolation="none")
-        colorbar(im)
-        ax.set_title("Dicom data")
-
-        f.suptitle(f"Slice: {slc}")
-        plt.tight_layout()
-        plt.savefig(os.path.join(save_dir, f"slc_{slc}_te{te}_ti{ti}_tr{tr}_b{b_value}.png"), bbox_inches="tight")
-        plt.close()
+        plot_im = build_image(plot_df, "data")
+        jobs.append(get_image_job(plot_im, os.path.join(save_dir, f"slc_{slc}_te{te}_ti{ti}_tr{tr}_b{b_value}.png"),
+                                  vmin=0, vmax=vmax, title="Dicom data", suptitle=f"Slice: {slc}"))
+    render_images(jobs, n_workers=n_workers, style=image_style)
@@ -1,18 +1,19 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import os
-from fitting.t1_fitting import model_T1_2
-from fitting.t2_fitting import model_T2
-from fitting.overall_fitting import get_measurement_estimates_for_data_by_group
-import seaborn as sns
 from fitting.constants import get_all_quantitative_variables
-from plotter.utils import colorbar
-
-sns.set_palette("flare")
+from plotter.render import build_volume, get_mosaic, get_image_job, render_images
 
 
 def imshow_fits_by_slice(data_pd, datatype, save_parent_dir, plot_column="slc", filename_extension="",
-                         use_median=True):
+                         use_median=True, n_workers=1, image_style="figure", mosaic=False):
+    jobs = get_fit_image_jobs(data_pd, datatype, save_parent_dir, plot_column=plot_column,
+                              filename_extension=filename_extension, use_median=use_median, mosaic=mosaic)
+    render_images(jobs, n_workers=n_workers, style=image_style)
+
+
+def get_fit_image_jobs(data_pd, datatype, save_parent_dir, plot_column="slc", filename_extension="",
+                       use_median=True, mosaic=False):
+    """ Get the image jobs for each slice (and optionally a mosaic of all slices) of each fitted quantity """
     if use_median:
         plot_median = [True]
     else:
@@ -20,33 +21,36 @@ def imshow_fits_by_slice(data_pd, datatype, save_parent_dir, plot_column="slc",
 
     # Create the full image for the scan results
     quant_cols = get_all_quantitative_variables(datatype)
+    slices = np.unique(data_pd[plot_column])
 
+    jobs = []
     for quant_col in quant_cols:
         for quant_col in [quant_col, "stderr_"+quant_col, "init_"+quant_col]:
             if quant_col not in data_pd.columns:
                 continue
+            # Build each volume once, for all slices and color scales
+            full_im = build_volume(data_pd, quant_col)
+            quant_values = data_pd[quant_col].to_numpy(dtype=float)
             for plt_median in plot_median:
-                vmin = np.min([0, np.min(data_pd[quant_col])])
+                vmin = np.min([0, np.nanmin(quant_values)])
                 if plt_median:
-                    vmax = np.nanmedian(data_pd[quant_col]) * 6
+                    vmax = np.nanmedian(quant_values) * 6
                 else:
-                    vmax = np.nanmax(data_pd[quant_col])
-                data_shape = (data_pd["nx"].values[0], data_pd["ny"].values[0], data_pd["nslc"].values[0])
-                full_im = np.zeros(data_shape)
-                full_im[list(data_pd["x"]),
-                        list(data_pd["y"]),
-                        list(data_pd["slc"])] = list(data_pd[quant_col])
+                    vmax = np.nanmax(quant_values)
 
                 # Plot and save each slice of the full scan image
-                for slc in np.unique(data_pd[plot_column]):
-                    im = full_im[:, :, slc]
-                    f, ax = plt.subplots(1,1)
-                    ax_im = ax.imshow(im, vmin=vmin, vmax=vmax)
-                    colorbar(ax_im)
-                    ax.set_title(f"{datatype} data: {quant_col} results for slice {slc}")
+                for slc in slices:
                     filename = f"{quant_col}_slc{slc}{filename_extension}.png"
                     if plt_median:
                         filename = "median_"+filename
-                    plt.savefig(os.path.join(save_parent_dir, filename),
-                                bbox_inches="tight")
-                    plt.close()
+                    jobs.append(get_image_job(full_im[:, :, slc], os.path.join(save_parent_dir, filename),
+                                              vmin=vmin, vmax=vmax,
+                                              title=f"{datatype} data: {quant_col} results for slice {slc}"))
+                if mosaic:
+                    filename = f"{quant_col}_mosaic{filename_extension}.png"
+                    if plt_median:
+                        filename = "median_"+filename
+                    jobs.append(get_image_job(get_mosaic(full_im, slices), os.path.join(save_parent_dir, filename),
+                                              vmin=vmin, vmax=vmax,
+                                              title=f"{datatype} data: {quant_col} results for all slices"))
+    return jobs
@@ -0,0 +1,114 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Reused figure for each (worker) process, so that images only need new data, color limits and titles
+_reusable_figure = {}
+
+
+def build_volume(data_pd, value_col, fill_value=0.):
+    """ Build the (nx, ny, nslc) volume of value_col in a single vectorized scatter """
+    data_shape = (data_pd["nx"].values[0], data_pd["ny"].values[0], data_pd["nslc"].values[0])
+    volume = np.full(data_shape, fill_value, dtype=float)
+    volume[data_pd["x"].to_numpy(dtype=int),
+           data_pd["y"].to_numpy(dtype=int),
+           data_pd["slc"].to_numpy(dtype=int)] = data_pd[value_col].to_numpy(dtype=float)
+    return volume
+
+
+def build_image(data_pd, value_col, fill_value=0.):
+    """ Build the (nx, ny) image of value_col for data of a single slice """
+    image = np.full((data_pd["nx"].values[0], data_pd["ny"].values[0]), fill_value, dtype=float)
+    image[data_pd["x"].to_numpy(dtype=int), data_pd["y"].to_numpy(dtype=int)] = data_pd[value_col].to_numpy(dtype=float)
+    return image
+
+
+def get_mosaic(volume, slices, n_cols=None, fill_value=np.nan):
+    """ Tile the given slices of an (nx, ny, nslc) volume into one 2D image """
+    slices = list(slices)
+    nx, ny = volume.shape[:2]
+    if n_cols is None:
+        n_cols = int(np.ceil(np.sqrt(len(slices))))
+    n_rows = int(np.ceil(len(slices) / n_cols))
+    mosaic = np.full((n_rows * nx, n_cols * ny), fill_value, dtype=float)
+    for idx, slc in enumerate(slices):
+        row, col = divmod(idx, n_cols)
+        mosaic[row * nx:(row + 1) * nx, col * ny:(col + 1) * ny] = volume[:, :, slc]
+    return mosaic
+
+
+def get_image_job(image, filename, vmin=None, vmax=None, title=None, suptitle=None, cmap=None):
+    """ Describe one image to render, so that images can be rendered in a batch or in worker processes """
+    return {"image": image, "filename": filename, "vmin": vmin, "vmax": vmax,
+            "title": title, "suptitle": suptitle, "cmap": cmap}
+
+
+def _get_reusable_figure(image_shape):
+    """ Get the figure for this process, re-creating it only if the image shape changes """
+    # matplotlib is imported here, so only runs that render images pay its import time
+    from matplotlib.figure import Figure
+    from plotter.utils import colorbar
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    if _reusable_figure.get("shape") != image_shape:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        ax_im = ax.imshow(np.zeros(image_shape), interpolation="none")
+        cbar = colorbar(ax_im)
+        _reusable_figure.update({"shape": image_shape, "fig": fig, "ax": ax, "ax_im": ax_im, "cbar": cbar})
+    return _reusable_figure
+
+
+def render_image_with_figure(job):
+    """ Render an image with a title and colorbar, reusing a single Agg figure """
+    image = np.asarray(job["image"])
+    figure = _get_reusable_figure(image.shape)
+    ax_im = figure["ax_im"]
+    ax_im.set_data(image)
+    ax_im.set_cmap(job["cmap"])
+    # Autoscale any missing color limits to this image
+    vmin = job["vmin"] if job["vmin"] is not None else np.nanmin(image)
+    vmax = job["vmax"] if job["vmax"] is not None else np.nanmax(image)
+    ax_im.set_clim(vmin, vmax)
+    figure["cbar"].update_normal(ax_im)
+    figure["ax"].set_title(job["title"] if job["title"] is not None else "")
+    figure["fig"].suptitle(job["suptitle"] if job["suptitle"] is not None else "")
+    figure["fig"].savefig(job["filename"], bbox_inches="tight")
+
+
+def render_image_as_array(job):
+    """ Write the colormapped image array directly to file, one pixel per voxel, without axes or colorbar """
+    import matplotlib.image
+    matplotlib.image.imsave(job["filename"], np.asarray(job["image"]),
+                            vmin=job["vmin"], vmax=job["vmax"], cmap=job["cmap"])
+
+
+def render_image_jobs(jobs, style="figure"):
+    if style == "figure":
+        render_function = render_image_with_figure
+    elif style == "array":
+        render_function = render_image_as_array
+    else:
+        raise Exception(f"Unknown image style: {style}")
+    for job in jobs:
+        render_function(job)
+    return len(jobs)
+
+
+def render_images(jobs, n_workers=1, style="figure"):
+    """ Render all image jobs, in parallel over n_workers worker processes if n_workers > 1 """
+    jobs = list(jobs)
+    if len(jobs) == 0:
+        return 0
+    for directory in set([os.path.dirname(job["filename"]) for job in jobs]):
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+    if (n_workers is None) or (n_workers <= 1) or (len(jobs) == 1):
+        return render_image_jobs(jobs, style=style)
+
+    # Split the jobs into one chunk per worker, so each worker only sets up its figure once
+    n_workers = min(n_workers, len(jobs))
+    job_chunks = [jobs[idx::n_workers] for idx in range(n_workers)]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        n_rendered = sum(executor.map(render_image_jobs, job_chunks, [style] * n_workers))
+    return n_rendered
@@ -1,125 +1,234 @@
 import os
 import glob
+import sys
 from utils_io.MRIData import MRIData, turn_mri_data_into_dfs_by_slice
+from utils_io.decoded_cache import DecodedImageCache
+from utils_io.compact_dtypes import MemoryUsage
+from utils_io.results_store import get_session_info, save_session_info
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-
-# #######################################################################################################
-# Input arguments
-parser = argparse.ArgumentParser(description='Pre-processing step to format and save MRI data into CSV format.')
-parser.add_argument('--load-dir', dest='load_dir',
-                    type=str, action='store', required=True,
-                    help='Directory to load raw data from')
-parser.add_argument('--load-subdirs', dest='load_subdirs',
-                    type=str, action='store', nargs="+", required=True,
-                    help='Sub-directories to load raw data from. Data will be loaded from each directory and \n'
-                         'combined. E.g., data will be loaded from: <load-dir>/<load-subdir> for each load-subdir in \n'
-                         'load-subdirs. For example, all TI data for a T1 dataset should be given in the load-subdirs\n'
-                         ' list.')
-parser.add_argument('--load-data-extension', dest='load_data_extension',
-                    type=str, action='store', required=True, choices=[".dcm", ".dim", "", ".fdf", ".IMA"],
-                    help='File extension of the raw data. A file extension of an empty string will load dicom data.')
-parser.add_argument('--dataset', dest='dataset',
-                    type=str, action='store', required=True,
-                    help='Dataset name - data will be saved with this name')
-parser.add_argument('--datatype', dest='datatype',
-                    type=str, action='store', required=True,
-                    choices=["t1", "t2", "t2_map"],
-                    help='Type of data to process')
-parser.add_argument('--output-dir', dest='output_dir',
-                    action='store', required=True,
-                    help='Directory to output data to. The output convention is: \n'
-                         '<output-dir>/<datatype>/<dataset>/raw_{slc}.csv, where slc is the slice number')
-parser.add_argument("--images",
-                    dest="save_images",
-                    default=False,
-                    action="store_true",
-                    help="(Optional) Store images of fits when saving data. Note: for grouping by voxel, "
-                         "this will be overwritten to False because it takes too long to run")
-
-args = parser.parse_args()
-dataset = args.dataset
-datatype = args.datatype
-output_dir = args.output_dir
-parent_load_dir = args.load_dir
-load_subdirs = args.load_subdirs
-load_data_extension = args.load_data_extension
-save_images = args.save_images
-
-# #######################################################################################################
-# Code
-print(f"\n----------------start {dataset}-----------------")
-
-# First, load all files for all specified directories
-mri_data_objs = []
-for raw_data_dir in load_subdirs:
-    load_dir = os.path.join(parent_load_dir, raw_data_dir)
-
-    print("Checking for files in", load_dir)
-    filenames = glob.glob(os.path.join(load_dir, "**", "*" + load_data_extension), recursive=True)
-    filenames.sort()
-    n_files = len(filenames)
-    print(n_files)
-    if n_files > 0:
-        print("Loading", n_files, "files from", load_dir, ", e.g.:", filenames[0])
-        for filename in filenames:
-            if (load_data_extension == ".dcm") or (load_data_extension == ".dim") or (load_data_extension == "") or\
-                    (load_data_extension == ".IMA"):
-                mri_data = MRIData().readDicom(filename, datatype=datatype, file_extension=load_data_extension)
-            elif load_data_extension == ".fdf":
-                mri_data = MRIData().readFDF(filename)
-            else:
-                # TODO: Make nii processing again
-                raise Exception(f"Unknown data extension: {load_data_extension}")
-            mri_data_objs.append(mri_data)
+from plotter.render import build_image, get_image_job, render_images
+from profiling.run_report import RunReport, optional_stage, add_counts
+
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Pre-processing step to format and save MRI data into CSV format.')
+    parser.add_argument('--load-dir', dest='load_dir',
+                        type=str, action='store', required=True,
+                        help='Directory to load raw data from')
+    parser.add_argument('--load-subdirs', dest='load_subdirs',
+                        type=str, action='store', nargs="+", required=True,
+                        help='Sub-directories to load raw data from. Data will be loaded from each directory and \n'
+                             'combined. E.g., data will be loaded from: <load-dir>/<load-subdir> for each load-subdir '
+                             'in \nload-subdirs. For example, all TI data for a T1 dataset should be given in the '
+                             'load-subdirs\n list.')
+    parser.add_argument('--load-data-extension', dest='load_data_extension',
+                        type=str, action='store', required=True, choices=[".dcm", ".dim", "", ".fdf", ".IMA"],
+                        help='File extension of the raw data. A file extension of an empty string will load dicom '
+                             'data.')
+    parser.add_argument('--dataset', dest='dataset',
+                        type=str, action='store', required=True,
+                        help='Dataset name - data will be saved with this name')
+    parser.add_argument('--datatype', dest='datatype',
+                        type=str, action='store', required=True,
+                        choices=["t1", "t2", "t2_epg", "t2_map", "adc"],
+                        help='Type of data to process')
+    parser.add_argument('--output-dir', dest='output_dir',
+                        action='store', required=True,
+                        help='Directory to output data to. The output convention is: \n'
+                             '<output-dir>/<datatype>/<dataset>/raw_{slc}.csv, where slc is the slice number')
+    parser.add_argument("--images",
+                        dest="save_images",
+                        default=False,
+                        action="store_true",
+                        help="(Optional) Store images of each acquisition when saving data")
+    parser.add_argument("--image-workers", dest="image_workers",
+                        type=int, default=1, action="store",
+                        help="(Optional) Number of worker processes to render images with. The default value is 1")
+    parser.add_argument("--image-style", dest="image_style",
+                        type=str, default="figure", action="store", choices=["figure", "array"],
+                        help="(Optional) Render images as figures with a colorbar (figure), or write the colormapped "
+                             "arrays directly to PNG, one pixel per voxel (array). The default value is figure")
+    parser.add_argument("--decoded-cache-dir", dest="decoded_cache_dir",
+                        action="store",
+                        help="(Optional) Directory to cache the decoded (and rescaled) images in, so files that were "
+                             "read before (e.g. with other sub-directories) are not decoded again. Images are keyed by "
+                             "their path, size and modification time, and the datatype")
+    parser.add_argument("--decoded-cache-max-gb", dest="decoded_cache_max_gb",
+                        type=float, default=10., action="store",
+                        help="(Optional) Maximum size of the decoded image cache in GB, above which the least recently "
+                             "used images are removed. The default value is 10")
+    parser.add_argument("--compact-dtypes", dest="compact_dtypes",
+                        action="store_true",
+                        help="(Optional) Build the dataframes with compact dtypes (16-bit integer coordinates, 32-bit "
+                             "float data and categorical acquisition columns), and report the memory they save")
+    parser.add_argument("--run-report", dest="run_report",
+                        action="store",
+                        help="(Optional) JSON file to store a run report in, with the wall/CPU time, rows, voxels, "
+                             "bytes read/written and peak memory of each stage and slice")
+    parser.add_argument("--profile-dir", dest="profile_dir",
+                        action="store",
+                        help="(Optional) Directory to store cProfile output of reading the files of each sub-directory "
+                             "in. Only used with --run-report")
+    return parser.parse_args(args)
+
+
+def read_scan(filename, load_data_extension, datatype, decoded_cache=None):
+    """ Read a file into an MRIData object, from the decoded image cache if it is given and has the file. Returns the
+    MRIData object and whether it was read from the cache """
+    if (load_data_extension == ".dcm") or (load_data_extension == ".dim") or \
+            (load_data_extension == "") or (load_data_extension == ".IMA"):
+        reader = "dicom" + load_data_extension
+    elif load_data_extension == ".fdf":
+        reader = "fdf"
+    else:
+        # TODO: Make nii processing again
+        raise Exception(f"Unknown data extension: {load_data_extension}")
+    if decoded_cache is not None:
+        mri_data = decoded_cache.get(filename, datatype, reader)
+        if mri_data is not None:
+            return mri_data, True
+    if reader == "fdf":
+        mri_data = MRIData().readFDF(filename)
     else:
-        raise Exception(f"No files found in {load_dir} for extension {load_data_extension}")
-
-# #######################################################################################################
-# Combnie the data all into one dataframe structure
-mri_dfs_by_slice = turn_mri_data_into_dfs_by_slice(mri_data_objs)
-
-# #######################################################################################################
-# Save data
-save_directory = os.path.join(output_dir,
-                              datatype,
-                              dataset)
-os.makedirs(save_directory, exist_ok=True)
-print("Saving data to:", save_directory)
-if save_images:
-    save_image_directory = os.path.join(save_directory, "images")
-    os.makedirs(save_image_directory, exist_ok=True)
-    print("Saving images to:", save_image_directory)
-for slc_location, mri_df in mri_dfs_by_slice.items():
-    assert len(np.unique(mri_df["slc"])) == 1, f"Multiple slices found for slice {slc_location}"
-    slc = mri_df["slc"].values[0]
-    print("Saving data for slc", slc, "at", slc_location)
-    save_filename = os.path.join(save_directory, f"raw_{slc}.csv")
-    with open(save_filename, "w") as f:
-        mri_df.to_csv(f, index=False)
-
-    # Save images
+        mri_data = MRIData().readDicom(filename, datatype=datatype, file_extension=load_data_extension)
+    if decoded_cache is not None:
+        decoded_cache.put(filename, datatype, reader, mri_data)
+    return mri_data, False
+
+
+def read_scans(parent_load_dir, load_subdirs, load_data_extension, datatype, run_report=None, decoded_cache=None):
+    """ Read all files of each sub-directory into MRIData objects, with the decoded image cache if given """
+    mri_data_objs = []
+    for raw_data_dir in load_subdirs:
+        load_dir = os.path.join(parent_load_dir, raw_data_dir)
+
+        print("Checking for files in", load_dir)
+        filenames = glob.glob(os.path.join(load_dir, "**", "*" + load_data_extension), recursive=True)
+        filenames.sort()
+        n_files = len(filenames)
+        print(n_files)
+        if n_files > 0:
+            print("Loading", n_files, "files from", load_dir, ", e.g.:", filenames[0])
+            with optional_stage(run_report, "read_scans", profile=True, load_subdir=raw_data_dir) as stage:
+                for filename in filenames:
+                    mri_data, from_cache = read_scan(filename, load_data_extension, datatype,
+                                                     decoded_cache=decoded_cache)
+                    mri_data_objs.append(mri_data)
+                    add_counts(stage, files=1, bytes_read=os.path.getsize(filename),
+                               voxels=int(np.size(mri_data.pixel_array)), cache_hits=int(from_cache))
+        else:
+            raise Exception(f"No files found in {load_dir} for extension {load_data_extension}")
+    return mri_data_objs
+
+
+def preformat_data(parent_load_dir, load_subdirs, load_data_extension, datatype, run_report=None,
+                   decoded_cache=None, compact=False, memory_usage=None, return_session_info=False):
+    """ Read the scans of each sub-directory (with the decoded image cache if given), and combine them into one
+    dataframe per slice, with the compact dtypes if compact (and their memory added to memory_usage, if given).
+    Returns the dataframes by slice location, and the session information of the scans (e.g. the study date) if
+    return_session_info """
+    mri_data_objs = read_scans(parent_load_dir, load_subdirs, load_data_extension, datatype, run_report=run_report,
+                               decoded_cache=decoded_cache)
+
+    # Combine the data all into one dataframe structure
+    with optional_stage(run_report, "build_dataframes") as stage:
+        mri_dfs_by_slice = turn_mri_data_into_dfs_by_slice(mri_data_objs, compact=compact)
+        add_counts(stage, rows=int(np.sum([len(mri_df) for mri_df in mri_dfs_by_slice.values()])))
+        if memory_usage is not None:
+            for mri_df in mri_dfs_by_slice.values():
+                memory_usage.add("build_dataframes", mri_df, stage=stage)
+    if return_session_info:
+        return mri_dfs_by_slice, get_session_info(mri_data_objs)
+    return mri_dfs_by_slice
+
+
+def save_preformatted_data(mri_dfs_by_slice, save_directory, save_images=False, image_workers=1,
+                           image_style="figure", session_info=None, run_report=None):
+    """ Save the dataframe of each slice as <save_directory>/raw_{slc}.csv, the session information (if given) as
+    <save_directory>/session_info.json, and optionally images of each acquisition """
+    os.makedirs(save_directory, exist_ok=True)
+    print("Saving data to:", save_directory)
+    if session_info is not None:
+        save_session_info(session_info, save_directory)
+    if save_images:
+        save_image_directory = os.path.join(save_directory, "images")
+        os.makedirs(save_image_directory, exist_ok=True)
+        print("Saving images to:", save_image_directory)
+    image_jobs = []
+    for slc_location, mri_df in mri_dfs_by_slice.items():
+        assert len(np.unique(mri_df["slc"])) == 1, f"Multiple slices found for slice {slc_location}"
+        slc = mri_df["slc"].values[0]
+        print("Saving data for slc", slc, "at", slc_location)
+        save_filename = os.path.join(save_directory, f"raw_{slc}.csv")
+        with optional_stage(run_report, "save", slc=slc) as stage:
+            with open(save_filename, "w") as f:
+                mri_df.to_csv(f, index=False)
+            add_counts(stage, rows=len(mri_df), bytes_written=os.path.getsize(save_filename))
+
+        # Save images
+        if save_images:
+            for group_name, group_df in mri_df.groupby(["te", "ti", "tr", "b_value", "b_vec_0", "b_vec_1",
+                                                        "b_vec_2"]):
+                te = group_name[0]
+                ti = group_name[1]
+                tr = group_name[2]
+                b_value = group_name[3]
+                b_vec_0 = group_name[4]
+                b_vec_1 = group_name[5]
+                b_vec_2 = group_name[6]
+                im = build_image(group_df, "data")
+                image_jobs.append(get_image_job(im, os.path.join(
+                    save_image_directory,
+                    f"slc_{slc}_te{te}_ti{ti}_tr{tr}_b{b_value}_at{b_vec_0}_{b_vec_1}_{b_vec_2}.png")))
+
+    # Render all images at once, so they can be rendered in parallel
     if save_images:
-        for group_name, group_df in mri_df.groupby(["te", "ti", "tr", "b_value", "b_vec_0", "b_vec_1", "b_vec_2"]):
-            te = group_name[0]
-            ti = group_name[1]
-            tr = group_name[2]
-            b_value = group_name[3]
-            b_vec_0 = group_name[4]
-            b_vec_1 = group_name[5]
-            b_vec_2 = group_name[6]
-            im = np.zeros((group_df["nx"].values[0], group_df["ny"].values[0]))
-            im[list(group_df["x"]), list(group_df["y"])] = list(group_df["data"])
-            f = plt.figure(num=1, clear=True)
-            ax = f.add_subplot()
-            im_ax = ax.imshow(im)
-            plt.colorbar(im_ax, ax=ax)
-            f.savefig(os.path.join(save_image_directory,
-                                   f"slc_{slc}_te{te}_ti{ti}_tr{tr}_b{b_value}_at{b_vec_0}_{b_vec_1}_{b_vec_2}.png"))
-
-# #######################################################################################################
-print("Finished")
-print(f"----------------end {dataset}-----------------")
-
-print("\nFinished Saving Data!")
+        print("Rendering", len(image_jobs), "images")
+        with optional_stage(run_report, "images") as stage:
+            render_images(image_jobs, n_workers=image_workers, style=image_style)
+            add_counts(stage, images=len(image_jobs))
+
+
+def main(args):
+    run_report = None
+    if args.run_report is not None:
+        run_report = RunReport("preformat_data", filename=args.run_report, profile_dir=args.profile_dir)
+        run_report.add_info(args=vars(args))
+
+    decoded_cache = None
+    if args.decoded_cache_dir is not None:
+        decoded_cache = DecodedImageCache(args.decoded_cache_dir, max_bytes=args.decoded_cache_max_gb * 1e9)
+
+    memory_usage = MemoryUsage() if args.compact_dtypes else None
+
+    print(f"\n----------------start {args.dataset}-----------------")
+    mri_dfs_by_slice, session_info = preformat_data(args.load_dir, args.load_subdirs, args.load_data_extension,
+                                                    args.datatype, run_report=run_report, decoded_cache=decoded_cache,
+                                                    compact=args.compact_dtypes, memory_usage=memory_usage,
+                                                    return_session_info=True)
+    if session_info["study_date"] != "":
+        print("Study date:", session_info["study_date"])
+    if decoded_cache is not None:
+        print(f"Read {decoded_cache.hits} files from the decoded image cache, and decoded {decoded_cache.misses} "
+              f"files")
+    save_directory = os.path.join(args.output_dir, args.datatype, args.dataset)
+    save_preformatted_data(mri_dfs_by_slice, save_directory, save_images=args.save_images,
+                           image_workers=args.image_workers, image_style=args.image_style, session_info=session_info,
+                           run_report=run_report)
+    if memory_usage is not None:
+        memory_usage.print()
+        if run_report is not None:
+            run_report.add_info(memory_usage=memory_usage.get_summary())
+    print("Finished")
+    print(f"----------------end {args.dataset}-----------------")
+
+    print("\nFinished Saving Data!")
+    if run_report is not None:
+        run_report.save()
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)
@@ -1,14 +1,44 @@
 import pandas as pd
 import numpy as np
 import os
-from fitting.overall_fitting import get_measurement_estimates_for_data_by_group, get_limited_values
-from fitting.fitting_utils import get_fit_by_str, get_fit_group_cols, remove_groups_with_zeros, limit_data_to_threshold
-from plotter.fits import imshow_fits_by_slice
+import time
+import hashlib
+from fitting.constants import get_all_quantitative_variables
+from fitting.models import supports_initial_values, has_reference_fit, get_model
+from fitting.overall_fitting import get_measurement_estimates_for_data_by_group, get_limited_values, fit_engines, \
+    get_limited_value_column, get_measurement_estimates_for_data_subsets, time_lmfit_groups, hybrid_calibration_groups
+from fitting.fitting_utils import get_fit_by_str, get_fit_group_cols, remove_groups_with_zeros, \
+    limit_data_to_threshold, limit_fits_to_threshold, summarize_fit_cost, add_fit_costs, print_fit_cost_comparison, \
+    summarize_hybrid_fit, add_hybrid_fit_summaries, print_hybrid_fit_summary
+from fitting.multires_fitting import get_multiresolution_estimates, check_multiresolution_factors
+from fitting.epg_fitting import set_epg_cache_dir
+from fitting.shadow_fitting import get_shadow_comparison, summarize_shadow_comparison, print_shadow_summary, \
+    get_shadow_max_groups, default_shadow_time_budget
+from fitting.roi_statistics import ROIStatistics, load_label_map, load_label_names
+from fitting.fit_planning import get_fit_plan, sample_voxels_to_fit, calibrate_fit_time, summarize_fit_plan, \
+    print_fit_plan, default_calibration_voxels
+from fitting.warm_start import load_prior_fits, get_warm_start_init_pd, default_max_shift
+from fitting.curve_clustering import get_clustered_estimates
+from fitting.solver_telemetry import split_solver_telemetry, get_slowest_voxels, summarize_solver_telemetry, \
+    print_solver_telemetry, default_slowest_voxels
+from fitting.subset_sweep import SliceValueTable, get_values_str, parse_values_subsets, get_sweep_subsets, \
+    get_subset_max_values, get_masked_subset_data
 from utils_io.dataframe import get_fit_pd_to_save
+from utils_io.parametric_maps import save_parametric_maps
+from utils_io.background_io import iterate_in_background, BackgroundWriter
+from utils_io.compact_dtypes import read_compact_csv, MemoryUsage
+from utils_io.results_store import ResultsStore, get_fit_summaries, load_session_info, format_study_date
+from profiling.run_report import RunReport, optional_stage, add_counts, add_labels, to_json_value
+import json
 import glob
+from functools import partial
 import argparse
 import sys
 
+# Columns of the fits that are not saved: the data, and the solver evaluations of each voxel, which are only saved
+# when the solver cost is compared or recorded (see get_columns_to_remove)
+default_columns_to_remove = ("data", "nfev")
+
 
 def parse_args(args):
     # Input arguments
@@ -18,7 +48,7 @@ def parse_args(args):
                         help='Dataset(s) to process')
     parser.add_argument('--datatype',
                         dest='datatype', type=str, action='store', nargs="+", required=True,
-                        choices=["t1", "t2", "t2_map"],
+                        choices=["t1", "t2", "t2_epg", "t2_map", "adc"],
                         help='Type(s) of data to process. If multiple datatypes are given, cannot specify '
                              'datatype-values')
     parser.add_argument('--datatype-values',
@@ -41,13 +71,788 @@ def parse_args(args):
                         dest='output_dir', action='store', required=True,
                         help='Directory to output data to. The output convention is: '
                              '<output-dir>/<datatype>/<dataset>/raw.csv')
+    parser.add_argument("--output-format",
+                        dest="output_format", type=str, default="csv", action="store", choices=["csv", "maps", "both"],
+                        help="(Optional) Store the fits as csv files for each slice and for all slices (csv), or as "
+                             "one compressed file of float32 maps of each fitted quantity and a bitmask of the fitted "
+                             "voxels and valid fits: <output-dir>/<datatype>/<dataset>/fit_maps*.npz (maps), or both. "
+                             "Use utils_io.parametric_maps.load_fit_pd_from_maps to load the maps as the fit "
+                             "dataframe. The default value is csv")
     parser.add_argument("--images",
                         dest="save_fits", default=False, action="store_true",
-                        help="(Optional) Store images of fits when saving data. Note: for grouping by voxel, "
-                             "this will be overwritten to False because it takes too long to run")
+                        help="(Optional) Store images of fits when saving data. Images are rendered once all "
+                             "slices are fit, on the same colorbar scale")
+    parser.add_argument("--image-workers",
+                        dest="image_workers", type=int, default=1, action="store",
+                        help="(Optional) Number of worker processes to render images with. The default value is 1")
+    parser.add_argument("--image-style",
+                        dest="image_style", type=str, default="figure", action="store", choices=["figure", "array"],
+                        help="(Optional) Render images as figures with a colorbar (figure), or write the colormapped "
+                             "arrays directly to PNG, one pixel per voxel (array). The default value is figure")
+    parser.add_argument("--image-mosaic",
+                        dest="image_mosaic", default=False, action="store_true",
+                        help="(Optional) Also store one mosaic image of all slices for each fitted quantity")
+    parser.add_argument("--multiresolution-factors",
+                        dest="multires_factors", nargs="+", type=int, action="store",
+                        help="(Optional) Fit coarse-to-fine: first fit block-averaged slices downsampled by each "
+                             "factor (e.g. 4 2, each factor must divide the previous one), and use the upsampled "
+                             "fits as initial values for the next level and the full resolution fit")
+    parser.add_argument("--compare-cold-start",
+                        dest="compare_cold_start", default=False, action="store_true",
+                        help="(Optional) Also run a single-level fit with the heuristic initial values for each "
+                             "slice, and report the solver evaluations and wall time against it")
+    parser.add_argument("--fit-engine",
+                        dest="fit_engine", type=str, default="lmfit", action="store", choices=fit_engines,
+                        help="(Optional) Fit each voxel with lmfit (lmfit), all voxels of a slice at once with a "
+                             "vectorized Levenberg-Marquardt solver of the model registered for the datatype "
+                             "(batched), or all voxels with the vectorized solver and then only the voxels with an "
+                             "invalid stderr or a high norm_redchi again with lmfit (hybrid). The default value is "
+                             "lmfit")
+    parser.add_argument("--fit-workers",
+                        dest="fit_workers", type=int, default=1, action="store",
+                        help="(Optional) Number of worker processes to split the voxels of each slice over when "
+                             "fitting. The default value is 1")
+    parser.add_argument("--epg-cache-dir",
+                        dest="epg_cache_dir", action="store",
+                        help="(Optional) Directory to cache the EPG dictionaries of the t2_epg datatype in, so the "
+                             "dictionary of each protocol (echo spacing and number of echos) is only computed once")
+    parser.add_argument("--shadow-fraction",
+                        dest="shadow_fraction", type=float, action="store",
+                        help="(Optional) Validate the fit by also fitting this fraction (e.g. 0.01) of the voxels of "
+                             "each slice, sampled at random, with the single-level fit with the heuristic initial "
+                             "values, and report the bias, max absolute/relative error and fraction of voxels "
+                             "outside the tolerance of each fitted quantity")
+    parser.add_argument("--shadow-max-voxels",
+                        dest="shadow_max_voxels", type=int, default=20, action="store",
+                        help="(Optional) Maximum number of voxels of each slice to validate the fit on. "
+                             "The default value is 20")
+    parser.add_argument("--shadow-time-budget",
+                        dest="shadow_time_budget", type=float, default=default_shadow_time_budget, action="store",
+                        help="(Optional) Largest time of the shadow fit, as a fraction of the time of the fit it "
+                             "validates. Fewer voxels are sampled when the budget cannot hold them, at the shadow fit "
+                             "time per voxel measured so far, and a warning is printed when it holds too few voxels "
+                             f"for meaningful statistics. The default value is {default_shadow_time_budget}")
+    parser.add_argument("--shadow-tolerance",
+                        dest="shadow_tolerance", type=float, default=0.01, action="store",
+                        help="(Optional) Relative error of the fit against the validation fit that is reported as "
+                             "outside the tolerance. The default value is 0.01")
+    parser.add_argument("--shadow-seed",
+                        dest="shadow_seed", type=int, default=0, action="store",
+                        help="(Optional) Random seed to sample the voxels to validate the fit on. "
+                             "The default value is 0")
+    parser.add_argument("--roi-labels",
+                        dest="roi_labels", action="store",
+                        help="(Optional) Label map of the same size as the fits (a .npy file, or the labels array of "
+                             "a .npz file, e.g. ground_truth.npz from generate_synthetic_data.py), to get the "
+                             "statistics of the fitted quantities of the valid fits in each label as the slices are "
+                             "fit, and save them in roi_stats_byvoxel_<threshold>.csv")
+    parser.add_argument("--roi-label-names",
+                        dest="roi_label_names", action="store",
+                        help="(Optional) csv file with the name of each label of --roi-labels, in label and name "
+                             "columns. Only used with --roi-labels")
+    parser.add_argument("--sweep-subsets",
+                        dest="sweep_subsets", type=str, nargs="+", action="store",
+                        help="(Optional) Subsets of the values to fit the data limited to, as with --datatype-values, "
+                             "each as comma-separated values (e.g. 100,800 100,400,800). The data is loaded and "
+                             "summarized for masking once, and the fits of each subset are saved as with "
+                             "--datatype-values: <output-dir>/<datatype>/<dataset>_<values>/. With the batched fit "
+                             "engine, all subsets of each slice are fit in one pass")
+    parser.add_argument("--sweep-k",
+                        dest="sweep_k", type=int, action="store",
+                        help="(Optional) Also sweep over all subsets of this many of the --datatype-values (or of "
+                             "all values of the data, if not given), e.g. 3 for all subsets of 3 inversion times")
+    parser.add_argument("--sweep-voxel-thresholds",
+                        dest="voxel_thresholds", type=float, nargs="+", action="store",
+                        help="(Optional) Voxel thresholds to mask the data by, instead of --fit-by-voxel-threshold. "
+                             "Each voxel is fit once, with the lowest threshold, and the fits for each threshold are "
+                             "limited to the voxels it keeps and saved as with --fit-by-voxel-threshold: "
+                             "fit_pd_<slice>_byvoxel_<threshold>.csv")
+    parser.add_argument("--plan",
+                        dest="plan", action="store_true",
+                        help="(Optional) Only plan the fit: report the voxels of each slice that would be fit with the "
+                             "voxel threshold (or each of --sweep-voxel-thresholds), and estimate the fit time and "
+                             "peak memory from a calibration fit of a random sample of the voxels with the fit engine "
+                             "and workers, without fitting all voxels or saving any fits")
+    parser.add_argument("--plan-calibration-voxels",
+                        dest="plan_calibration_voxels", type=int, default=default_calibration_voxels, action="store",
+                        help="(Optional) Number of voxels to fit to estimate the fit time with --plan. The default "
+                             f"value is {default_calibration_voxels}")
+    parser.add_argument("--warm-start-fits",
+                        dest="warm_start_fits", type=str, nargs="+", action="store",
+                        help="(Optional) Fits of a previous session of the same phantom, as saved by this script "
+                             "(fit_pd*.csv, e.g. of each slice, or fit_maps*.npz), to start the fit of each voxel "
+                             "from. "
+                             "Each slice is matched to the prior slice at the closest location and aligned to it by "
+                             "an in-plane shift, and voxels without a valid prior fit start from the heuristic "
+                             "initial values. Use with --compare-cold-start to report the solver evaluations saved. "
+                             "Only valid when only one datatype is specified")
+    parser.add_argument("--warm-start-max-shift",
+                        dest="warm_start_max_shift", type=int, default=default_max_shift, action="store",
+                        help="(Optional) Largest in-plane shift, in voxels, to align the prior fits to the data by. "
+                             f"The default value is {default_max_shift}")
+    parser.add_argument("--cluster-tolerance",
+                        dest="cluster_tolerance", type=float, action="store",
+                        help="(Optional) Fit clusters of near-duplicate voxel signal curves instead of every voxel: "
+                             "the curves of each slice are normalized by their max and quantized in steps of this "
+                             "tolerance (e.g. 0.05), and voxels with the same quantized curve are a cluster. The mean "
+                             "curve of each cluster is fit once, and each voxel is then fit again starting from the "
+                             "fit of its cluster (or assigned it, with --cluster-assign). A larger tolerance gives "
+                             "fewer clusters and faster, but less accurate, fits. By default, every voxel is fit")
+    parser.add_argument("--cluster-assign",
+                        dest="cluster_assign", action="store_true",
+                        help="(Optional) With --cluster-tolerance, assign each voxel the fit of its cluster, with its "
+                             "own signal scale, instead of fitting each voxel again from it")
+    parser.add_argument("--solver-telemetry",
+                        dest="solver_telemetry", action="store_true",
+                        help="(Optional) Record the solver telemetry of each voxel: the solver evaluations, whether "
+                             "the solver converged, why it stopped and the fit time. The telemetry is saved as "
+                             "solver_telemetry_byvoxel_<threshold>.csv, and a summary (histograms, the fit time of "
+                             "each slice and the slowest voxels with their signal curves and initial values) as "
+                             "solver_telemetry_byvoxel_<threshold>.json")
+    parser.add_argument("--telemetry-slowest-voxels",
+                        dest="telemetry_slowest_voxels", type=int, default=default_slowest_voxels, action="store",
+                        help="(Optional) Number of the slowest voxels to report with --solver-telemetry. The default "
+                             f"value is {default_slowest_voxels}")
+    parser.add_argument("--prefetch-slices",
+                        dest="prefetch_slices", type=int, default=0, action="store",
+                        help="(Optional) Pipeline loading, fitting and saving: load up to this many slices ahead in "
+                             "a background thread, and save the fits of each slice in a background thread, instead "
+                             "of loading all slices before fitting. Only the prefetched slices are held in memory. "
+                             "The default value is 0 (load all slices first)")
+    parser.add_argument("--compact-dtypes",
+                        dest="compact_dtypes", action="store_true",
+                        help="(Optional) Load and fit the data with compact dtypes (16-bit integer coordinates, 32-bit "
+                             "float data and categorical acquisition columns), and report the memory they save at "
+                             "each stage. The fits are the same within float32 precision")
+    parser.add_argument("--results-store",
+                        dest="results_store", action="store",
+                        help="(Optional) SQLite file to store the summaries (statistics of the fitted values) of each "
+                             "dataset, slice and ROI in, by dataset, datatype, study date, protocol values and fit "
+                             "engine, for trend queries over many sessions (see query_results_store.py). A dataset "
+                             "that is fit again replaces its stored summaries. Datasets without a study date are "
+                             "stored by the directory of their data, with a warning")
+    parser.add_argument("--study-date",
+                        dest="study_date", action="store",
+                        help="(Optional) Study date (YYYY-MM-DD or YYYYMMDD) to store the summaries by with "
+                             "--results-store. By default, the study date of the scans, which preformat_data.py saves "
+                             "in session_info.json next to the data, is used")
+    parser.add_argument("--run-report",
+                        dest="run_report", action="store",
+                        help="(Optional) JSON file to store a run report in, with the wall/CPU time, rows, voxels, "
+                             "bytes read/written and peak memory of each stage and slice")
+    parser.add_argument("--profile-dir",
+                        dest="profile_dir", action="store",
+                        help="(Optional) Directory to store cProfile output of the fit of each slice in. "
+                             "Only used with --run-report")
     return parser.parse_args(args)
 
 
+def get_saved_data_filenames(saved_data_dir, datatype, dataset):
+    """ Get the raw_{slc}.csv files of a dataset, or None if it is saved as one deprecated raw.csv file """
+    if os.path.exists(os.path.join(saved_data_dir, datatype, dataset, "raw.csv")):
+        return None
+    filenames = glob.glob(os.path.join(saved_data_dir, datatype, dataset, "raw*.csv"))
+    filenames.sort()
+    return filenames
+
+
+def load_saved_data_file(filename, datatype, dataset, compact=False, memory_usage=None, run_report=None):
+    """ Load the saved data of one slice, with the compact dtypes if compact (and its memory added to memory_usage,
+    if given). Returns the slice and its data """
+    print("Opening file", filename)
+    with optional_stage(run_report, "load", dataset=dataset, datatype=datatype) as stage:
+        data_pd = read_compact_csv(filename) if compact else pd.read_csv(filename)
+        slc = data_pd["slc"].values[0]
+        add_labels(stage, slc=slc)
+        add_counts(stage, rows=len(data_pd), bytes_read=os.path.getsize(filename))
+        if memory_usage is not None:
+            memory_usage.add("load", data_pd, stage=stage)
+    return slc, data_pd
+
+
+def load_saved_data(saved_data_dir, datatype, dataset, compact=False, memory_usage=None, run_report=None):
+    """ Load the saved data of a dataset, by slice """
+    data_pd_dict = {}
+    filenames = get_saved_data_filenames(saved_data_dir, datatype, dataset)
+    if filenames is None:
+        print("WARNING: Using deprecated load method - loading raw.csv")
+        filename = os.path.join(saved_data_dir, datatype, dataset, "raw.csv")
+        with optional_stage(run_report, "load", dataset=dataset, datatype=datatype) as stage:
+            full_data_pd = read_compact_csv(filename) if compact else pd.read_csv(filename)
+            add_counts(stage, rows=len(full_data_pd), bytes_read=os.path.getsize(filename))
+            if memory_usage is not None:
+                memory_usage.add("load", full_data_pd, stage=stage)
+        for slc, data_pd in full_data_pd.groupby("slc"):
+            data_pd_dict[slc] = data_pd
+    else:
+        for filename in filenames:
+            slc, data_pd = load_saved_data_file(filename, datatype, dataset, compact=compact,
+                                                memory_usage=memory_usage, run_report=run_report)
+            data_pd_dict[slc] = data_pd
+    return data_pd_dict
+
+
+def load_saved_slices(filenames, datatype, dataset, values_to_use=None, compact=False, memory_usage=None,
+                      run_report=None):
+    """ Load and preprocess (see preprocess_data) the saved data of each slice in turn, yielding the slice and its
+    data, so only one slice is loaded at a time """
+    for filename in filenames:
+        slc, data_pd = load_saved_data_file(filename, datatype, dataset, compact=compact, memory_usage=memory_usage,
+                                            run_report=run_report)
+        if values_to_use is not None:
+            with optional_stage(run_report, "preprocess", dataset=dataset, datatype=datatype, slc=slc) as stage:
+                print("Fitting", datatype, "using limited values:", values_to_use)
+                data_pd = get_limited_values(data_pd, datatype, values_to_use)
+                add_counts(stage, rows=len(data_pd))
+                if memory_usage is not None:
+                    memory_usage.add("preprocess", data_pd, stage=stage)
+        yield slc, data_pd
+
+
+def get_file_digest(filename, chunk_bytes=1 << 20):
+    """ Get a digest of the contents of a file, which is much faster to compute than parsing it """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_saved_data_max_value(filenames, datatype, values_to_use=None, cache_dir=None, run_report=None, **labels):
+    """ Get the max value over all slices of the (preprocessed) saved data. If cache_dir is given (e.g. the output
+    directory, so the saved data is not modified), the max value of each file is stored in max_values.json in it by
+    the digest of the file's contents, and is only computed again (by only reading the data column, and the column of
+    the values to use) if the contents changed """
+    max_val = -1
+    values_key = "all" if values_to_use is None else "_".join([str(m) for m in values_to_use])
+    usecols = ["data"]
+    if values_to_use is not None:
+        usecols.append(get_limited_value_column(datatype))
+    max_values_filename = os.path.join(cache_dir, "max_values.json") if cache_dir is not None else None
+    stored_max_values = {}
+    if (max_values_filename is not None) and os.path.exists(max_values_filename):
+        with open(max_values_filename, "r") as f:
+            stored_max_values = json.load(f)
+    updated = False
+    digests = []
+    with optional_stage(run_report, "max_value", **labels, datatype=datatype) as stage:
+        for filename in filenames:
+            digest = get_file_digest(filename) if max_values_filename is not None else None
+            digests.append(digest)
+            stored = stored_max_values.setdefault(digest, {}) if digest is not None else {}
+            if values_key not in stored:
+                data_pd = pd.read_csv(filename, usecols=usecols)
+                if values_to_use is not None:
+                    data_pd = get_limited_values(data_pd, datatype, values_to_use)
+                stored[values_key] = float(np.max(data_pd["data"]))
+                updated = True
+                add_counts(stage, rows=len(data_pd), bytes_read=os.path.getsize(filename))
+            max_val = np.max([max_val, stored[values_key]])
+    if updated and (max_values_filename is not None):
+        try:
+            tmp_filename = max_values_filename + ".tmp"
+            with open(tmp_filename, "w") as f:
+                # Only keep the max values of the current contents of the files
+                json.dump({digest: stored_max_values[digest] for digest in digests}, f, indent=2)
+            os.replace(tmp_filename, max_values_filename)
+        except OSError as e:
+            print(f"Unable to store the max values in {max_values_filename}: {e}")
+    return max_val
+
+
+def preprocess_data(data_pd_dict, datatype, values_to_use=None, memory_usage=None, run_report=None, **labels):
+    """ Limit the data of each slice to the given values (inversion or echo times), if given (and add the memory of
+    the limited data to memory_usage, if given). Returns the data by slice and the max value over all slices """
+    max_val = -1
+    preprocessed_data_pd_dict = {}
+    with optional_stage(run_report, "preprocess", **labels, datatype=datatype) as stage:
+        for slc, data_pd in data_pd_dict.items():
+            # If limits are specified, limit the data_pd
+            if values_to_use is not None:
+                print("Fitting", datatype, "using limited values:", values_to_use)
+                data_pd = get_limited_values(data_pd, datatype, values_to_use)
+            # Store the data and max value
+            preprocessed_data_pd_dict[slc] = data_pd
+            max_val = np.max([max_val, np.max(data_pd["data"])])
+            add_counts(stage, rows=len(data_pd))
+            if (memory_usage is not None) and (values_to_use is not None):
+                memory_usage.add("preprocess", data_pd, stage=stage)
+    return preprocessed_data_pd_dict, max_val
+
+
+def mask_slice(data_pd, max_val, voxel_threshold, group_cols):
+    """ Mask the background voxels of a slice """
+    # Only look at slices that have max val of at least 10% of total max val
+    slc_max_val = np.max(data_pd["data"])
+    if slc_max_val > (np.min([0.1, voxel_threshold]) * max_val):
+        # Remove all groups that have any data that is exactly zero:
+        data_pd = remove_groups_with_zeros(data_pd, group_cols=group_cols, data_col="data")
+        # Only keep data that is above the voxel threshold:
+        data_pd = limit_data_to_threshold(data_pd, slc_max_val, voxel_threshold)
+    return data_pd
+
+
+def fit_slices(data_pd_dict, datatype, max_val=None, voxel_threshold=0.2, multires_factors=None,
+               compare_cold_start=False, shadow_fraction=None, shadow_max_voxels=20,
+               shadow_time_budget=default_shadow_time_budget, shadow_tolerance=0.01, shadow_seed=0,
+               fit_engine="lmfit", fit_workers=1, prior_fit_pd=None,
+               warm_start_max_shift=default_max_shift, cluster_tolerance=None, cluster_polish=True,
+               record_telemetry=False, telemetry_slowest_voxels=default_slowest_voxels, save_slice=None,
+               keep_fits=True, memory_usage=None, run_report=None, **labels):
+    """ Fit each slice of the (preprocessed) data by voxel, with the fit engine over fit_workers worker processes.
+    data_pd_dict is a dictionary of the data by slice, or an iterable of (slice, data) pairs (e.g. slices that are
+    loaded as they are fit), in which case max_val must be given. If prior_fit_pd is given (e.g. the fits of a
+    previous session), the fits of each slice are started from its aligned fitted values (see
+    get_warm_start_init_pd). If cluster_tolerance is given, the voxels of each slice are fit by clusters of
+    near-duplicate signal curves (see get_clustered_estimates). If save_slice is given, it is called with the slice
+    and its fits as soon as each slice is fit. Returns the fits by slice (if keep_fits) and a summary of the fit cost,
+    the cold start fit cost (if compare_cold_start), the alignment and coverage of the prior fits (if prior_fit_pd is
+    given), the voxels refined by the hybrid fit engine and the time it saved (for fit_engine hybrid), the clusters
+    (if cluster_tolerance is given), the shadow fit (if shadow_fraction is given, sampling as many voxels as
+    shadow_time_budget holds, see get_shadow_max_groups) and the solver telemetry of each
+    voxel and its summary (if record_telemetry). The memory of the masked data and fits of each slice is added to
+    memory_usage, if given """
+    group_cols = get_fit_group_cols("voxel")
+    if isinstance(data_pd_dict, dict):
+        slices = data_pd_dict.items()
+        if max_val is None:
+            max_val = np.max([np.max(data_pd["data"]) for data_pd in data_pd_dict.values()])
+    elif max_val is None:
+        raise Exception("max_val must be given to fit slices that are not in a dictionary")
+    else:
+        slices = data_pd_dict
+    if multires_factors is not None:
+        multires_factors = check_multiresolution_factors(multires_factors)
+    labels["datatype"] = datatype
+    fit_pds = {}
+    fit_cost = summarize_fit_cost(pd.DataFrame(), 0)
+    cold_start_fit_cost = summarize_fit_cost(pd.DataFrame(), 0)
+    hybrid_summary = summarize_hybrid_fit(pd.DataFrame(), 0)
+    shadow_comparison_pds = []
+    shadow_time = 0.
+    shadow_voxels = 0
+    shadow_budget_limited = False
+    shadow_rng = np.random.default_rng(shadow_seed)
+    use_initial_values = supports_initial_values(datatype, fit_engine)
+    warm_start = (prior_fit_pd is not None) and use_initial_values
+    if (prior_fit_pd is not None) and not use_initial_values:
+        print(f"Note: the {fit_engine} fit of {datatype} cannot start from given values, so the prior fits are not "
+              f"used")
+    warm_start_summary = {"num_voxels": 0, "num_voxels_with_prior": 0, "slices": {}}
+    run_shadow_fit = (shadow_fraction is not None) and has_reference_fit(datatype)
+    # Clusters are fit from their representatives' fits, so the fits must be iterative and have a forward model
+    cluster = (cluster_tolerance is not None) and (multires_factors is None) and use_initial_values and \
+        (get_model(datatype).forward is not None)
+    if (cluster_tolerance is not None) and not cluster:
+        print(f"Note: the {fit_engine} fit of {datatype} cannot start from given values, so every voxel is fit "
+              f"instead of clusters")
+    cluster_summary = {"num_voxels": 0, "num_clusters": 0, "representative_nfev": 0, "polish_nfev": 0}
+    telemetry_pds = []
+    slowest_voxels = []
+    for slc, data_pd in slices:
+        print("Processing fit by voxel for slice", slc)
+
+        with optional_stage(run_report, "mask", **labels, slc=slc) as stage:
+            add_counts(stage, rows_in=len(data_pd))
+            data_pd = mask_slice(data_pd, max_val, voxel_threshold, group_cols)
+            add_counts(stage, rows_out=len(data_pd))
+            if memory_usage is not None:
+                memory_usage.add("mask", data_pd, stage=stage)
+        if len(data_pd) == 0:
+            # Nothing to fit, continue
+            continue
+
+        # Get the initial values from the aligned prior fits
+        init_pd = None
+        if warm_start:
+            with optional_stage(run_report, "warm_start", **labels, slc=slc) as stage:
+                init_pd, alignment = get_warm_start_init_pd(data_pd, prior_fit_pd, datatype,
+                                                            max_shift=warm_start_max_shift)
+                n_voxels = len(data_pd.drop_duplicates(subset=group_cols))
+                warm_start_summary["num_voxels"] += n_voxels
+                warm_start_summary["num_voxels_with_prior"] += len(init_pd)
+                warm_start_summary["slices"][str(slc)] = {**alignment, "num_voxels_with_prior": len(init_pd)}
+                add_counts(stage, voxels=n_voxels, voxels_with_prior=len(init_pd))
+            print(f"Starting from prior slice {alignment['prior_slc']} shifted by {alignment['shift']} for "
+                  f"{len(init_pd)} of {n_voxels} voxels")
+
+        # Fit data for this slice
+        with optional_stage(run_report, "fit", profile=True, **labels, slc=slc) as stage:
+            start_time = time.time()
+            if (multires_factors is not None) and use_initial_values:
+                fit_pd, _ = get_multiresolution_estimates(data_pd, datatype, multires_factors,
+                                                          group_cols=group_cols, run_report=run_report,
+                                                          fit_engine=fit_engine, n_workers=fit_workers,
+                                                          record_telemetry=record_telemetry)
+            elif cluster:
+                fit_pd, slice_cluster_summary = get_clustered_estimates(data_pd, datatype, tolerance=cluster_tolerance,
+                                                                        polish=cluster_polish, group_cols=group_cols,
+                                                                        run_report=run_report, fit_engine=fit_engine,
+                                                                        n_workers=fit_workers,
+                                                                        record_telemetry=record_telemetry)
+                for k in cluster_summary:
+                    cluster_summary[k] += slice_cluster_summary[k]
+            else:
+                fit_pd = get_measurement_estimates_for_data_by_group(data_pd, datatype, group_cols=group_cols,
+                                                                     init_pd=init_pd, run_report=run_report,
+                                                                     fit_engine=fit_engine, n_workers=fit_workers,
+                                                                     record_telemetry=record_telemetry)
+            slice_fit_cost = summarize_fit_cost(fit_pd, time.time() - start_time)
+            if cluster:
+                # Count the solver evaluations of the representatives too
+                slice_fit_cost["nfev"] += slice_cluster_summary["representative_nfev"]
+            fit_cost = add_fit_costs(fit_cost, slice_fit_cost)
+            add_counts(stage, rows=len(data_pd), voxels=slice_fit_cost["num_voxels"], nfev=slice_fit_cost["nfev"])
+            if memory_usage is not None:
+                memory_usage.add("fit", fit_pd, stage=stage)
+        if fit_engine == "hybrid":
+            # Time lmfit on a few voxels of the run (outside the fit time) to estimate the time the hybrid fit saves
+            n_timed_voxels = hybrid_calibration_groups - hybrid_summary["num_timed"]
+            if ("refined" in fit_pd.columns) and (n_timed_voxels > 0):
+                with optional_stage(run_report, "hybrid_calibration", **labels, slc=slc) as stage:
+                    fit_pd = time_lmfit_groups(data_pd, fit_pd, datatype, group_cols, n_groups=n_timed_voxels)
+                    add_counts(stage, voxels=n_timed_voxels)
+            hybrid_summary = add_hybrid_fit_summaries(hybrid_summary,
+                                                      summarize_hybrid_fit(fit_pd, slice_fit_cost["wall_time"]))
+        if record_telemetry:
+            # Keep the telemetry of all voxels, but only the signal curves of the slowest voxels so far
+            fit_pd, telemetry_pd = split_solver_telemetry(fit_pd, datatype, group_cols)
+            if telemetry_pd is not None:
+                telemetry_pds.append(telemetry_pd)
+                slowest_voxels = sorted(slowest_voxels + get_slowest_voxels(
+                    fit_pd, telemetry_pd, datatype, get_model(datatype).independent_cols, group_cols,
+                    n_voxels=telemetry_slowest_voxels), key=lambda v: (v["fit_time"], v["nfev"]),
+                    reverse=True)[:telemetry_slowest_voxels]
+        if compare_cold_start and use_initial_values:
+            with optional_stage(run_report, "cold_start_fit", **labels, slc=slc):
+                start_time = time.time()
+                cold_start_fit_pd = get_measurement_estimates_for_data_by_group(data_pd, datatype,
+                                                                                group_cols=group_cols,
+                                                                                fit_engine=fit_engine,
+                                                                                n_workers=fit_workers)
+                cold_start_fit_cost = add_fit_costs(cold_start_fit_cost,
+                                                    summarize_fit_cost(cold_start_fit_pd, time.time() - start_time))
+        if run_shadow_fit:
+            slice_shadow_max_voxels = get_shadow_max_groups(shadow_max_voxels, fit_cost["wall_time"], shadow_time,
+                                                            shadow_voxels, time_budget=shadow_time_budget)
+            n_wanted = int(np.ceil(slice_fit_cost["num_voxels"] * shadow_fraction))
+            shadow_budget_limited |= slice_shadow_max_voxels < min(n_wanted, shadow_max_voxels or n_wanted)
+            if slice_shadow_max_voxels > 0:
+                with optional_stage(run_report, "shadow_fit", **labels, slc=slc) as stage:
+                    start_time = time.time()
+                    shadow_comparison_pd = get_shadow_comparison(data_pd, fit_pd, datatype, group_cols,
+                                                                 fraction=shadow_fraction,
+                                                                 max_groups=slice_shadow_max_voxels, rng=shadow_rng)
+                    shadow_comparison_pds.append(shadow_comparison_pd)
+                    shadow_time += time.time() - start_time
+                    shadow_voxels += len(shadow_comparison_pd)
+                    add_counts(stage, voxels=len(shadow_comparison_pd))
+        if keep_fits:
+            fit_pds[slc] = fit_pd
+        if save_slice is not None:
+            save_slice(slc, fit_pd)
+
+    # Report the fit cost for all slices
+    fit_summary = {"fit_cost": fit_cost}
+    print(f"Fit {fit_cost['num_voxels']} voxels for {' '.join([str(v) for v in labels.values()])} with "
+          f"{fit_cost['nfev']} solver evaluations in {fit_cost['wall_time']:.2f} s")
+    if cluster:
+        polish_str = f"fit the voxels again from them with {cluster_summary['polish_nfev']} solver evaluations" \
+            if cluster_polish else "assigned their fits to the voxels"
+        print(f"Fit {cluster_summary['num_clusters']} clusters of {cluster_summary['num_voxels']} voxels (tolerance "
+              f"{cluster_tolerance}) with {cluster_summary['representative_nfev']} solver evaluations, and "
+              f"{polish_str}")
+        fit_summary["clusters"] = {**cluster_summary, "tolerance": cluster_tolerance, "polish": cluster_polish}
+    if warm_start:
+        print(f"Started the fits of {warm_start_summary['num_voxels_with_prior']} of "
+              f"{warm_start_summary['num_voxels']} voxels from the prior fits")
+        fit_summary["warm_start"] = warm_start_summary
+    if compare_cold_start and use_initial_values:
+        fit_name = "Multiresolution fit" if multires_factors is not None else "Warm start fit" if warm_start else "Fit"
+        print_fit_cost_comparison(fit_name, fit_cost, "Single-level cold start fit", cold_start_fit_cost)
+        fit_summary["cold_start_fit_cost"] = cold_start_fit_cost
+    if fit_engine == "hybrid":
+        fit_summary["hybrid_fit"] = print_hybrid_fit_summary(hybrid_summary)
+
+    # Report how far the fit is from the validation fit of the sampled voxels
+    if run_shadow_fit:
+        shadow_comparison_pd = pd.concat(shadow_comparison_pds) if len(shadow_comparison_pds) > 0 \
+            else pd.DataFrame()
+        shadow_summary = summarize_shadow_comparison(shadow_comparison_pd, datatype, tolerance=shadow_tolerance,
+                                                     fit_time=fit_cost["wall_time"], shadow_time=shadow_time,
+                                                     time_budget=shadow_time_budget,
+                                                     budget_limited=shadow_budget_limited)
+        print_shadow_summary(shadow_summary)
+        fit_summary["shadow_fit"] = shadow_summary
+
+    # Report where the solver spent its time
+    if record_telemetry:
+        telemetry_pd = pd.concat(telemetry_pds, ignore_index=True) if len(telemetry_pds) > 0 else None
+        telemetry_summary = summarize_solver_telemetry(telemetry_pd, slowest_voxels,
+                                                       n_slowest_voxels=telemetry_slowest_voxels)
+        print_solver_telemetry(telemetry_summary, group_cols=group_cols)
+        fit_summary["solver_telemetry"] = telemetry_summary
+        fit_summary["solver_telemetry_pd"] = telemetry_pd
+    return fit_pds, fit_summary
+
+
+def fit_value_subsets(data_pd_dict, datatype, subsets, voxel_threshold=0.2, fit_engine="lmfit", fit_workers=1,
+                      save_slices=None, keep_fits=True, run_report=None, **labels):
+    """ Fit each slice of the data by voxel, limited to each subset of the values (as preprocess_data does with the
+    values to use) and masked as fit_slices does. The data of each slice is only summarized once for masking all
+    subsets, and with the batched fit engine, all subsets of a slice are fit in one pass of the vectorized solver.
+    If save_slices is given, save_slices[i] is called with the slice and its fits for subset i as soon as the slice is
+    fit. Returns the fits by slice of each subset (if keep_fits) and a summary of the fit cost of all subsets """
+    group_cols = get_fit_group_cols("voxel")
+    labels["datatype"] = datatype
+    with optional_stage(run_report, "value_tables", **labels) as stage:
+        value_tables = {slc: SliceValueTable(data_pd, datatype) for slc, data_pd in data_pd_dict.items()}
+        add_counts(stage, rows=int(np.sum([len(data_pd) for data_pd in data_pd_dict.values()])))
+    max_vals = get_subset_max_values(value_tables, subsets)
+    fit_pds_by_subset = [{} for _ in subsets]
+    fit_cost = summarize_fit_cost(pd.DataFrame(), 0)
+    for slc, data_pd in data_pd_dict.items():
+        print("Processing fit by voxel for slice", slc, "for", len(subsets), "subsets of values")
+        with optional_stage(run_report, "mask", **labels, slc=slc) as stage:
+            subset_data_pds = [get_masked_subset_data(data_pd, value_tables[slc], subset, max_val, voxel_threshold,
+                                                      group_cols=group_cols)
+                               for subset, max_val in zip(subsets, max_vals)]
+            add_counts(stage, rows_in=len(data_pd), rows_out=int(np.sum([len(d) for d in subset_data_pds])))
+        subset_idx = [idx for idx, subset_data_pd in enumerate(subset_data_pds) if len(subset_data_pd) > 0]
+        if len(subset_idx) == 0:
+            # Nothing to fit, continue
+            continue
+
+        # Fit the data of all subsets of this slice
+        with optional_stage(run_report, "fit", profile=True, **labels, slc=slc) as stage:
+            start_time = time.time()
+            fit_pds = get_measurement_estimates_for_data_subsets([subset_data_pds[idx] for idx in subset_idx],
+                                                                 datatype, group_cols, run_report=run_report,
+                                                                 fit_engine=fit_engine, n_workers=fit_workers)
+            wall_time = time.time() - start_time
+            for idx, fit_pd in zip(subset_idx, fit_pds):
+                slice_fit_cost = summarize_fit_cost(fit_pd, 0)
+                fit_cost = add_fit_costs(fit_cost, slice_fit_cost)
+                add_counts(stage, voxels=slice_fit_cost["num_voxels"], nfev=slice_fit_cost["nfev"])
+            fit_cost["wall_time"] += wall_time
+        for idx, fit_pd in zip(subset_idx, fit_pds):
+            if keep_fits:
+                fit_pds_by_subset[idx][slc] = fit_pd
+            if save_slices is not None:
+                save_slices[idx](slc, fit_pd)
+
+    print(f"Fit {fit_cost['num_voxels']} voxels of {len(subsets)} subsets of values for "
+          f"{' '.join([str(v) for v in labels.values()])} with {fit_cost['nfev']} solver evaluations in "
+          f"{fit_cost['wall_time']:.2f} s")
+    return fit_pds_by_subset, {"fit_cost": fit_cost}
+
+
+def fit_slices_by_thresholds(data_pd_dict, datatype, voxel_thresholds, max_val=None, fit_engine="lmfit",
+                             fit_workers=1, save_slices=None, keep_fits=True, run_report=None, **labels):
+    """ Fit each slice of the (preprocessed) data by voxel, masked as fit_slices does with each of the voxel
+    thresholds, while fitting each voxel once: the data of a slice is fit masked with the lowest threshold, which
+    keeps the voxels of all higher thresholds, and the fits for each higher threshold are the fits of the voxels it
+    keeps. Slices that are not masked for a threshold (as their max value is too low) are fit in full. If save_slices
+    is given, save_slices[i] is called with the slice and its fits for threshold i as soon as the slice is fit.
+    Returns the fits by slice for each threshold (if keep_fits) and a summary of the fit cost """
+    group_cols = get_fit_group_cols("voxel")
+    if max_val is None:
+        max_val = np.max([np.max(data_pd["data"]) for data_pd in data_pd_dict.values()])
+    labels["datatype"] = datatype
+    fit_pds_by_threshold = [{} for _ in voxel_thresholds]
+    fit_cost = summarize_fit_cost(pd.DataFrame(), 0)
+    for slc, data_pd in data_pd_dict.items():
+        print("Processing fit by voxel for slice", slc, "for voxel thresholds", voxel_thresholds)
+        slc_max_val = np.max(data_pd["data"])
+        masked = [slc_max_val > (np.min([0.1, voxel_threshold]) * max_val) for voxel_threshold in voxel_thresholds]
+        # Each fit of the slice, with the thresholds it is for
+        data_pds_to_fit = []
+        with optional_stage(run_report, "mask", **labels, slc=slc) as stage:
+            add_counts(stage, rows_in=len(data_pd))
+            if not all(masked):
+                # Masking adds a column to the data, so the full data is copied if the slice is also masked
+                data_pds_to_fit.append((data_pd.copy() if any(masked) else data_pd,
+                                        [idx for idx in range(len(masked)) if not masked[idx]]))
+            if any(masked):
+                lowest_threshold = np.min([t for t, is_masked in zip(voxel_thresholds, masked) if is_masked])
+                data_pds_to_fit.append((mask_slice(data_pd, max_val, lowest_threshold, group_cols),
+                                        [idx for idx in range(len(masked)) if masked[idx]]))
+            add_counts(stage, rows_out=int(np.sum([len(d) for d, _ in data_pds_to_fit])))
+
+        for fit_data_pd, threshold_idx in data_pds_to_fit:
+            if len(fit_data_pd) == 0:
+                # Nothing to fit, continue
+                continue
+            with optional_stage(run_report, "fit", profile=True, **labels, slc=slc) as stage:
+                start_time = time.time()
+                fit_pd = get_measurement_estimates_for_data_by_group(fit_data_pd, datatype, group_cols=group_cols,
+                                                                     run_report=run_report, fit_engine=fit_engine,
+                                                                     n_workers=fit_workers)
+                slice_fit_cost = summarize_fit_cost(fit_pd, time.time() - start_time)
+                fit_cost = add_fit_costs(fit_cost, slice_fit_cost)
+                add_counts(stage, rows=len(fit_data_pd), voxels=slice_fit_cost["num_voxels"],
+                           nfev=slice_fit_cost["nfev"])
+            for idx in threshold_idx:
+                threshold_fit_pd = fit_pd
+                if masked[idx] and (voxel_thresholds[idx] > lowest_threshold):
+                    with optional_stage(run_report, "limit_fits", **labels, slc=slc) as stage:
+                        threshold_fit_pd = limit_fits_to_threshold(fit_pd, fit_data_pd, slc_max_val,
+                                                                   voxel_thresholds[idx], group_cols)
+                        add_counts(stage, rows_in=len(fit_pd), rows_out=len(threshold_fit_pd))
+                if keep_fits:
+                    fit_pds_by_threshold[idx][slc] = threshold_fit_pd
+                if save_slices is not None:
+                    save_slices[idx](slc, threshold_fit_pd)
+
+    print(f"Fit {fit_cost['num_voxels']} voxels for {len(voxel_thresholds)} voxel thresholds for "
+          f"{' '.join([str(v) for v in labels.values()])} with {fit_cost['nfev']} solver evaluations in "
+          f"{fit_cost['wall_time']:.2f} s")
+    return fit_pds_by_threshold, {"fit_cost": fit_cost}
+
+
+def save_slice_fit(fit_pd, save_dir, slc, extra_str, columns_to_remove=default_columns_to_remove, run_report=None,
+                   **labels):
+    """ Save the fits of a slice. Returns the saved fits """
+    with optional_stage(run_report, "save", **labels, slc=slc) as stage:
+        fit_pd_to_save = get_fit_pd_to_save(fit_pd, columns_to_remove=list(columns_to_remove))
+        fit_pd_slc_filename = os.path.join(save_dir, f"fit_pd_{str(slc)}{extra_str}.csv")
+        with open(fit_pd_slc_filename, "w") as f:
+            fit_pd_to_save.to_csv(f, index=False)
+        add_counts(stage, rows=len(fit_pd_to_save), bytes_written=os.path.getsize(fit_pd_slc_filename))
+    return fit_pd_to_save
+
+
+def get_saved_data_values(saved_data_dir, datatype, dataset):
+    """ Get the values (e.g. inversion times) of the acquisitions of the saved data of a dataset, from its first
+    file """
+    filenames = get_saved_data_filenames(saved_data_dir, datatype, dataset)
+    filename = os.path.join(saved_data_dir, datatype, dataset, "raw.csv") if filenames is None else filenames[0]
+    value_col = get_limited_value_column(datatype)
+    return np.unique(pd.read_csv(filename, usecols=[value_col])[value_col]).tolist()
+
+
+def store_results(results_store, fit_pds_to_save, voxel_threshold, protocol_values, session_info,
+                  roi_statistics=None, fit_engine="lmfit", output_dir=None, run_report=None, **labels):
+    """ Store the summaries of the fits of all slices of a dataset (and of each ROI, if the ROI statistics are given)
+    in the results store, see get_fit_summaries. The labels must have the dataset and datatype """
+    dataset, datatype = labels["dataset"], labels["datatype"]
+    with optional_stage(run_report, "results_store", **labels) as stage:
+        summary_pd = get_fit_summaries(fit_pds_to_save, get_all_quantitative_variables(datatype),
+                                       roi_statistics=roi_statistics)
+        results_store.add_run(summary_pd, dataset, datatype, voxel_threshold, protocol_values,
+                              study_date=session_info.get("study_date", ""),
+                              protocol_name=session_info.get("protocol_name", ""), fit_engine=fit_engine,
+                              session=session_info.get("session", ""), output_dir=output_dir)
+        add_counts(stage, rows=len(summary_pd))
+    print(f"Stored the summaries of {dataset} {datatype} (study date {session_info.get('study_date') or 'unknown'}, "
+          f"fit engine {fit_engine}) in {results_store.filename}")
+
+
+def get_columns_to_remove(args):
+    """ Get the columns of the fits not to save. The solver evaluations of each voxel (nfev) are only saved with the
+    fits when they are compared (--compare-cold-start, --shadow-fraction) or recorded (--solver-telemetry) """
+    if args.compare_cold_start or (args.shadow_fraction is not None) or args.solver_telemetry:
+        return ("data",)
+    return default_columns_to_remove
+
+
+def make_save_dir(output_dir, datatype, dataset_name):
+    """ Make the directory to save the fits of a dataset in, and its images directory """
+    save_dir = os.path.join(output_dir, datatype, dataset_name)
+    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(os.path.join(save_dir, "images"), exist_ok=True)
+    return save_dir
+
+
+def get_roi_statistics(roi_label_map, datatype, roi_label_names=None):
+    """ Get the statistics to add the fits of each slice to, if a label map is given """
+    if roi_label_map is None:
+        return None
+    return ROIStatistics(roi_label_map, datatype=datatype, label_names=roi_label_names)
+
+
+def get_slice_saver(save_dir, extra_str, output_format, columns_to_remove=default_columns_to_remove,
+                    roi_statistics=None, run_report=None, **labels):
+    """ Get the function to save the fits of each slice with (see save_slice_fit) as soon as it is fit, which also
+    adds them to the ROI statistics if given, and the list it collects the saved fits of all slices in """
+    fit_pds_to_save = []
+    group_cols = get_fit_group_cols("voxel")
+
+    def save_slice(slc, fit_pd):
+        if output_format in ["csv", "both"]:
+            fit_pds_to_save.append(save_slice_fit(fit_pd, save_dir, slc, extra_str,
+                                                  columns_to_remove=columns_to_remove, run_report=run_report,
+                                                  **labels))
+        else:
+            # The maps are saved for all slices at once, so only keep one row per voxel
+            fit_pds_to_save.append(get_fit_pd_to_save(fit_pd, columns_to_remove=list(columns_to_remove),
+                                                      subset=group_cols))
+        if roi_statistics is not None:
+            with optional_stage(run_report, "roi_statistics", **labels, slc=slc):
+                roi_statistics.add_fits(fit_pds_to_save[-1])
+    return save_slice, fit_pds_to_save
+
+
+def save_roi_statistics(roi_statistics, save_dir, extra_str, run_report=None, **labels):
+    if roi_statistics is None:
+        return
+    with optional_stage(run_report, "roi_statistics", **labels) as stage:
+        roi_stats_filename = os.path.join(save_dir, f"roi_stats{extra_str}.csv")
+        roi_statistics.get_statistics().to_csv(roi_stats_filename, index=False)
+        print("Saved the statistics of each label to:", roi_stats_filename)
+        add_counts(stage, voxels=roi_statistics.num_voxels)
+
+
+def save_solver_telemetry(fit_summary, save_dir, extra_str, run_report=None, **labels):
+    """ Save the solver telemetry of each voxel and its summary """
+    with optional_stage(run_report, "save", **labels) as stage:
+        if fit_summary["solver_telemetry_pd"] is not None:
+            telemetry_filename = os.path.join(save_dir, f"solver_telemetry{extra_str}.csv")
+            fit_summary["solver_telemetry_pd"].to_csv(telemetry_filename, index=False)
+            add_counts(stage, rows=len(fit_summary["solver_telemetry_pd"]),
+                       bytes_written=os.path.getsize(telemetry_filename))
+        summary_filename = os.path.join(save_dir, f"solver_telemetry{extra_str}.json")
+        with open(summary_filename, "w") as f:
+            json.dump(fit_summary["solver_telemetry"], f, indent=2, default=to_json_value)
+        print("Saved the solver telemetry to:", summary_filename)
+
+
+def save_all_slice_fits(fit_pds_to_save, save_dir, extra_str, output_format, run_report=None, **labels):
+    """ Save the fits of all slices, as one csv file and/or parametric maps """
+    if len(fit_pds_to_save) == 0:
+        print("No voxels were fit, so no fits are saved in:", save_dir)
+        return
+    with optional_stage(run_report, "save", **labels) as stage:
+        fit_pds_to_save = pd.concat(fit_pds_to_save)
+        if output_format in ["csv", "both"]:
+            fit_pd_slc_filename = os.path.join(save_dir, f"fit_pd{extra_str}.csv")
+            with open(fit_pd_slc_filename, "w") as f:
+                fit_pds_to_save.to_csv(f, index=False)
+            add_counts(stage, rows=len(fit_pds_to_save), bytes_written=os.path.getsize(fit_pd_slc_filename))
+        if output_format in ["maps", "both"]:
+            fit_maps_filename = os.path.join(save_dir, f"fit_maps{extra_str}.npz")
+            save_parametric_maps(fit_pds_to_save, fit_maps_filename)
+            print("Saved parametric maps to:", fit_maps_filename)
+            add_counts(stage, rows=len(fit_pds_to_save), bytes_written=os.path.getsize(fit_maps_filename))
+
+
+def save_fit_images(fit_pds, save_dir, extra_str, image_workers=1, image_style="figure", image_mosaic=False,
+                    run_report=None, **labels):
+    """ Plot the fits of each slice, on the same colorbar scale. The datatype is taken from the labels of the run
+    report stage """
+    if len(fit_pds) == 0:
+        return
+    datatype = labels["datatype"]
+    # Only import the plotting code (matplotlib) when images are rendered
+    from plotter.fits import imshow_fits_by_slice
+    with optional_stage(run_report, "images", **labels):
+        fit_pds = pd.concat(fit_pds.values())
+        print("Saving plots on the same colorbar scale")
+        imshow_fits_by_slice(fit_pds, datatype, save_parent_dir=os.path.join(save_dir, "images"),
+                             filename_extension=extra_str, n_workers=image_workers, image_style=image_style,
+                             mosaic=image_mosaic)
+
+
 def main(args):
     ##########################################################################################
     # Get args
@@ -58,24 +863,68 @@ def main(args):
     output_dir = args.output_dir
     saved_data_dir = args.saved_data_dir
     save_fits = args.save_fits
+    image_workers = args.image_workers
+    image_style = args.image_style
+    image_mosaic = args.image_mosaic
     voxel_threshold = args.fit_by_voxel_threshold
+    output_format = args.output_format
     if len(datatypes_to_process) > 1 and (values_to_use is not None):
         raise Exception("Only one datatype can be given if datatype-values is specified!")
+    sweep = (args.sweep_subsets is not None) or (args.sweep_k is not None)
+    sweep_subsets = parse_values_subsets(args.sweep_subsets) if args.sweep_subsets is not None else None
+    voxel_thresholds = sorted(set(args.voxel_thresholds)) if args.voxel_thresholds is not None else None
+    if sweep or (voxel_thresholds is not None):
+        if (args.sweep_subsets is not None) and (len(datatypes_to_process) > 1):
+            raise Exception("Only one datatype can be given if sweep-subsets is specified!")
+        unsupported = [name for name, value in [("multiresolution-factors", args.multires_factors),
+                                                ("compare-cold-start", args.compare_cold_start),
+                                                ("shadow-fraction", args.shadow_fraction),
+                                                ("prefetch-slices", args.prefetch_slices > 0),
+                                                ("warm-start-fits", args.warm_start_fits),
+                                                ("solver-telemetry", args.solver_telemetry),
+                                                ("cluster-tolerance", args.cluster_tolerance is not None)] if value]
+        if sweep and (voxel_thresholds is not None):
+            unsupported.append("sweep-voxel-thresholds")
+        if (voxel_thresholds is not None) and (args.fit_engine == "hybrid"):
+            # The voxels that the hybrid fit engine refines depend on the other voxels of the slice
+            unsupported.append("fit-engine hybrid")
+        if len(unsupported) > 0:
+            raise Exception(f"Cannot sweep over subsets of values or voxel thresholds with: {', '.join(unsupported)}")
+    if args.plan and sweep:
+        raise Exception("Cannot plan a sweep over subsets of values, plan with --datatype-values for each subset")
+    if args.multires_factors is not None:
+        check_multiresolution_factors(args.multires_factors)
+    if (args.cluster_tolerance is not None) and ((args.multires_factors is not None) or
+                                                 (args.warm_start_fits is not None)):
+        raise Exception("Cannot fit clusters of voxels with multiresolution fits or from prior fits")
+    if (args.cluster_tolerance is not None) and (args.cluster_tolerance <= 0):
+        raise Exception(f"The cluster tolerance must be positive, got: {args.cluster_tolerance}")
+    prior_fit_pd = None
+    if args.warm_start_fits is not None:
+        if len(datatypes_to_process) > 1:
+            raise Exception("Only one datatype can be given if warm-start-fits is specified!")
+        if args.multires_factors is not None:
+            raise Exception("Cannot start multiresolution fits from the prior fits")
+        prior_fit_pd = load_prior_fits(args.warm_start_fits, datatypes_to_process[0])
+        print(f"Loaded the prior fits of {len(prior_fit_pd)} voxels from: {', '.join(args.warm_start_fits)}")
+    # Always set (or clear) the EPG cache directory, as it is kept by the module, e.g. between the jobs of a worker
+    set_epg_cache_dir(args.epg_cache_dir)
+    roi_label_map = load_label_map(args.roi_labels) if args.roi_labels is not None else None
+    roi_label_names = load_label_names(args.roi_label_names) if args.roi_label_names is not None else None
+    run_report = None
+    if args.run_report is not None:
+        run_report = RunReport("process_saved_data", filename=args.run_report, profile_dir=args.profile_dir)
+        run_report.add_info(args=vars(args))
+    memory_usage = MemoryUsage() if args.compact_dtypes else None
+    results_store = ResultsStore(args.results_store) if args.results_store is not None else None
+    study_date = format_study_date(args.study_date) if args.study_date is not None else None
 
     ##########################################################################################
     # Code
     # Set up formatting for saving data
     overall_extra_str = get_fit_by_str(fit_by, voxel_threshold)
     extra_str = overall_extra_str
-    values_extra_str = ""
-    if values_to_use is not None:
-        values_extra_str = f"_{'_'.join([str(m) for m in values_to_use])}"
-
-    # Get group by columns for fit
-    group_cols = get_fit_group_cols(fit_by)
-
-    # Never save fits if it's by voxel, and set up the other things
-    columns_to_remove = ["data"]
+    values_extra_str = get_values_str(values_to_use)
 
     exceptions = ""
     for datatype in datatypes_to_process:
@@ -84,86 +933,197 @@ def main(args):
                 exceptions += f"\n{os.path.join(saved_data_dir, datatype, dataset)} does not exist"
                 continue
 
+            # The session of the dataset (e.g. its study date), to store the results by
+            session_info = load_session_info(os.path.join(saved_data_dir, datatype, dataset))
+            if study_date is not None:
+                session_info["study_date"] = study_date
+            if (results_store is not None) and (session_info.get("study_date", "") == ""):
+                # Without a study date, the runs of a dataset are stored by the directory of its data
+                session_info["session"] = os.path.abspath(os.path.join(saved_data_dir, datatype, dataset))
+                print(f"Warning: no study date for {dataset} {datatype} (give one with --study-date), storing its "
+                      f"summaries by its session {session_info['session']}")
+            dataset_values = values_to_use if (results_store is None) or (values_to_use is not None) \
+                else get_saved_data_values(saved_data_dir, datatype, dataset)
+
+            if args.plan:
+                # Estimate the fit cost from the masks and a calibration fit, without fitting -------
+                data_pd_dict = load_saved_data(saved_data_dir, datatype, dataset, compact=args.compact_dtypes,
+                                               memory_usage=memory_usage, run_report=run_report)
+                data_pd_dict, max_val = preprocess_data(data_pd_dict, datatype, values_to_use=values_to_use,
+                                                        memory_usage=memory_usage, run_report=run_report,
+                                                        dataset=dataset)
+                plan_thresholds = voxel_thresholds if voxel_thresholds is not None else [voxel_threshold]
+                with optional_stage(run_report, "plan", dataset=dataset, datatype=datatype) as stage:
+                    plan_pd = get_fit_plan(data_pd_dict, plan_thresholds, max_val=max_val)
+                    sample_pd = sample_voxels_to_fit(data_pd_dict, np.min(plan_thresholds),
+                                                     args.plan_calibration_voxels, max_val=max_val,
+                                                     rng=np.random.default_rng(0))
+                    add_counts(stage, voxels=int(plan_pd["voxels"].sum()))
+                with optional_stage(run_report, "calibration_fit", dataset=dataset, datatype=datatype) as stage:
+                    calibration = calibrate_fit_time(sample_pd, datatype, get_fit_group_cols(fit_by),
+                                                     fit_engine=args.fit_engine, n_workers=args.fit_workers)
+                    add_counts(stage, voxels=calibration["num_voxels"])
+                plan_summary = summarize_fit_plan(plan_pd, calibration, keep_fits=save_fits)
+                print_fit_plan(plan_pd, plan_summary)
+                if args.multires_factors is not None:
+                    print("Note: the fit time is estimated for a single-level fit, not a multiresolution fit")
+                if run_report is not None:
+                    run_report.add_info(**{f"plan_{dataset}_{datatype}": plan_summary})
+                continue
+
+            if sweep or (voxel_thresholds is not None):
+                # Load the data once, and fit it for each subset of values or voxel threshold -------
+                data_pd_dict = load_saved_data(saved_data_dir, datatype, dataset, compact=args.compact_dtypes,
+                                               memory_usage=memory_usage, run_report=run_report)
+                if sweep:
+                    subsets = get_sweep_subsets(data_pd_dict, datatype, subsets=sweep_subsets, k=args.sweep_k,
+                                                values_to_use=values_to_use)
+                    print(f"Sweeping over {len(subsets)} subsets of values:",
+                          ", ".join([" ".join([str(m) for m in subset]) for subset in subsets]))
+                    # The save directory, suffix and run report labels of the fits of each subset
+                    outputs = [(make_save_dir(output_dir, datatype, f"{dataset}{get_values_str(subset)}"), extra_str,
+                                {"values": get_values_str(subset)[1:]}) for subset in subsets]
+                    fit_function = partial(fit_value_subsets, subsets=subsets, voxel_threshold=voxel_threshold)
+                else:
+                    data_pd_dict, max_val = preprocess_data(data_pd_dict, datatype, values_to_use=values_to_use,
+                                                            memory_usage=memory_usage, run_report=run_report,
+                                                            dataset=dataset)
+                    save_dir = make_save_dir(output_dir, datatype, f"{dataset}{values_extra_str}")
+                    outputs = [(save_dir, get_fit_by_str(fit_by, t), {"voxel_threshold": t})
+                               for t in voxel_thresholds]
+                    fit_function = partial(fit_slices_by_thresholds, voxel_thresholds=voxel_thresholds,
+                                           max_val=max_val)
+                all_roi_statistics = [get_roi_statistics(roi_label_map, datatype, roi_label_names) for _ in outputs]
+                savers = [get_slice_saver(save_dir, output_extra_str, output_format,
+                                          columns_to_remove=get_columns_to_remove(args),
+                                          roi_statistics=roi_statistics, run_report=run_report, dataset=dataset,
+                                          datatype=datatype, **output_labels)
+                          for (save_dir, output_extra_str, output_labels), roi_statistics
+                          in zip(outputs, all_roi_statistics)]
+                fit_pds_by_output, _ = fit_function(data_pd_dict, datatype,
+                                                    fit_engine=args.fit_engine,
+                                                    fit_workers=args.fit_workers,
+                                                    save_slices=[saver[0] for saver in savers],
+                                                    keep_fits=save_fits,
+                                                    run_report=run_report,
+                                                    dataset=dataset)
+                for (save_dir, output_extra_str, output_labels), (_, fit_pds_to_save), roi_statistics, fit_pds in \
+                        zip(outputs, savers, all_roi_statistics, fit_pds_by_output):
+                    labels = {"dataset": dataset, "datatype": datatype, **output_labels}
+                    save_roi_statistics(roi_statistics, save_dir, output_extra_str, run_report=run_report, **labels)
+                    save_all_slice_fits(fit_pds_to_save, save_dir, output_extra_str, output_format,
+                                        run_report=run_report, **labels)
+                    if results_store is not None:
+                        output_values = output_labels["values"].split("_") if "values" in output_labels \
+                            else dataset_values
+                        store_results(results_store, fit_pds_to_save,
+                                      output_labels.get("voxel_threshold", voxel_threshold), output_values,
+                                      session_info, roi_statistics=roi_statistics, fit_engine=args.fit_engine,
+                                      output_dir=save_dir, run_report=run_report, **labels)
+                    if save_fits:
+                        save_fit_images(fit_pds, save_dir, output_extra_str, image_workers=image_workers,
+                                        image_style=image_style, image_mosaic=image_mosaic, run_report=run_report,
+                                        **labels)
+                continue
+
             # Make save dir ---------------------------------------------------------------------
-            save_dir = os.path.join(output_dir, datatype, f"{dataset}{values_extra_str}")
-            os.makedirs(save_dir, exist_ok=True)
-            save_image_dir = os.path.join(save_dir, "images")
-            os.makedirs(save_image_dir, exist_ok=True)
-
-            # Load raw data ---------------------------------------------------------------------
-            data_pd_dict = {}
-            if os.path.exists(os.path.join(saved_data_dir, datatype, dataset, "raw.csv")):
-                print("WARNING: Using deprecated load method - loading raw.csv")
-                full_data_pd = pd.read_csv(os.path.join(saved_data_dir, datatype, dataset, "raw.csv"))
-                data_pd_dict = {}
-                for slc, data_pd in full_data_pd.groupby("slc"):
-                    data_pd_dict[slc] = data_pd
+            save_dir = make_save_dir(output_dir, datatype, f"{dataset}{values_extra_str}")
+
+            # Load raw data and preprocess before fitting ---------------------------------------
+            filenames = get_saved_data_filenames(saved_data_dir, datatype, dataset)
+            prefetch = (args.prefetch_slices > 0) and (filenames is not None)
+            if prefetch:
+                # Get the max value in a cheap first pass, and then load each slice as it is fit
+                max_val = get_saved_data_max_value(filenames, datatype, values_to_use=values_to_use,
+                                                   cache_dir=save_dir, run_report=run_report, dataset=dataset)
+                data_pd_dict = iterate_in_background(load_saved_slices(filenames, datatype, dataset,
+                                                                       values_to_use=values_to_use,
+                                                                       compact=args.compact_dtypes,
+                                                                       memory_usage=memory_usage,
+                                                                       run_report=run_report),
+                                                     depth=args.prefetch_slices)
             else:
-                filenames = glob.glob(os.path.join(saved_data_dir, datatype, dataset, "raw*.csv"))
-                filenames.sort()
-                for filename in filenames:
-                    print("Opening file", filename)
-                    data_pd = pd.read_csv(filename)
-                    slc = data_pd["slc"].values[0]
-                    data_pd_dict[slc] = data_pd
-
-            # Preprocess before fitting ----------------------------------------------------------
-            max_val = -1
-            for slc, data_pd in data_pd_dict.items():
-                # If limits are specified, limit the data_pd 
-                if values_to_use is not None:
-                    print("Fitting", datatype, "using limited values:", values_to_use)
-                    data_pd = get_limited_values(data_pd, datatype, values_to_use)
-                # Store the data and max value 
-                data_pd_dict[slc] = data_pd
-                max_val = np.max([max_val, np.max(data_pd["data"])])
-
-            # Fit by slice ---------------------------------------------------------------------
-            fit_pds = []
-            fit_pds_to_save = []
-            for slc, data_pd in data_pd_dict.items():
-                print("Processing fit by voxel for slice", slc)
-
-                # Only look at slices that have max val of at least 10% of total max val
-                slc_max_val = np.max(data_pd["data"])
-                if slc_max_val > (np.min([0.1, voxel_threshold]) * max_val):
-                    # Remove all groups that have any data that is exactly zero:
-                    data_pd = remove_groups_with_zeros(data_pd, group_cols=["slc", "x", "y"], data_col="data")
-                    # Only keep data that is above the voxel threshold:
-                    data_pd = limit_data_to_threshold(data_pd, slc_max_val, voxel_threshold)
-                    if len(data_pd) == 0:
-                        # Nothing to fit, continue
-                        continue
-
-                # Fit data for this slice
-                fit_pd = get_measurement_estimates_for_data_by_group(data_pd, datatype, group_cols=group_cols)
-                fit_pds.append(fit_pd)  # For plotting the images later
-                fit_pd_to_save = get_fit_pd_to_save(fit_pd, columns_to_remove=columns_to_remove)
-                fit_pds_to_save.append(fit_pd_to_save)
-
-                # Save the fits for this slice
-                fit_pd_slc_filename = os.path.join(save_dir, f"fit_pd_{str(slc)}{extra_str}.csv")
-                with open(fit_pd_slc_filename, "w") as f:
-                    fit_pd_to_save.to_csv(f, index=False)
-
-                # Plot the results for each slice
-                if save_fits:
-                    imshow_fits_by_slice(fit_pd, datatype, save_parent_dir=save_image_dir,
-                                        filename_extension=extra_str)
+                data_pd_dict = load_saved_data(saved_data_dir, datatype, dataset, compact=args.compact_dtypes,
+                                               memory_usage=memory_usage, run_report=run_report)
+                data_pd_dict, max_val = preprocess_data(data_pd_dict, datatype, values_to_use=values_to_use,
+                                                        memory_usage=memory_usage, run_report=run_report,
+                                                        dataset=dataset)
+
+            # Fit by slice, and save the fits for each slice as soon as it is fit ---------------
+            roi_statistics = get_roi_statistics(roi_label_map, datatype, roi_label_names)
+            save_slice, fit_pds_to_save = get_slice_saver(save_dir, extra_str, output_format,
+                                                          columns_to_remove=get_columns_to_remove(args),
+                                                          roi_statistics=roi_statistics, run_report=run_report,
+                                                          dataset=dataset, datatype=datatype)
+
+            # Save the fits of each slice in the background while the next slice is fit
+            writer = BackgroundWriter(save_slice, max_pending=args.prefetch_slices) if prefetch else None
+            fit_pds, fit_summary = fit_slices(data_pd_dict, datatype, max_val=max_val,
+                                              voxel_threshold=voxel_threshold,
+                                              multires_factors=args.multires_factors,
+                                              compare_cold_start=args.compare_cold_start,
+                                              shadow_fraction=args.shadow_fraction,
+                                              shadow_max_voxels=args.shadow_max_voxels,
+                                              shadow_time_budget=args.shadow_time_budget,
+                                              shadow_tolerance=args.shadow_tolerance,
+                                              shadow_seed=args.shadow_seed,
+                                              fit_engine=args.fit_engine,
+                                              fit_workers=args.fit_workers,
+                                              prior_fit_pd=prior_fit_pd,
+                                              warm_start_max_shift=args.warm_start_max_shift,
+                                              cluster_tolerance=args.cluster_tolerance,
+                                              cluster_polish=not args.cluster_assign,
+                                              record_telemetry=args.solver_telemetry,
+                                              telemetry_slowest_voxels=args.telemetry_slowest_voxels,
+                                              save_slice=save_slice if writer is None else writer.submit,
+                                              keep_fits=save_fits,  # For plotting the images later
+                                              memory_usage=memory_usage,
+                                              run_report=run_report,
+                                              dataset=dataset)
+            if writer is not None:
+                writer.close()
+            if "shadow_fit" in fit_summary:
+                shadow_filename = os.path.join(save_dir, f"shadow_fit{extra_str}.json")
+                with open(shadow_filename, "w") as f:
+                    json.dump(fit_summary["shadow_fit"], f, indent=2)
+                if run_report is not None:
+                    run_report.add_info(**{f"shadow_fit_{dataset}_{datatype}": fit_summary["shadow_fit"]})
+            if ("warm_start" in fit_summary) and (run_report is not None):
+                run_report.add_info(**{f"warm_start_{dataset}_{datatype}": fit_summary["warm_start"]})
+            if ("hybrid_fit" in fit_summary) and (run_report is not None):
+                run_report.add_info(**{f"hybrid_fit_{dataset}_{datatype}": fit_summary["hybrid_fit"]})
+            if ("clusters" in fit_summary) and (run_report is not None):
+                run_report.add_info(**{f"clusters_{dataset}_{datatype}": fit_summary["clusters"]})
+            if "solver_telemetry" in fit_summary:
+                save_solver_telemetry(fit_summary, save_dir, extra_str, run_report=run_report, dataset=dataset,
+                                      datatype=datatype)
+                if run_report is not None:
+                    run_report.add_info(**{f"solver_telemetry_{dataset}_{datatype}": fit_summary["solver_telemetry"]})
+            save_roi_statistics(roi_statistics, save_dir, extra_str, run_report=run_report, dataset=dataset,
+                                datatype=datatype)
 
             # Save the fits for all slices
-            fit_pds_to_save = pd.concat(fit_pds_to_save)
-            fit_pd_slc_filename = os.path.join(save_dir, f"fit_pd{extra_str}.csv")
-            with open(fit_pd_slc_filename, "w") as f:
-                fit_pds_to_save.to_csv(f, index=False)
+            save_all_slice_fits(fit_pds_to_save, save_dir, extra_str, output_format, run_report=run_report,
+                                dataset=dataset, datatype=datatype)
+            if results_store is not None:
+                store_results(results_store, fit_pds_to_save, voxel_threshold, dataset_values, session_info,
+                              roi_statistics=roi_statistics, fit_engine=args.fit_engine, output_dir=save_dir,
+                              run_report=run_report, dataset=dataset, datatype=datatype)
 
-            # Re-plot the results for each slice, to be on same colorbar scale
+            # Plot the results for each slice, on the same colorbar scale
             if save_fits:
-                fit_pds = pd.concat(fit_pds)
-                print("Resaving plots on the same colorbar scale")
-                imshow_fits_by_slice(fit_pds, datatype, save_parent_dir=save_image_dir,
-                                    filename_extension=extra_str)
+                save_fit_images(fit_pds, save_dir, extra_str, image_workers=image_workers,
+                                image_style=image_style, image_mosaic=image_mosaic, run_report=run_report,
+                                dataset=dataset, datatype=datatype)
 
+    if memory_usage is not None:
+        memory_usage.print()
+        if run_report is not None:
+            run_report.add_info(memory_usage=memory_usage.get_summary())
+    if results_store is not None:
+        results_store.close()
+    if run_report is not None:
+        run_report.save()
     print("\nFinished Processing Data!")
     if len(exceptions) > 0:
         print("\nNote, unable to process data for the following file and datatype combinations:")
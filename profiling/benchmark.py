@@ -0,0 +1,180 @@
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+from fitting.models import get_model
+from profiling.resources import get_path_bytes, run_command, start_peak_rss_window, stop_peak_rss_window
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_benchmark_metadata(parameters):
+    """ Get the information needed to tell whether two benchmark results are comparable """
+    metadata = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "parameters": parameters,
+    }
+    for package in ["numpy", "pandas", "scipy", "lmfit"]:
+        try:
+            metadata[package] = __import__(package).__version__
+        except ImportError:
+            metadata[package] = None
+    try:
+        metadata["git_commit"] = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir,
+                                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        metadata["git_commit"] = None
+    return metadata
+
+
+def add_throughput(result, n_voxels, n_bytes):
+    result["voxels"] = int(n_voxels)
+    result["bytes"] = int(n_bytes)
+    result["voxels_per_s"] = n_voxels / result["wall_time"] if result["wall_time"] > 0 else None
+    result["mb_per_s"] = n_bytes / 1e6 / result["wall_time"] if result["wall_time"] > 0 else None
+    return result
+
+
+def benchmark_stage(name, script, script_args, log_dir, n_voxels, input_paths, output_paths):
+    """ Time one pipeline script as a separate process, as it is run from the command line. Throughput is given by
+    the number of voxels processed and the number of bytes read and written """
+    print(f"Benchmarking {name}...")
+    command = [sys.executable, os.path.join(repo_dir, script)] + script_args
+    result = run_command(command, os.path.join(log_dir, f"{name}.log"), cwd=repo_dir)
+    n_bytes = get_path_bytes(input_paths) + get_path_bytes(output_paths)
+    return add_throughput(result, n_voxels, n_bytes)
+
+
+def benchmark_pipeline(work_dir, dataset, datatype, load_subdirs, load_data_extension, n_voxels,
+                       fit_by_voxel_threshold=0.2):
+    """ Time the preformat_data, save_data and process_saved_data stages on scans in <work_dir>/scans """
+    load_dir = os.path.join(work_dir, "scans", dataset, "dicom" if load_data_extension == ".dcm" else "fdf")
+    preformat_dir = os.path.join(work_dir, "benchmark", "preformat_data")
+    saved_data_dir = os.path.join(work_dir, "benchmark", "saved_data")
+    fit_dir = os.path.join(work_dir, "benchmark", "fit_data")
+    log_dir = os.path.join(work_dir, "benchmark", "logs", datatype)
+    os.makedirs(log_dir, exist_ok=True)
+
+    results = {}
+    results["preformat_data"] = benchmark_stage(
+        "preformat_data", "preformat_data.py",
+        ["--load-dir", load_dir, "--load-subdirs"] + load_subdirs +
+        ["--load-data-extension", load_data_extension, "--dataset", dataset, "--datatype", datatype,
+         "--output-dir", preformat_dir],
+        log_dir, n_voxels,
+        input_paths=[os.path.join(load_dir, d) for d in load_subdirs],
+        output_paths=os.path.join(preformat_dir, datatype, dataset))
+    results["save_data"] = benchmark_stage(
+        "save_data", "save_data.py",
+        ["--dataset", dataset, "--datatype", datatype, "--preformat-data-dir", preformat_dir,
+         "--output-dir", saved_data_dir],
+        log_dir, n_voxels,
+        input_paths=os.path.join(preformat_dir, datatype, dataset),
+        output_paths=os.path.join(saved_data_dir, datatype, dataset))
+    # For fitting, throughput is given by the number of fitted voxels
+    fit_output_dir = os.path.join(fit_dir, datatype, dataset)
+    results["process_saved_data"] = benchmark_stage(
+        "process_saved_data", "process_saved_data.py",
+        ["--dataset", dataset, "--datatype", datatype, "--fit-by-voxel-threshold", str(fit_by_voxel_threshold),
+         "--saved-data-dir", saved_data_dir, "--output-dir", fit_dir],
+        log_dir, 0,
+        input_paths=os.path.join(saved_data_dir, datatype, dataset),
+        output_paths=fit_output_dir)
+    fit_filenames = glob.glob(os.path.join(fit_output_dir, "fit_pd_*.csv"))
+    n_fitted_voxels = np.sum([len(pd.read_csv(f, usecols=["x", "y"]).drop_duplicates()) for f in fit_filenames])
+    add_throughput(results["process_saved_data"], n_fitted_voxels, results["process_saved_data"]["bytes"])
+    return results
+
+
+def benchmark_startup(module, log_dir, n_repeats=5, heavy_modules=("matplotlib", "seaborn", "lmfit", "scipy")):
+    """ Time starting an interpreter and importing a pipeline script (without running it), as paid by each command
+    line call. The median over n_repeats is reported, along with the heavy modules that the import loaded """
+    print(f"Benchmarking startup of {module}...")
+    log_filename = os.path.join(log_dir, f"startup_{module}.log")
+    code = f"import sys; import {module}; print(' '.join([m for m in {list(heavy_modules)} if m in sys.modules]))"
+    results = [run_command([sys.executable, "-c", code], log_filename, cwd=repo_dir) for _ in range(n_repeats)]
+    with open(log_filename, "r") as f:
+        loaded_modules = f.read().split()
+    return {"wall_time": float(np.median([r["wall_time"] for r in results])),
+            "min_wall_time": float(np.min([r["wall_time"] for r in results])),
+            "cpu_time": None if results[0]["cpu_time"] is None else float(np.median([r["cpu_time"] for r in results])),
+            "peak_rss_mb": results[0]["peak_rss_mb"],
+            "repeats": n_repeats,
+            "loaded_modules": loaded_modules}
+
+
+def get_voxel_groups(data_pd, n_voxels, seed=0):
+    """ Get the data of n_voxels randomly sampled voxels that are above 20 % of the maximum signal """
+    max_by_voxel = data_pd.groupby(["slc", "x", "y"])["data"].max()
+    voxels = max_by_voxel[max_by_voxel > 0.2 * max_by_voxel.max()].index
+    rng = np.random.default_rng(seed)
+    voxels = voxels[rng.permutation(len(voxels))[:n_voxels]]
+    grouped_pd = data_pd.set_index(["slc", "x", "y"]).sort_index()
+    return [grouped_pd.loc[[voxel]].reset_index() for voxel in voxels]
+
+
+def benchmark_estimator(data_pd, datatype, n_voxels, seed=0):
+    """ Time individual lmfit fits (estimate_T1 or estimate_T2 calls) of the model of the datatype on sampled voxels """
+    model = get_model(datatype)
+    if model.estimate_group is None:
+        raise Exception(f"The model for datatype {datatype} cannot be fit with lmfit")
+    groups = get_voxel_groups(data_pd, n_voxels, seed=seed)
+    print(f"Benchmarking {len(groups)} estimate_{datatype.upper()} calls...")
+    peak_rss_window = start_peak_rss_window()
+    start_time = time.perf_counter()
+    start_cpu_time = time.process_time()
+    nfev = 0
+    for group in groups:
+        output, _ = model.estimate_group(group)
+        nfev += output.nfev
+    result = {"wall_time": time.perf_counter() - start_time,
+              "cpu_time": time.process_time() - start_cpu_time,
+              "peak_rss_mb": stop_peak_rss_window(peak_rss_window),
+              "nfev": int(nfev)}
+    n_bytes = np.sum([group.memory_usage(deep=True).sum() for group in groups])
+    return add_throughput(result, len(groups), n_bytes)
+
+
+def compare_benchmark_results(results, baseline_results, tolerance=0.2, metrics=("wall_time", "peak_rss_mb")):
+    """ Compare results against baseline results, and return the benchmarks that regressed by more than tolerance
+    (as a fraction of the baseline value) """
+    regressions = []
+    print("\nComparison against baseline:")
+    for datatype, datatype_results in results["results"].items():
+        for name, result in datatype_results.items():
+            baseline_result = baseline_results["results"].get(datatype, {}).get(name)
+            if baseline_result is None:
+                continue
+            for metric in metrics:
+                value = result.get(metric)
+                baseline_value = baseline_result.get(metric)
+                if (value is None) or (baseline_value is None) or (baseline_value == 0):
+                    continue
+                ratio = value / baseline_value
+                flag = ""
+                if ratio > 1 + tolerance:
+                    flag = "  <-- REGRESSION"
+                    regressions.append({"datatype": datatype, "benchmark": name, "metric": metric,
+                                        "value": value, "baseline_value": baseline_value, "ratio": ratio})
+                print(f"\t{datatype} {name} {metric}: {value:.3f} vs {baseline_value:.3f} ({ratio:.2f}x){flag}")
+    return regressions
+
+
+def save_benchmark_results(results, filename):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_benchmark_results(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not reported
+    resource = None
+
+
+def maxrss_to_mb(maxrss):
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return maxrss / 1024 / 1024
+    return maxrss / 1024
+
+
+# Peak memory of the open peak memory windows (see start_peak_rss_window) up to the last reset of the peak memory
+# of the process, and the peak memory of the process before it was first reset
+_peak_rss_lock = threading.Lock()
+_peak_rss_windows = {}
+_reset_peak_rss_mb = 0.
+
+
+def get_proc_status_mb(field):
+    """ Get a memory field (e.g. VmRSS, VmHWM) of this process from /proc/self/status, in MB, or None if it is not
+    available (e.g. on macOS or Windows) """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """ Reset the peak resident memory of this process (VmHWM, and ru_maxrss) to its current resident memory. Only
+    possible on Linux, returns whether it was reset """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    """ Get the peak resident memory of this process so far, in MB """
+    if resource is None:
+        return None
+    with _peak_rss_lock:
+        return max(_reset_peak_rss_mb, maxrss_to_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+                   get_proc_status_mb("VmHWM") or 0.)
+
+
+def start_peak_rss_window():
+    """ Start measuring the peak resident memory of this process from now on, e.g. during a stage of a run, rather
+    than since the process started. The peak memory of the process is reset, after adding it to the other open
+    windows, so windows can be nested and overlap (e.g. stages in other threads). Returns the window to pass to
+    stop_peak_rss_window, or None if the peak memory cannot be reset (it is then only known for the whole process) """
+    global _reset_peak_rss_mb
+    with _peak_rss_lock:
+        peak_rss_mb = get_proc_status_mb("VmHWM")
+        if peak_rss_mb is None:
+            return None
+        for window, window_peak_rss_mb in _peak_rss_windows.items():
+            _peak_rss_windows[window] = max(window_peak_rss_mb, peak_rss_mb)
+        _reset_peak_rss_mb = max(_reset_peak_rss_mb, peak_rss_mb)
+        if not reset_peak_rss():
+            return None
+        window = object()
+        _peak_rss_windows[window] = get_proc_status_mb("VmRSS")
+        return window
+
+
+def stop_peak_rss_window(window):
+    """ Get the peak resident memory of this process since the window started, in MB """
+    if window is None:
+        return None
+    with _peak_rss_lock:
+        return max(_peak_rss_windows.pop(window), get_proc_status_mb("VmHWM"))
+
+
+def get_path_bytes(paths):
+    """ Get the total size of the given files, or of all files under the given directories """
+    if isinstance(paths, str):
+        paths = [paths]
+    n_bytes = 0
+    for path in paths:
+        if os.path.isfile(path):
+            n_bytes += os.path.getsize(path)
+        for parent_dir, _, filenames in os.walk(path):
+            n_bytes += sum([os.path.getsize(os.path.join(parent_dir, f)) for f in filenames])
+    return n_bytes
+
+
+def wait_for_command(command, rusage_filename):
+    """ Run a command and write its wall time, CPU time and peak memory to rusage_filename as json. This is run in a
+    small helper process (see run_command): on Linux, a child's peak memory (ru_maxrss) starts from that of the
+    process it was started from, so a command started by a process that has allocated a lot of memory (e.g. a
+    benchmark driver) would report that process's peak instead of its own """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command)
+    _, status, rusage = os.wait4(process.pid, 0)
+    with open(rusage_filename, "w") as f:
+        json.dump({"returncode": os.waitstatus_to_exitcode(status),
+                   "wall_time": time.perf_counter() - start_time,
+                   "cpu_time": rusage.ru_utime + rusage.ru_stime,
+                   "peak_rss_mb": maxrss_to_mb(rusage.ru_maxrss)}, f)
+
+
+def run_command(command, log_filename, cwd=None):
+    """ Run a command, logging its output to log_filename, and measure its wall time, CPU time and peak memory. The
+    command is started from a helper process that has not allocated much memory (see wait_for_command), so its peak
+    memory is its own (at least that of a bare interpreter, about 10 MB) """
+    start_time = time.perf_counter()
+    with open(log_filename, "w") as log_file:
+        if hasattr(os, "wait4"):
+            rusage_fd, rusage_filename = tempfile.mkstemp(suffix=".json")
+            os.close(rusage_fd)
+            try:
+                returncode = subprocess.call([sys.executable, os.path.abspath(__file__), rusage_filename] + command,
+                                             cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT)
+                if returncode == 0:
+                    with open(rusage_filename, "r") as f:
+                        result = json.load(f)
+                    returncode = result.pop("returncode")
+            finally:
+                os.remove(rusage_filename)
+        else:
+            returncode = subprocess.call(command, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT)
+            result = {"wall_time": time.perf_counter() - start_time, "cpu_time": None, "peak_rss_mb": None}
+    if returncode != 0:
+        raise Exception(f"Command failed with return code {returncode}, see {log_filename}: {' '.join(command)}")
+    return result
+
+
+if __name__ == '__main__':
+    # Helper process of run_command: resources.py <rusage_filename> <command...>
+    wait_for_command(sys.argv[2:], sys.argv[1])
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from profiling.resources import get_peak_rss_mb, get_proc_status_mb, start_peak_rss_window, stop_peak_rss_window
+
+
+class RunReport:
+    ''' Records wall/CPU time, counters (rows, voxels, bytes read/written) and peak memory for each stage of a run,
+    and optionally profiles hot sections with cProfile '''
+
+    def __init__(self, name, filename=None, profile_dir=None):
+        self.name = name
+        self.filename = filename
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.start_time = time.perf_counter()
+        self.start_cpu_time = time.process_time()
+        self.info = {}
+        # Labels of the enclosing stages of each thread, so nested stages (e.g. the fit of a slice) are labelled
+        # with them too
+        self._thread_local = threading.local()
+        self._profiling = False
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+
+    @property
+    def _label_stack(self):
+        if not hasattr(self._thread_local, "label_stack"):
+            self._thread_local.label_stack = []
+        return self._thread_local.label_stack
+
+    @contextmanager
+    def stage(self, name, profile=False, **labels):
+        """ Record a stage. Labels (e.g. dataset, datatype, slc) identify the stage, and counters can be added to the
+        yielded stage with add_counts while it runs. If profile is given and there is a profile directory, the stage
+        is profiled with cProfile. The peak memory of a stage (peak_rss_mb) is the peak resident memory of the process
+        while the stage ran, and rss_delta_mb the resident memory it added (both None where they cannot be measured,
+        e.g. on macOS). process_peak_rss_mb is the peak memory of the process since it started, when the stage
+        finished, so it is cumulative over the stages """
+        stage = {"stage": name}
+        if len(self._label_stack) > 0:
+            stage.update(self._label_stack[-1])
+        stage.update(labels)
+        stage["counts"] = {}
+        stage_labels = {k: v for k, v in stage.items() if k not in ["stage", "counts"]}
+        self._label_stack.append(stage_labels)
+        profiler = None
+        if profile and (self.profile_dir is not None) and (not self._profiling):
+            # Only one stage can be profiled at a time, so stages nested in a profiled stage are part of its profile
+            profiler = cProfile.Profile()
+            self._profiling = True
+        peak_rss_window = start_peak_rss_window()
+        start_rss_mb = get_proc_status_mb("VmRSS")
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            self._label_stack.pop()
+            stage["wall_time"] = time.perf_counter() - start_time
+            stage["cpu_time"] = time.process_time() - start_cpu_time
+            stage["peak_rss_mb"] = stop_peak_rss_window(peak_rss_window)
+            end_rss_mb = get_proc_status_mb("VmRSS")
+            stage["rss_delta_mb"] = end_rss_mb - start_rss_mb if (start_rss_mb is not None) and \
+                (end_rss_mb is not None) else None
+            stage["process_peak_rss_mb"] = get_peak_rss_mb()
+            if profiler is not None:
+                stage["profile"] = self.save_profile(profiler, name, stage_labels)
+            self.stages.append(stage)
+
+    def save_profile(self, profiler, name, labels):
+        """ Save the cProfile stats of a stage (to view with e.g. snakeviz), and a text summary of the top functions """
+        basename = "_".join([self.name, name] + [str(v) for v in labels.values()])
+        basename = os.path.join(self.profile_dir, basename)
+        profiler.dump_stats(basename + ".prof")
+        with open(basename + ".txt", "w") as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(30)
+        return basename + ".prof"
+
+    def add_info(self, **info):
+        self.info.update(info)
+
+    def get_summary(self):
+        """ Sum the times and counters of all stages with the same name, with the largest peak memory of any of them """
+        summary = {}
+        for stage in self.stages:
+            stage_summary = summary.setdefault(stage["stage"], {"calls": 0, "wall_time": 0., "cpu_time": 0.,
+                                                               "peak_rss_mb": None, "counts": {}})
+            stage_summary["calls"] += 1
+            if stage["peak_rss_mb"] is not None:
+                stage_summary["peak_rss_mb"] = max(stage_summary["peak_rss_mb"] or 0., stage["peak_rss_mb"])
+            stage_summary["wall_time"] += stage["wall_time"]
+            stage_summary["cpu_time"] += stage["cpu_time"]
+            for k, v in stage["counts"].items():
+                stage_summary["counts"][k] = stage_summary["counts"].get(k, 0) + v
+        return summary
+
+    def get_report(self):
+        return {
+            "name": self.name,
+            "wall_time": time.perf_counter() - self.start_time,
+            "cpu_time": time.process_time() - self.start_cpu_time,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "info": self.info,
+            "summary": self.get_summary(),
+            "stages": self.stages,
+        }
+
+    def save(self, filename=None):
+        """ Save the report as JSON, if a filename is given here or when creating the report """
+        filename = filename if filename is not None else self.filename
+        if filename is None:
+            return None
+        report = self.get_report()
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2, default=to_json_value)
+        peak_memory = "unknown" if report["peak_rss_mb"] is None else f"{report['peak_rss_mb']:.1f} MB"
+        print(f"Saved run report ({report['wall_time']:.2f} s, peak memory {peak_memory}) to:", filename)
+        return filename
+
+
+def to_json_value(value):
+    """ Convert numpy scalars and other values that json can't serialize """
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def add_counts(stage, **counts):
+    """ Add counters (e.g. rows, voxels, bytes_read, bytes_written) to a stage """
+    if stage is None:
+        return
+    for k, v in counts.items():
+        stage["counts"][k] = stage["counts"].get(k, 0) + (v.item() if hasattr(v, "item") else v)
+
+
+def add_labels(stage, **labels):
+    """ Add labels (e.g. slc) to a stage, once they are known """
+    if stage is None:
+        return
+    stage.update(labels)
+
+
+@contextmanager
+def optional_stage(run_report, name, profile=False, **labels):
+    """ Record a stage if there is a run report, otherwise just run the code """
+    if run_report is None:
+        yield None
+    else:
+        with run_report.stage(name, profile=profile, **labels) as stage:
+            yield stage
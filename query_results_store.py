@@ -0,0 +1,115 @@
+import sys
+import time
+import argparse
+import pandas as pd
+from fitting.constants import get_quantitative_variable
+from utils_io.results_store import ResultsStore, get_control_limits, summary_levels, statistics_cols
+
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Query the trend of a fitted quantity over the sessions stored in a '
+                                                 'results store by process_saved_data.py, with control limits.')
+    parser.add_argument('--results-store',
+                        dest='results_store', type=str, action='store', required=True,
+                        help='SQLite results store, as given to process_saved_data.py with --results-store')
+    parser.add_argument('--datatype',
+                        dest='datatype', type=str, action='store', required=True,
+                        choices=["t1", "t2", "t2_epg", "t2_map", "adc"],
+                        help='Type of data to query')
+    parser.add_argument('--quantity',
+                        dest='quantity', type=str, action='store',
+                        help='(Optional) Fitted quantity to query (e.g. Si). The default value is the quantitative '
+                             'value of the datatype (e.g. T1)')
+    parser.add_argument('--level',
+                        dest='level', type=str, default="dataset", action='store', choices=summary_levels,
+                        help='(Optional) Summaries to query: of all voxels of each dataset, of each slice, or of each '
+                             'ROI (if the fits were stored with --roi-labels). The default value is dataset')
+    parser.add_argument('--dataset',
+                        dest='datasets', type=str, nargs="+", action='store',
+                        help='(Optional) Datasets to query. By default, all datasets are queried')
+    parser.add_argument('--roi-label',
+                        dest='roi_label', type=int, action='store',
+                        help='(Optional) ROI label to query, with --level roi. By default, all ROIs are queried')
+    parser.add_argument('--slc',
+                        dest='slc', type=int, action='store',
+                        help='(Optional) Slice to query, with --level slice. By default, all slices are queried')
+    parser.add_argument('--protocol-values',
+                        dest='protocol_values', type=float, nargs="+", action='store',
+                        help='(Optional) Only query the fits of these values (e.g. inversion times), as given to '
+                             'process_saved_data.py with --datatype-values, or of all values of the data')
+    parser.add_argument('--start-date',
+                        dest='start_date', type=str, action='store',
+                        help='(Optional) First study date to query (YYYY-MM-DD or YYYYMMDD)')
+    parser.add_argument('--end-date',
+                        dest='end_date', type=str, action='store',
+                        help='(Optional) Last study date to query (YYYY-MM-DD or YYYYMMDD)')
+    parser.add_argument('--voxel-threshold',
+                        dest='voxel_threshold', type=float, action='store',
+                        help='(Optional) Only query the fits with this voxel threshold')
+    parser.add_argument('--fit-engine',
+                        dest='fit_engine', type=str, action='store',
+                        help='(Optional) Only query the fits of this fit engine (e.g. lmfit), as given to '
+                             'process_saved_data.py with --fit-engine')
+    parser.add_argument('--statistic',
+                        dest='statistic', type=str, default="median", action='store',
+                        choices=[c for c in statistics_cols if not c.startswith("num_")],
+                        help='(Optional) Statistic of the quantity to get control limits of. The default value is '
+                             'median')
+    parser.add_argument('--baseline-runs',
+                        dest='baseline_runs', type=int, action='store',
+                        help='(Optional) Number of the first runs (by study date) of each series (e.g. of each ROI) '
+                             'to get the center line and standard deviation of the control limits from. By default, '
+                             'all runs are used')
+    parser.add_argument('--n-sigma',
+                        dest='n_sigma', type=float, default=3., action='store',
+                        help='(Optional) Number of standard deviations of the control limits from the center line. '
+                             'The default value is 3')
+    parser.add_argument('--output',
+                        dest='output', type=str, action='store',
+                        help='(Optional) csv file to save the trend with its control limits to')
+    return parser.parse_args(args)
+
+
+def get_trend_with_control_limits(trend_pd, statistic="median", n_baseline=None, n_sigma=3.):
+    """ Get the control limits of each series (the summaries of each ROI or slice, with the same protocol values and
+    fit engine) of a trend, see get_control_limits """
+    series_cols = ["protocol_values", "fit_engine"] + [c for c in ["roi_label", "slc"] if trend_pd[c].notna().any()]
+    return pd.concat([get_control_limits(series_pd, statistic=statistic, n_baseline=n_baseline, n_sigma=n_sigma)
+                      for _, series_pd in trend_pd.groupby(series_cols, sort=True)], ignore_index=True)
+
+
+def main(args):
+    quantity = args.quantity if args.quantity is not None else get_quantitative_variable(args.datatype)
+    with ResultsStore(args.results_store) as results_store:
+        start_time = time.perf_counter()
+        trend_pd = results_store.get_trend(args.datatype, quantity, level=args.level, datasets=args.datasets,
+                                           roi_label=args.roi_label, slc=args.slc,
+                                           protocol_values=args.protocol_values, start_date=args.start_date,
+                                           end_date=args.end_date, voxel_threshold=args.voxel_threshold,
+                                           fit_engine=args.fit_engine)
+        query_time = time.perf_counter() - start_time
+    if len(trend_pd) == 0:
+        print(f"No {args.level} summaries of {quantity} found for {args.datatype} in {args.results_store}")
+        return trend_pd
+    trend_pd = get_trend_with_control_limits(trend_pd, statistic=args.statistic, n_baseline=args.baseline_runs,
+                                             n_sigma=args.n_sigma)
+    print(f"Found {len(trend_pd)} {args.level} summaries of {quantity} in {query_time * 1000:.1f} ms")
+    display_cols = ["study_date"] + (["session"] if (trend_pd["study_date"] == "").any() else []) + \
+        ["dataset", "protocol_values", "fit_engine"] + \
+        [c for c in ["slc", "roi_label", "roi_name"] if trend_pd[c].notna().any()] + \
+        ["num_valid", args.statistic, "lower_limit", "upper_limit", "out_of_control"]
+    print(trend_pd[display_cols].to_string(index=False))
+    n_out_of_control = int(trend_pd["out_of_control"].sum())
+    if n_out_of_control > 0:
+        print(f"\n{n_out_of_control} summaries are outside the control limits (+/- {args.n_sigma} standard "
+              f"deviations)")
+    if args.output is not None:
+        trend_pd.to_csv(args.output, index=False)
+        print("Saved the trend to:", args.output)
+    return trend_pd
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)
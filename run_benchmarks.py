@@ -0,0 +1,121 @@
+import os
+import glob
+import argparse
+import sys
+import pandas as pd
+from generate_synthetic_data import generate_synthetic_data
+from profiling.benchmark import get_benchmark_metadata, benchmark_pipeline, benchmark_estimator, \
+    benchmark_startup, compare_benchmark_results, save_benchmark_results, load_benchmark_results
+
+startup_modules = ["preformat_data", "save_data", "process_saved_data"]
+
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages and quantitative fits on a synthetic '
+                                                 'phantom dataset.')
+    parser.add_argument('--work-dir',
+                        dest='work_dir', action='store', required=True,
+                        help='Directory to generate the synthetic data and run the pipeline in')
+    parser.add_argument('--datatype',
+                        dest='datatypes', type=str, nargs="+", default=["t1", "t2"], action='store',
+                        choices=["t1", "t2"],
+                        help='(Optional) Type(s) of data to benchmark. The defaults are t1 and t2')
+    parser.add_argument('--matrix-size',
+                        dest='matrix_size', type=int, default=64, action='store',
+                        help='(Optional) In-plane matrix size of the synthetic data. The default value is 64')
+    parser.add_argument('--slices',
+                        dest='n_slices', type=int, default=4, action='store',
+                        help='(Optional) Number of slices of the synthetic data. The default value is 4')
+    parser.add_argument('--noise-sigma',
+                        dest='noise_sigma', type=float, default=10., action='store',
+                        help='(Optional) Noise standard deviation of the synthetic data. The default value is 10')
+    parser.add_argument('--load-data-extension',
+                        dest='load_data_extension', type=str, default=".dcm", action='store', choices=[".dcm", ".fdf"],
+                        help='(Optional) Scan format to benchmark the pre-format step with. The default is .dcm')
+    parser.add_argument('--fit-by-voxel-threshold',
+                        dest='fit_by_voxel_threshold', type=float, default=0.2, action='store',
+                        help='(Optional) Threshold to mask the data by when fitting. The default value is 0.2')
+    parser.add_argument('--estimator-voxels',
+                        dest='estimator_voxels', type=int, default=200, action='store',
+                        help='(Optional) Number of voxels to time individual estimate_T1/estimate_T2 calls on. '
+                             'The default value is 200')
+    parser.add_argument('--skip-pipeline',
+                        dest='skip_pipeline', default=False, action='store_true',
+                        help='(Optional) Only benchmark the estimate_T1/estimate_T2 calls')
+    parser.add_argument('--startup-repeats',
+                        dest='startup_repeats', type=int, default=5, action='store',
+                        help='(Optional) Number of times to time the startup (interpreter start and imports) of each '
+                             'pipeline script. Set to 0 to skip. The default value is 5')
+    parser.add_argument('--output',
+                        dest='output', action='store',
+                        help='(Optional) JSON file to store the results in. The default is '
+                             '<work-dir>/benchmark_results.json')
+    parser.add_argument('--compare',
+                        dest='baseline', action='store',
+                        help='(Optional) JSON file of baseline results to compare the results against')
+    parser.add_argument('--regression-tolerance',
+                        dest='regression_tolerance', type=float, default=0.2, action='store',
+                        help='(Optional) Fractional increase in wall time or peak memory over the baseline that is '
+                             'reported as a regression. The default value is 0.2')
+    return parser.parse_args(args)
+
+
+def main(args):
+    output = args.output
+    if output is None:
+        output = os.path.join(args.work_dir, "benchmark_results.json")
+    dataset = "synthetic_benchmark"
+    file_format = "dicom" if args.load_data_extension == ".dcm" else "fdf"
+    results = {"metadata": get_benchmark_metadata(vars(args)), "results": {}}
+
+    if args.startup_repeats > 0:
+        print("\n----------------start startup benchmark-----------------")
+        log_dir = os.path.join(args.work_dir, "benchmark", "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        startup_results = {module: benchmark_startup(module, log_dir, n_repeats=args.startup_repeats)
+                           for module in startup_modules}
+        results["results"]["startup"] = startup_results
+        for module, result in startup_results.items():
+            print(f"\t{module}: {result['wall_time']:.2f} s (min {result['min_wall_time']:.2f} s), loads "
+                  f"{' '.join(result['loaded_modules']) if len(result['loaded_modules']) > 0 else 'no heavy modules'}")
+        print("----------------end startup benchmark-----------------")
+
+    for datatype in args.datatypes:
+        print(f"\n----------------start {datatype} benchmark-----------------")
+        load_subdirs, _ = generate_synthetic_data(dataset, datatype, args.work_dir, matrix_size=args.matrix_size,
+                                                  n_slices=args.n_slices, noise_sigma=args.noise_sigma,
+                                                  formats=[file_format, "csv"])
+        n_voxels = args.matrix_size * args.matrix_size * args.n_slices
+        datatype_results = {}
+        if not args.skip_pipeline:
+            datatype_results = benchmark_pipeline(args.work_dir, dataset, datatype, load_subdirs,
+                                                  args.load_data_extension, n_voxels,
+                                                  fit_by_voxel_threshold=args.fit_by_voxel_threshold)
+
+        filenames = glob.glob(os.path.join(args.work_dir, "preformat_data", datatype, dataset, "raw_*.csv"))
+        data_pd = pd.concat([pd.read_csv(f) for f in filenames])
+        datatype_results[f"estimate_{datatype.upper()}"] = benchmark_estimator(data_pd, datatype,
+                                                                               args.estimator_voxels)
+        results["results"][datatype] = datatype_results
+
+        for name, result in datatype_results.items():
+            peak_memory = "unknown" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.1f} MB"
+            print(f"\t{name}: {result['wall_time']:.2f} s, {result['voxels_per_s']:.1f} voxels/s, "
+                  f"{result['mb_per_s']:.2f} MB/s, peak memory {peak_memory}")
+        print(f"----------------end {datatype} benchmark-----------------")
+
+    save_benchmark_results(results, output)
+    print("\nSaved benchmark results to:", output)
+
+    if args.baseline is not None:
+        regressions = compare_benchmark_results(results, load_benchmark_results(args.baseline),
+                                                tolerance=args.regression_tolerance)
+        if len(regressions) > 0:
+            print(f"\nNote, found {len(regressions)} regression(s) of more than "
+                  f"{100 * args.regression_tolerance:.0f} %")
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)
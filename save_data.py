@@ -1,83 +1,164 @@
 import os
 import glob
+import shutil
+import sys
 import pandas as pd
 from plotter.data import plot_data_by_scan_params
 import argparse
+from profiling.run_report import RunReport, optional_stage, add_counts
+from utils_io.compact_dtypes import read_compact_csv, MemoryUsage
+from utils_io.results_store import session_info_filename
 
-##########################################################################################
-# Input arguments
-
-parser = argparse.ArgumentParser(description='Save raw MRI data into CSV format.')
-parser.add_argument('--dataset', dest='dataset',
-                    type=str, action='store', required=True, nargs="+",
-                    help='Dataset name(s) - data will be loaded and saved with this name')
-parser.add_argument('--datatype', dest='datatype',
-                    type=str, action='store', nargs="+", required=True,
-                    choices=["t1", "t2", "t2_map"],
-                    help='Type(s) of data to process. If multiple datatypes are given, cannot specify datatype-values')
-parser.add_argument('--preformat-data-dir', dest='preformat_data_dir',
-                    type=str, action='store', required=True,
-                    help='Directory to load preformatted data from')
-parser.add_argument('--output-dir', dest='output_dir',
-                    action='store', required=True,
-                    help='Directory to output data to. The output convention is: \n'
-                         '<output-dir>/<datatype>/<dataset>/raw_{slc}.csv, where slc is the slice number')
-parser.add_argument("--images", dest="plot_images",
-                    default=False, action="store_true",
-                    help="(Optional) If included, store images when saving data")
-
-
-args = parser.parse_args()
-datasets = args.dataset
-datatypes = args.datatype
-preformat_data_dir = args.preformat_data_dir
-parent_save_dir = args.output_dir
-plot_images = args.plot_images
-
-
-##########################################################################################
-# Code
-
-# Get and save Raw data
-print("Starting to save data...")
-exceptions = ""
-
-for dataset in datasets:
-    for datatype in datatypes:
-        print(f"\n----------------start {dataset} - {datatype}-----------------")
-        # If we haven't found any data, abort the loop and move on to next version
-        input_directory = os.path.join(preformat_data_dir, datatype, dataset)
-        if not os.path.exists(input_directory):
-            e = f"\t{dataset}: Path does not exist {input_directory} - not saving data for {datatype}\n"
-            exceptions += e
-            print(e + f"----------------end {dataset} - {datatype}-----------------")
-            continue
-
-        # Load one dataframe to get the data shape for ROI loading
-        filenames = glob.glob(os.path.join(input_directory, f"raw_*"))
-        slices_to_save = [f.split(os.sep)[-1].split("raw_")[-1].split(".")[0] for f in filenames]
-
-        # Set up the save directories
-        save_dir = os.path.join(parent_save_dir, datatype, dataset)
-        save_image_dir = os.path.join(save_dir, "images")
-        os.makedirs(save_dir, exist_ok=True)
-        os.makedirs(save_image_dir, exist_ok=True)
-
-        # Only get the ROI values out of the raw data (in some cases, the ROI is everything)
-        for slc in slices_to_save:
-            print("Saving raw data for slice:", slc)
-            load_filename = os.path.join(preformat_data_dir, datatype, dataset, f"raw_{slc}.csv")
-            data_pd = pd.read_csv(load_filename)
-            pd_filename = os.path.join(save_dir, f"raw_{slc}.csv")
-            with open(pd_filename, "w") as f:
-                data_pd.to_csv(f, index=False)
-
-            if plot_images:
-                print("Saving images to same colorscale")
-                plot_data_by_scan_params(data_pd, save_image_dir)
-        print(f"----------------end {dataset} - {datatype}-----------------")
-
-print("\nFinished Saving Data!")
-if len(exceptions) > 0:
-    print("\nNote, unable to save data for the following file and datatype combinations:")
-    print(exceptions)
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Save raw MRI data into CSV format.')
+    parser.add_argument('--dataset', dest='dataset',
+                        type=str, action='store', required=True, nargs="+",
+                        help='Dataset name(s) - data will be loaded and saved with this name')
+    parser.add_argument('--datatype', dest='datatype',
+                        type=str, action='store', nargs="+", required=True,
+                        choices=["t1", "t2", "t2_epg", "t2_map", "adc"],
+                        help='Type(s) of data to process. If multiple datatypes are given, cannot specify '
+                             'datatype-values')
+    parser.add_argument('--preformat-data-dir', dest='preformat_data_dir',
+                        type=str, action='store', required=True,
+                        help='Directory to load preformatted data from')
+    parser.add_argument('--output-dir', dest='output_dir',
+                        action='store', required=True,
+                        help='Directory to output data to. The output convention is: \n'
+                             '<output-dir>/<datatype>/<dataset>/raw_{slc}.csv, where slc is the slice number')
+    parser.add_argument("--images", dest="plot_images",
+                        default=False, action="store_true",
+                        help="(Optional) If included, store images when saving data")
+    parser.add_argument("--image-workers", dest="image_workers",
+                        type=int, default=1, action="store",
+                        help="(Optional) Number of worker processes to render images with. The default value is 1")
+    parser.add_argument("--image-style", dest="image_style",
+                        type=str, default="figure", action="store", choices=["figure", "array"],
+                        help="(Optional) Render images as figures with a colorbar (figure), or write the colormapped "
+                             "arrays directly to PNG, one pixel per voxel (array). The default value is figure")
+    parser.add_argument("--compact-dtypes", dest="compact_dtypes",
+                        action="store_true",
+                        help="(Optional) Load the data with compact dtypes (16-bit integer coordinates, 32-bit float "
+                             "data and categorical acquisition columns), and report the memory they save")
+    parser.add_argument("--run-report", dest="run_report",
+                        action="store",
+                        help="(Optional) JSON file to store a run report in, with the wall/CPU time, rows, "
+                             "bytes read/written and peak memory of each stage and slice")
+    parser.add_argument("--profile-dir", dest="profile_dir",
+                        action="store",
+                        help="(Optional) Directory to store cProfile output of loading each slice in. "
+                             "Only used with --run-report")
+    return parser.parse_args(args)
+
+
+def get_slices_to_save(input_directory):
+    """ Get the slice numbers of the raw_{slc}.csv files in a directory """
+    filenames = glob.glob(os.path.join(input_directory, f"raw_*"))
+    return [f.split(os.sep)[-1].split("raw_")[-1].split(".")[0] for f in filenames]
+
+
+def load_slice_data(input_directory, slc, compact=False, memory_usage=None, run_report=None, **labels):
+    """ Load the preformatted data of a slice, with the compact dtypes if compact (and its memory added to
+    memory_usage, if given) """
+    load_filename = os.path.join(input_directory, f"raw_{slc}.csv")
+    with optional_stage(run_report, "load", profile=True, **labels, slc=slc) as stage:
+        data_pd = read_compact_csv(load_filename) if compact else pd.read_csv(load_filename)
+        add_counts(stage, rows=len(data_pd), bytes_read=os.path.getsize(load_filename))
+        if memory_usage is not None:
+            memory_usage.add("load", data_pd, stage=stage)
+    return data_pd
+
+
+def load_preformatted_data(input_directory, compact=False, memory_usage=None, run_report=None, **labels):
+    """ Load the preformatted data of each slice in a directory. Returns the data by slice """
+    return {slc: load_slice_data(input_directory, slc, compact=compact, memory_usage=memory_usage,
+                                 run_report=run_report, **labels)
+            for slc in get_slices_to_save(input_directory)}
+
+
+def save_slice_data(data_pd, save_dir, slc, plot_images=False, image_workers=1, image_style="figure",
+                    run_report=None, **labels):
+    """ Save the data of a slice as <save_dir>/raw_{slc}.csv, and optionally images of each acquisition """
+    print("Saving raw data for slice:", slc)
+    pd_filename = os.path.join(save_dir, f"raw_{slc}.csv")
+    with optional_stage(run_report, "save", **labels, slc=slc) as stage:
+        with open(pd_filename, "w") as f:
+            data_pd.to_csv(f, index=False)
+        add_counts(stage, rows=len(data_pd), bytes_written=os.path.getsize(pd_filename))
+
+    if plot_images:
+        print("Saving images to same colorscale")
+        with optional_stage(run_report, "images", **labels, slc=slc):
+            plot_data_by_scan_params(data_pd, os.path.join(save_dir, "images"), n_workers=image_workers,
+                                     image_style=image_style)
+
+
+def save_data(data_pd_dict, save_dir, plot_images=False, image_workers=1, image_style="figure", run_report=None,
+              **labels):
+    """ Save the data of each slice, and optionally images of each acquisition """
+    save_image_dir = os.path.join(save_dir, "images")
+    os.makedirs(save_dir, exist_ok=True)
+    os.makedirs(save_image_dir, exist_ok=True)
+    for slc, data_pd in data_pd_dict.items():
+        save_slice_data(data_pd, save_dir, slc, plot_images=plot_images, image_workers=image_workers,
+                        image_style=image_style, run_report=run_report, **labels)
+
+
+def main(args):
+    run_report = None
+    if args.run_report is not None:
+        run_report = RunReport("save_data", filename=args.run_report, profile_dir=args.profile_dir)
+        run_report.add_info(args=vars(args))
+
+    memory_usage = MemoryUsage() if args.compact_dtypes else None
+
+    # Get and save Raw data
+    print("Starting to save data...")
+    exceptions = ""
+
+    for dataset in args.dataset:
+        for datatype in args.datatype:
+            print(f"\n----------------start {dataset} - {datatype}-----------------")
+            # If we haven't found any data, abort the loop and move on to next version
+            input_directory = os.path.join(args.preformat_data_dir, datatype, dataset)
+            if not os.path.exists(input_directory):
+                e = f"\t{dataset}: Path does not exist {input_directory} - not saving data for {datatype}\n"
+                exceptions += e
+                print(e + f"----------------end {dataset} - {datatype}-----------------")
+                continue
+
+            # Only get the ROI values out of the raw data (in some cases, the ROI is everything). Each slice is
+            # saved as soon as it is loaded, so only one slice is in memory at a time
+            save_dir = os.path.join(args.output_dir, datatype, dataset)
+            os.makedirs(save_dir, exist_ok=True)
+            os.makedirs(os.path.join(save_dir, "images"), exist_ok=True)
+            # Keep the session information (e.g. the study date) with the data
+            if os.path.exists(os.path.join(input_directory, session_info_filename)):
+                shutil.copyfile(os.path.join(input_directory, session_info_filename),
+                                os.path.join(save_dir, session_info_filename))
+            for slc in get_slices_to_save(input_directory):
+                data_pd = load_slice_data(input_directory, slc, compact=args.compact_dtypes,
+                                          memory_usage=memory_usage, run_report=run_report, dataset=dataset,
+                                          datatype=datatype)
+                save_slice_data(data_pd, save_dir, slc, plot_images=args.plot_images,
+                                image_workers=args.image_workers, image_style=args.image_style,
+                                run_report=run_report, dataset=dataset, datatype=datatype)
+            print(f"----------------end {dataset} - {datatype}-----------------")
+
+    if memory_usage is not None:
+        memory_usage.print()
+        if run_report is not None:
+            run_report.add_info(memory_usage=memory_usage.get_summary())
+    print("\nFinished Saving Data!")
+    if len(exceptions) > 0:
+        print("\nNote, unable to save data for the following file and datatype combinations:")
+        print(exceptions)
+    if run_report is not None:
+        run_report.save()
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)
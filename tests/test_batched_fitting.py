@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+from fitting.t1_fitting import model_T1_2
+from fitting.t2_fitting import model_T2
+from fitting.overall_fitting import get_measurement_estimates_for_data_by_group
+
+
+def make_voxel_pd(datatype, n_voxels=20, noise_sigma=5., seed=0):
+    """ Noisy T1 (inversion recovery) or T2 (echo train) data of n_voxels voxels with random T1 or T2 """
+    rng = np.random.default_rng(seed)
+    if datatype == "t1":
+        values = np.array([50., 100., 200., 400., 800., 1600., 3200.])
+        quantity = rng.uniform(300., 2000., n_voxels)
+        signals = model_T1_2(Si=1000., delta=0.9, TI=values[None, :], T1=quantity[:, None], TR=5000.)
+    else:
+        values = np.array([10., 20., 40., 80., 160., 320.])
+        quantity = rng.uniform(20., 300., n_voxels)
+        signals = model_T2(Si=1000., TE=values[None, :], T2=quantity[:, None])
+    data_pd = pd.DataFrame({"voxel": np.repeat(np.arange(n_voxels), len(values)),
+                            "ti" if datatype == "t1" else "te": np.tile(values, n_voxels),
+                            "data": np.abs(signals + rng.normal(0., noise_sigma, signals.shape)).ravel()})
+    if datatype == "t1":
+        data_pd["tr"] = 5000.
+    return data_pd
+
+
+@pytest.mark.parametrize("datatype, quantity", [("t1", "T1"), ("t2", "T2")])
+def test_batched_fits_match_lmfit(datatype, quantity):
+    data_pd = make_voxel_pd(datatype)
+    fit_pds = {fit_engine: get_measurement_estimates_for_data_by_group(data_pd, datatype, group_cols=["voxel"],
+                                                                      fit_engine=fit_engine)
+               .drop_duplicates(subset="voxel").sort_values("voxel")
+               for fit_engine in ["lmfit", "batched"]}
+    np.testing.assert_allclose(fit_pds["batched"][quantity], fit_pds["lmfit"][quantity], rtol=1e-3)
+    np.testing.assert_allclose(fit_pds["batched"]["Si"], fit_pds["lmfit"]["Si"], rtol=1e-3)
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils_io.compact_dtypes import compact_dataframe, expand_categorical_columns, get_memory_bytes, \
+    get_default_memory_bytes
+
+
+def make_data_pd(n_voxels=100, seed=0):
+    """ Long-format data of n_voxels voxels with four inversion times """
+    rng = np.random.default_rng(seed)
+    TI = np.array([100., 400., 800., 1600.])
+    return pd.DataFrame({"x": np.repeat(np.arange(n_voxels), len(TI)), "y": 3, "slc": 1, "nx": 256, "ny": 256,
+                         "nslc": 4, "slc_location": 5., "tr": 5000., "ti": np.tile(TI, n_voxels),
+                         "data": rng.uniform(0., 4000., n_voxels * len(TI))})
+
+
+def test_compact_dataframe_is_within_float32_precision():
+    data_pd = make_data_pd()
+    compact_pd = compact_dataframe(data_pd)
+    assert compact_pd["x"].dtype == "int16"
+    assert compact_pd["data"].dtype == "float32"
+    assert isinstance(compact_pd["ti"].dtype, pd.CategoricalDtype)
+    assert get_memory_bytes(compact_pd) < get_default_memory_bytes(data_pd) / 2
+    expanded_pd = expand_categorical_columns(compact_pd.copy())
+    pd.testing.assert_frame_equal(expanded_pd, data_pd, check_dtype=False, rtol=1e-7)
+    for c in ["slc_location", "tr", "ti"]:
+        assert expanded_pd[c].dtype == data_pd[c].dtype
+
+
+def test_compact_dataframe_rejects_coordinates_out_of_range():
+    data_pd = make_data_pd()
+    data_pd.loc[0, "x"] = 40000
+    with pytest.raises(Exception):
+        compact_dataframe(data_pd)
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+from fitting.t2_fitting import model_T2
+from fitting.curve_clustering import get_clustered_estimates
+from fitting.overall_fitting import get_measurement_estimates_for_data_by_group
+from utils_io.synthetic_phantom import get_phantom_labels, get_ground_truth_maps
+
+
+def make_phantom_t2_pd(matrix_size=16, noise_sigma=1., seed=0):
+    """ T2 echo trains of the voxels of one slice of the synthetic phantom, which has many near-duplicate curves """
+    ground_truth_maps = get_ground_truth_maps(get_phantom_labels(matrix_size, 1))
+    x, y = np.nonzero(ground_truth_maps["PD"][:, :, 0] > 0)
+    TE = np.array([10., 20., 40., 80., 160., 320.])
+    signals = model_T2(Si=1000. * ground_truth_maps["PD"][x, y, 0][:, None], TE=TE[None, :],
+                       T2=ground_truth_maps["T2"][x, y, 0][:, None])
+    signals = signals + np.random.default_rng(seed).normal(0., noise_sigma, signals.shape)
+    return pd.DataFrame({"slc": 0, "x": np.repeat(x, len(TE)), "y": np.repeat(y, len(TE)),
+                         "te": np.tile(TE, len(x)), "data": signals.ravel()})
+
+
+@pytest.mark.parametrize("polish, rtol", [(True, 1e-6), (False, 0.05)])
+def test_cluster_fits_match_voxel_fits(polish, rtol):
+    data_pd = make_phantom_t2_pd()
+    group_cols = ["slc", "x", "y"]
+    voxel_fit_pd = get_measurement_estimates_for_data_by_group(data_pd, "t2", group_cols=group_cols)
+    cluster_fit_pd, summary = get_clustered_estimates(data_pd, "t2", polish=polish, group_cols=group_cols)
+    assert summary["num_clusters"] < summary["num_voxels"] / 2
+    voxel_fit_pd = voxel_fit_pd.drop_duplicates(subset=group_cols).sort_values(group_cols)
+    cluster_fit_pd = cluster_fit_pd.drop_duplicates(subset=group_cols).sort_values(group_cols)
+    assert cluster_fit_pd[group_cols].to_numpy().tolist() == voxel_fit_pd[group_cols].to_numpy().tolist()
+    for c in ["T2", "Si"]:
+        np.testing.assert_allclose(cluster_fit_pd[c], voxel_fit_pd[c], rtol=rtol, err_msg=c)
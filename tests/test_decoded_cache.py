@@ -0,0 +1,57 @@
+import os
+import numpy as np
+from utils_io.MRIData import MRIData
+from utils_io.decoded_cache import DecodedImageCache
+
+
+def make_scan(tmp_path, name, seed=0):
+    """ A scan file, and its decoded image """
+    filename = str(tmp_path / name)
+    with open(filename, "wb") as f:
+        f.write(name.encode())
+    mri_data = MRIData()
+    mri_data.pixel_array = np.random.default_rng(seed).random((16, 16))
+    mri_data.InversionTime = 100.
+    return filename, mri_data
+
+
+def test_get_returns_the_cached_image(tmp_path):
+    cache = DecodedImageCache(str(tmp_path / "cache"))
+    filename, mri_data = make_scan(tmp_path, "scan_1.dcm")
+    assert cache.get(filename, "t1", "dicom") is None
+    cache.put(filename, "t1", "dicom", mri_data)
+    cached_mri_data = cache.get(filename, "t1", "dicom")
+    np.testing.assert_array_equal(cached_mri_data.pixel_array, mri_data.pixel_array)
+    assert cached_mri_data.InversionTime == 100.
+    # The datatype (which the rescaling depends on) is part of the key
+    assert cache.get(filename, "t2", "dicom") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_changed_files_are_not_read_from_the_cache(tmp_path):
+    cache = DecodedImageCache(str(tmp_path / "cache"))
+    filename, mri_data = make_scan(tmp_path, "scan_1.dcm")
+    cache.put(filename, "t1", "dicom", mri_data)
+    with open(filename, "ab") as f:
+        f.write(b"changed")
+    assert cache.get(filename, "t1", "dicom") is None
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    scans = [make_scan(tmp_path, f"scan_{idx}.dcm", seed=idx) for idx in range(3)]
+    cache = DecodedImageCache(str(tmp_path / "cache"))
+    for filename, mri_data in scans[:2]:
+        cache.put(filename, "t1", "dicom", mri_data)
+    entry_bytes = cache.total_bytes / 2
+    # Make the first image older than the second, and then use it
+    for (filename, _), mtime in zip(scans[:2], [1000., 2000.]):
+        os.utime(cache.get_paths(cache.get_key(filename, "t1", "dicom"))[1], (mtime, mtime))
+    assert cache.get(scans[0][0], "t1", "dicom") is not None
+
+    # Only room for two images, so the second (least recently used) one is evicted
+    cache.max_bytes = 2.5 * entry_bytes
+    cache.put(scans[2][0], "t1", "dicom", scans[2][1])
+    assert cache.total_bytes <= cache.max_bytes
+    assert cache.get(scans[0][0], "t1", "dicom") is not None
+    assert cache.get(scans[1][0], "t1", "dicom") is None
+    assert cache.get(scans[2][0], "t1", "dicom") is not None
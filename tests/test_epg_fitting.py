@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+from fitting.epg_fitting import simulate_cpmg_epg, estimate_T2_EPG, default_t2_values
+
+
+def make_echo_train_pd(T2, B1, echo_spacing=10., n_echos=32, Si=1000.):
+    """ Echo trains of one voxel per (T2, B1) pair, as the data of each echo time """
+    signals = Si * simulate_cpmg_epg(T2, B1, echo_spacing, n_echos)
+    TE = echo_spacing * np.arange(1, n_echos + 1)
+    return pd.DataFrame({"voxel": np.repeat(np.arange(len(signals)), n_echos),
+                         "te": np.tile(TE, len(signals)),
+                         "data": signals.ravel()})
+
+
+def test_simulate_cpmg_epg_with_ideal_refocusing_is_monoexponential():
+    echos = simulate_cpmg_epg([50., 200.], 1., 10., 16)
+    TE = 10. * np.arange(1, 17)
+    np.testing.assert_allclose(echos, np.exp(-TE[None, :] / np.array([50., 200.])[:, None]), rtol=1e-10)
+
+
+def test_estimate_T2_EPG_recovers_known_T2_and_B1():
+    T2 = np.array([40., 100., 400.])
+    B1 = np.array([0.7, 0.9, 1.])
+    fit_pd = estimate_T2_EPG(make_echo_train_pd(T2, B1, Si=1000.), ["voxel"])
+    # Within one step of the dictionary grid
+    t2_step = default_t2_values[1] / default_t2_values[0]
+    assert np.all(np.abs(np.log(fit_pd["T2"] / T2)) <= np.log(t2_step))
+    # Refocusing angles above 180 degrees give the same echoes as their mirror below 180 degrees
+    np.testing.assert_allclose(np.minimum(fit_pd["B1"], 2 - fit_pd["B1"]), B1, atol=0.011)
+    np.testing.assert_allclose(fit_pd["Si"], 1000., rtol=0.02)
+    assert fit_pd["valid_fit_by_grid_T2"].all()
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from utils_io.parametric_maps import save_parametric_maps, load_fit_pd_from_maps
+
+
+def make_fit_pd(nx=6, ny=5, nslc=3, seed=0):
+    """ Fits of a random half of the voxels of an (nx, ny, nslc) volume, ordered by slc, x, y """
+    rng = np.random.default_rng(seed)
+    slc, x, y = [v.ravel() for v in np.meshgrid(np.arange(nslc), np.arange(nx), np.arange(ny), indexing="ij")]
+    fitted = rng.random(len(x)) < 0.5
+    x, y, slc = x[fitted], y[fitted], slc[fitted]
+    n = len(x)
+    return pd.DataFrame({"x": x, "y": y, "slc": slc, "slc_location": 5. * slc,
+                         "nx": nx, "ny": ny, "nslc": nslc,
+                         "T2": rng.uniform(20., 300., n), "Si": rng.uniform(500., 1500., n),
+                         # lmfit gives no stderr for some voxels
+                         "stderr_T2": pd.Series(rng.uniform(0., 5., n), dtype=object).where(rng.random(n) < 0.8),
+                         "num_echos": rng.integers(4, 8, n),
+                         "valid_fit_by_stderr_T2": rng.random(n) < 0.5,
+                         "valid_fit_by_grid_T2": rng.random(n) < 0.5})
+
+
+def test_parametric_maps_round_trip(tmp_path):
+    fit_pd = make_fit_pd()
+    filename = str(tmp_path / "fit_pd.npz")
+    save_parametric_maps(fit_pd, filename)
+    loaded_fit_pd = load_fit_pd_from_maps(filename)
+    assert list(loaded_fit_pd.columns) == list(fit_pd.columns)
+    expected_fit_pd = fit_pd.assign(stderr_T2=pd.to_numeric(fit_pd["stderr_T2"]))
+    # Numeric columns are stored with float32 precision
+    pd.testing.assert_frame_equal(loaded_fit_pd, expected_fit_pd, check_dtype=False, rtol=1e-6)
+    for c in ["x", "y", "slc", "nx", "ny", "nslc", "num_echos", "valid_fit_by_stderr_T2", "valid_fit_by_grid_T2"]:
+        assert loaded_fit_pd[c].dtype == fit_pd[c].dtype
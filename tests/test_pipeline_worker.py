@@ -0,0 +1,27 @@
+import os
+import pipeline_worker
+from fitting import epg_fitting
+from fitting.epg_fitting import set_epg_cache_dir
+
+
+class RecordingScript:
+    ''' Pipeline script stand-in that records the EPG cache directory its jobs run with '''
+    def __init__(self):
+        self.epg_cache_dirs = []
+
+    def parse_args(self, args):
+        return args
+
+    def main(self, args):
+        self.epg_cache_dirs.append(epg_fitting._epg_cache_dir["dir"])
+        if len(args) > 0:
+            set_epg_cache_dir(args[0])
+
+
+def test_epg_cache_dir_does_not_leak_between_jobs(tmp_path):
+    script = RecordingScript()
+    modules = {"process_saved_data": script}
+    log_filename = os.path.join(str(tmp_path), "job.log")
+    assert pipeline_worker.run_job({"script": "process_saved_data", "args": [str(tmp_path)]}, modules, log_filename)
+    assert pipeline_worker.run_job({"script": "process_saved_data", "args": []}, modules, log_filename)
+    assert script.epg_cache_dirs == [None, None]
@@ -0,0 +1,148 @@
+import os
+import json
+import glob
+import numpy as np
+import pandas as pd
+import save_data
+import process_saved_data
+from generate_synthetic_data import generate_synthetic_data
+
+
+def make_saved_data(tmp_path, dataset="phantom", datatype="t2"):
+    """ Generate a small synthetic dataset and save it with save_data.py """
+    generate_synthetic_data(dataset, datatype, str(tmp_path), matrix_size=16, n_slices=2, formats=["csv"])
+    saved_data_dir = os.path.join(str(tmp_path), "saved_data")
+    save_data.main(save_data.parse_args(["--dataset", dataset, "--datatype", datatype,
+                                         "--preformat-data-dir", os.path.join(str(tmp_path), "preformat_data"),
+                                         "--output-dir", saved_data_dir]))
+    return saved_data_dir
+
+
+def test_main_with_images(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path)
+    output_dir = os.path.join(str(tmp_path), "fit_data")
+    process_saved_data.main(process_saved_data.parse_args(["--dataset", "phantom", "--datatype", "t2",
+                                                           "--saved-data-dir", saved_data_dir,
+                                                           "--output-dir", output_dir, "--images"]))
+    assert len(glob.glob(os.path.join(output_dir, "t2", "phantom", "fit_pd*.csv"))) > 0
+    assert len(glob.glob(os.path.join(output_dir, "t2", "phantom", "images", "**", "*.png"), recursive=True)) > 0
+
+
+def test_main_with_images_and_sweep(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path)
+    output_dir = os.path.join(str(tmp_path), "fit_data")
+    process_saved_data.main(process_saved_data.parse_args(["--dataset", "phantom", "--datatype", "t2",
+                                                           "--saved-data-dir", saved_data_dir,
+                                                           "--output-dir", output_dir, "--images",
+                                                           "--sweep-voxel-thresholds", "0.1", "0.2"]))
+    assert len(glob.glob(os.path.join(output_dir, "t2", "phantom*", "images", "**", "*.png"), recursive=True)) > 0
+
+
+def test_saved_fits_have_no_solver_evaluations_by_default(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path)
+    output_dir = os.path.join(str(tmp_path), "fit_data")
+    process_saved_data.main(process_saved_data.parse_args(["--dataset", "phantom", "--datatype", "t2",
+                                                           "--saved-data-dir", saved_data_dir,
+                                                           "--output-dir", output_dir]))
+    fit_pd = pd.read_csv(glob.glob(os.path.join(output_dir, "t2", "phantom", "fit_pd*.csv"))[0])
+    assert "T2" in fit_pd.columns
+    assert "nfev" not in fit_pd.columns
+
+
+def test_saved_adc_fits_have_one_row_per_voxel(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path, datatype="adc")
+    output_dir = os.path.join(str(tmp_path), "fit_data")
+    process_saved_data.main(process_saved_data.parse_args(["--dataset", "phantom", "--datatype", "adc",
+                                                           "--saved-data-dir", saved_data_dir,
+                                                           "--output-dir", output_dir]))
+    # The fits of all slices
+    fit_pd = pd.read_csv(os.path.join(output_dir, "adc", "phantom", "fit_pd_byvoxel_0.2.csv"))
+    assert len(fit_pd) > 0
+    assert len(fit_pd) == len(fit_pd.drop_duplicates(subset=["slc", "x", "y"]))
+    assert "target_b_value" not in fit_pd.columns
+
+
+def test_hybrid_calibration_is_timed_once_outside_the_fit(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path)
+    output_dir = os.path.join(str(tmp_path), "fit_data")
+    run_report_filename = os.path.join(str(tmp_path), "run_report.json")
+    process_saved_data.main(process_saved_data.parse_args(["--dataset", "phantom", "--datatype", "t2",
+                                                           "--saved-data-dir", saved_data_dir,
+                                                           "--output-dir", output_dir, "--fit-engine", "hybrid",
+                                                           "--run-report", run_report_filename]))
+    with open(run_report_filename) as f:
+        summary = json.load(f)["summary"]
+    assert summary["fit"]["calls"] == 2
+    assert summary["hybrid_calibration"]["calls"] == 1
+
+
+def test_adc_fits_recover_the_synthetic_phantom(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path, datatype="adc")
+    output_dir = os.path.join(str(tmp_path), "fit_data")
+    process_saved_data.main(process_saved_data.parse_args(["--dataset", "phantom", "--datatype", "adc",
+                                                           "--saved-data-dir", saved_data_dir,
+                                                           "--output-dir", output_dir]))
+    fit_pd = pd.read_csv(os.path.join(output_dir, "adc", "phantom", "fit_pd_byvoxel_0.2.csv"))
+    with np.load(os.path.join(str(tmp_path), "ground_truth", "adc", "phantom", "ground_truth.npz")) as f:
+        voxels = (fit_pd["x"].to_numpy(), fit_pd["y"].to_numpy(), fit_pd["slc"].to_numpy())
+        fit_pd["label"] = f["labels"][voxels]
+        fit_pd["true_ADC"] = f["ADC"][voxels]
+    # The median fit of each compartment (including anisotropic white matter) is within 5% of its ADC
+    median_pd = fit_pd[fit_pd["label"] > 0].groupby("label")[["ADC", "true_ADC"]].median()
+    assert len(median_pd) > 3
+    np.testing.assert_allclose(median_pd["ADC"], median_pd["true_ADC"], rtol=0.05)
+
+
+def read_all_slice_fits(output_dir, datatype, dataset_dir, voxel_threshold):
+    """ Read the saved fits of all slices, by voxel """
+    fit_pd = pd.read_csv(os.path.join(output_dir, datatype, dataset_dir, f"fit_pd_byvoxel_{voxel_threshold}.csv"))
+    return fit_pd.sort_values(["slc", "x", "y"]).reset_index(drop=True)
+
+
+def test_voxel_threshold_sweep_matches_separate_runs(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path)
+    args = ["--dataset", "phantom", "--datatype", "t2", "--saved-data-dir", saved_data_dir]
+    sweep_dir = os.path.join(str(tmp_path), "sweep")
+    process_saved_data.main(process_saved_data.parse_args(args + ["--output-dir", sweep_dir,
+                                                                  "--sweep-voxel-thresholds", "0.2", "0.6"]))
+    for voxel_threshold in [0.2, 0.6]:
+        output_dir = os.path.join(str(tmp_path), f"threshold_{voxel_threshold}")
+        process_saved_data.main(process_saved_data.parse_args(args + ["--output-dir", output_dir,
+                                                                      "--fit-by-voxel-threshold",
+                                                                      str(voxel_threshold)]))
+        fit_pd = read_all_slice_fits(output_dir, "t2", "phantom", voxel_threshold)
+        sweep_fit_pd = read_all_slice_fits(sweep_dir, "t2", "phantom", voxel_threshold)
+        assert sweep_fit_pd[["slc", "x", "y"]].equals(fit_pd[["slc", "x", "y"]])
+        np.testing.assert_allclose(sweep_fit_pd["T2"], fit_pd["T2"], rtol=1e-6)
+    assert len(read_all_slice_fits(sweep_dir, "t2", "phantom", 0.6)) < \
+        len(read_all_slice_fits(sweep_dir, "t2", "phantom", 0.2))
+
+
+def test_subset_sweep_matches_datatype_values(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path)
+    args = ["--dataset", "phantom", "--datatype", "t2", "--saved-data-dir", saved_data_dir]
+    sweep_dir = os.path.join(str(tmp_path), "sweep")
+    process_saved_data.main(process_saved_data.parse_args(args + ["--output-dir", sweep_dir,
+                                                                  "--sweep-subsets", "10,40,160", "20,80,320"]))
+    for values in [["10", "40", "160"], ["20", "80", "320"]]:
+        output_dir = os.path.join(str(tmp_path), "_".join(values))
+        process_saved_data.main(process_saved_data.parse_args(args + ["--output-dir", output_dir,
+                                                                      "--datatype-values"] + values))
+        dataset_dir = "phantom_" + "_".join([str(float(v)) for v in values])
+        fit_pd = read_all_slice_fits(output_dir, "t2", dataset_dir, 0.2)
+        sweep_fit_pd = read_all_slice_fits(sweep_dir, "t2", dataset_dir, 0.2)
+        assert sweep_fit_pd[["slc", "x", "y"]].equals(fit_pd[["slc", "x", "y"]])
+        np.testing.assert_allclose(sweep_fit_pd["T2"], fit_pd["T2"], rtol=1e-6)
+
+
+def test_compact_dtypes_fits_are_within_float32_precision(tmp_path):
+    saved_data_dir = make_saved_data(tmp_path, datatype="t1")
+    args = ["--dataset", "phantom", "--datatype", "t1", "--saved-data-dir", saved_data_dir]
+    fit_pds = {}
+    for name, extra_args in [("default", []), ("compact", ["--compact-dtypes"])]:
+        output_dir = os.path.join(str(tmp_path), name)
+        process_saved_data.main(process_saved_data.parse_args(args + ["--output-dir", output_dir] + extra_args))
+        fit_pds[name] = read_all_slice_fits(output_dir, "t1", "phantom", 0.2)
+    assert fit_pds["compact"][["slc", "x", "y"]].equals(fit_pds["default"][["slc", "x", "y"]])
+    for c in ["T1", "Si", "delta"]:
+        np.testing.assert_allclose(fit_pds["compact"][c], fit_pds["default"][c], rtol=1e-4, err_msg=c)
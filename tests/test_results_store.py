@@ -0,0 +1,53 @@
+import pytest
+import numpy as np
+import pandas as pd
+from utils_io.results_store import ResultsStore, statistics_cols
+
+
+def make_summary_pd(median):
+    """ A dataset summary of T1, with the given median """
+    summary_pd = pd.DataFrame({"level": ["dataset"], "slc": [None], "slc_location": [None], "roi_label": [None],
+                               "roi_name": [None], "quantity": ["T1"]})
+    for c in statistics_cols:
+        summary_pd[c] = 10 if c.startswith("num_") else median
+    return summary_pd
+
+
+def test_add_run_replaces_the_same_run(tmp_path):
+    with ResultsStore(str(tmp_path / "results.db")) as results_store:
+        results_store.add_run(make_summary_pd(800.), "phantom", "t1", 0.2, [100, 800], study_date="20240101")
+        results_store.add_run(make_summary_pd(810.), "phantom", "t1", 0.2, [100, 800], study_date="2024-01-01")
+        trend_pd = results_store.get_trend("t1", "T1")
+        assert len(results_store.get_runs()) == 1
+    assert trend_pd["median"].tolist() == [810.]
+
+
+def test_add_run_keeps_the_runs_of_each_fit_engine(tmp_path):
+    with ResultsStore(str(tmp_path / "results.db")) as results_store:
+        for fit_engine, median in [("lmfit", 800.), ("batched", 801.), ("lmfit", 802.)]:
+            results_store.add_run(make_summary_pd(median), "phantom", "t1", 0.2, [100, 800],
+                                  study_date="2024-01-01", fit_engine=fit_engine)
+        trend_pd = results_store.get_trend("t1", "T1", fit_engine="lmfit")
+        assert len(results_store.get_runs()) == 2
+    assert trend_pd["median"].tolist() == [802.]
+
+
+def test_add_run_without_a_study_date_needs_a_session(tmp_path):
+    with ResultsStore(str(tmp_path / "results.db")) as results_store:
+        with pytest.raises(Exception):
+            results_store.add_run(make_summary_pd(800.), "phantom", "t1", 0.2, [100, 800])
+        for session in ["session_1", "session_2"]:
+            results_store.add_run(make_summary_pd(800.), "phantom", "t1", 0.2, [100, 800], session=session)
+        assert results_store.get_runs()["session"].tolist() == ["session_1", "session_2"]
+
+
+def test_get_trend_by_study_date(tmp_path):
+    medians = {"2024-03-01": 820., "2024-01-01": 800., "2024-02-01": 810.}
+    with ResultsStore(str(tmp_path / "results.db")) as results_store:
+        for study_date, median in medians.items():
+            results_store.add_run(make_summary_pd(median), "phantom", "t1", 0.2, [100, 800], study_date=study_date)
+            results_store.add_run(make_summary_pd(median), "phantom", "t1", 0.2, [100, 800, 1600],
+                                  study_date=study_date)
+        trend_pd = results_store.get_trend("t1", "T1", protocol_values=[800, 100], start_date="2024-02-01")
+    assert trend_pd["study_date"].tolist() == ["2024-02-01", "2024-03-01"]
+    np.testing.assert_allclose(trend_pd["median"], [810., 820.])
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+from fitting.roi_statistics import ROIStatistics, get_label_statistics
+
+
+def test_get_label_statistics_matches_pandas_groupby():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(1, 6, 1000)
+    values = rng.normal(100., 20., 1000)
+    stats_pd = get_label_statistics(labels, values).set_index("label")
+    grouped = pd.Series(values).groupby(labels)
+    np.testing.assert_array_equal(stats_pd["num_valid"], grouped.size())
+    for name, expected in [("mean", grouped.mean()), ("std", grouped.std()), ("min", grouped.min()),
+                           ("p5", grouped.quantile(0.05)), ("p25", grouped.quantile(0.25)),
+                           ("median", grouped.median()), ("p75", grouped.quantile(0.75)),
+                           ("p95", grouped.quantile(0.95)), ("max", grouped.max())]:
+        np.testing.assert_allclose(stats_pd[name], expected, rtol=1e-12, err_msg=name)
+
+
+def test_roi_statistics_of_slices_match_pandas_groupby():
+    rng = np.random.default_rng(1)
+    label_map = rng.integers(0, 4, (8, 8, 2))
+    x, y, slc = [v.ravel() for v in np.meshgrid(np.arange(8), np.arange(8), np.arange(2), indexing="ij")]
+    fit_pd = pd.DataFrame({"x": x, "y": y, "slc": slc, "T1": rng.normal(1000., 100., len(x)),
+                           "valid_fit_by_stderr_T1": rng.random(len(x)) < 0.9})
+    fit_pd.loc[3, "T1"] = np.nan
+
+    # Add the fits of each slice, as they are fit
+    roi_statistics = ROIStatistics(label_map, quantities=["T1"])
+    for _, slice_fit_pd in fit_pd.groupby("slc"):
+        roi_statistics.add_fits(slice_fit_pd)
+    stats_pd = roi_statistics.get_statistics().set_index("label")
+
+    fit_pd["label"] = label_map[x, y, slc]
+    fit_pd = fit_pd[fit_pd["label"] != 0]
+    np.testing.assert_array_equal(stats_pd["num_voxels"], fit_pd.groupby("label").size())
+    valid_pd = fit_pd[fit_pd["valid_fit_by_stderr_T1"] & np.isfinite(fit_pd["T1"])]
+    grouped = valid_pd.groupby("label")["T1"]
+    np.testing.assert_array_equal(stats_pd["num_valid"], grouped.size())
+    np.testing.assert_allclose(stats_pd["mean"], grouped.mean(), rtol=1e-12)
+    np.testing.assert_allclose(stats_pd["median"], grouped.median(), rtol=1e-12)
+    np.testing.assert_allclose(stats_pd["p95"], grouped.quantile(0.95), rtol=1e-12)
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from fitting.warm_start import estimate_shift, get_warm_start_init_pd
+from utils_io.synthetic_phantom import get_phantom_labels, get_ground_truth_maps
+
+
+def get_phantom_maps(matrix_size=32):
+    """ The ground truth PD and T1 maps of one slice of the synthetic phantom """
+    ground_truth_maps = get_ground_truth_maps(get_phantom_labels(matrix_size, 1))
+    return ground_truth_maps["PD"][:, :, 0], ground_truth_maps["T1"][:, :, 0]
+
+
+@pytest.mark.parametrize("shift", [(0, 0), (2, -1), (-3, 4)])
+def test_estimate_shift_of_the_phantom(shift):
+    PD, _ = get_phantom_maps()
+    assert estimate_shift(np.roll(PD, shift, axis=(0, 1)), PD) == shift
+
+
+def test_warm_start_init_values_follow_the_shift():
+    PD, T1 = get_phantom_maps()
+    nx, ny = PD.shape
+    x, y = [v.ravel() for v in np.meshgrid(np.arange(nx), np.arange(ny), indexing="ij")]
+    in_phantom = PD[x, y] > 0
+    prior_pd = pd.DataFrame({"slc": 0, "x": x, "y": y, "Si": 1000. * PD[x, y], "T1": T1[x, y],
+                             "delta": 0.9})[in_phantom]
+    # The phantom moved by (2, -1) voxels since the prior session
+    shifted_PD = np.roll(PD, (2, -1), axis=(0, 1))
+    data_pd = pd.DataFrame({"slc": 0, "x": x, "y": y, "nx": nx, "ny": ny, "data": 800. * shifted_PD[x, y]})
+    init_pd, alignment = get_warm_start_init_pd(data_pd, prior_pd, "t1")
+    assert alignment == {"prior_slc": 0, "shift": [2, -1]}
+    assert len(init_pd) == int(np.sum(in_phantom))
+    shifted_T1 = np.roll(T1, (2, -1), axis=(0, 1))
+    np.testing.assert_array_equal(init_pd["T1"], shifted_T1[init_pd["x"], init_pd["y"]])
@@ -4,6 +4,7 @@ import struct
 import pydicom
 import pandas as pd
 from typing import List
+from utils_io.compact_dtypes import compact_dtypes, compact_dataframe
 
 
 class MRIData:
@@ -137,22 +138,24 @@ class MRIData:
         print("Manufacturer:", dicomImage.Manufacturer)
         if "StudyDate" in p:
             dicomImage.StudyDate = p.StudyDate
-        # Loading b_value is complicated depending on manufacturer
-        bvalue_tag = "bValue"
-        if "hyperfine" in p.Manufacturer.lower():
-            bvalue_tag = "0x00189087"
-        elif "siemens" in p.Manufacturer.lower():
-            if "0x0019100c" in p:
-                bvalue_tag = "0x0019100c"
-            else:
-                bvalue_tag = "0x0019a00c"
-        elif ("ge" in dicomImage.Manufacturer.lower()) or "general electric" in dicomImage.Manufacturer.lower():
+        # Loading b_value depends on the manufacturer: Siemens and GE use private tags, and the others (e.g. Hyperfine
+        # and Philips) the standard DiffusionBValue tag
+        manufacturer = dicomImage.Manufacturer.lower()
+        if "siemens" in manufacturer:
+            bvalue_tag = "0x0019100c" if "0x0019100c" in p else "0x0019a00c"
+        elif ("ge" in manufacturer) or ("general electric" in manufacturer):
             bvalue_tag = "0x0043a039"
-        elif "philips" in dicomImage.Manufacturer.lower():
+        else:
             bvalue_tag = "0x00189087"
         if bvalue_tag in p:
             dicomImage.bValue = extract_b_value(p, bvalue_tag)
             dicomImage.targetBValue = dicomImage.bValue
+        # The diffusion direction is in the standard DiffusionGradientOrientation tag, or a private Siemens tag
+        for bvec_tag in ["0x00189089", "0x0019100e"]:
+            if (bvec_tag in p) and isinstance(p[bvec_tag].value, (list, tuple, pydicom.multival.MultiValue)) and \
+                    (len(p[bvec_tag].value) == 3):
+                dicomImage.bVector = [float(v) for v in p[bvec_tag].value]
+                break
 
         if "ImageOrientationPatient" in p:
             dicomImage.ImageOrientationPatient = p.ImageOrientationPatient
@@ -200,7 +203,7 @@ class MRIData:
         # Get the data, rescale it if necessary
         dicomImage.pixel_array = p.pixel_array
         if "hyperfine" in dicomImage.Manufacturer.lower():
-            if (datatype == "t1") or (datatype == "t2"):
+            if (datatype == "t1") or (datatype == "t2") or (datatype == "t2_epg"):
                 dicomImage.pixel_array = rescale_images_hyperfine(p)
         if "philips" in dicomImage.Manufacturer.lower():
             rescale_slope = 1
@@ -233,7 +236,9 @@ def get_and_process_b_from_tag(ds, tag):
     return int(str(ds[tag].value[0]).split("1000000")[-1])
 
 
-def turn_mri_data_into_dfs_by_slice(mri_data_objs: List[MRIData]):
+def turn_mri_data_into_dfs_by_slice(mri_data_objs: List[MRIData], compact=False):
+    """ Turn the loaded MRI data into long-format data by slice location. If compact, the data uses the compact dtypes
+    (see compact_dataframe) """
     all_dfs_by_slice = {}
     n_mridata = len(mri_data_objs)
 
@@ -256,7 +261,7 @@ def turn_mri_data_into_dfs_by_slice(mri_data_objs: List[MRIData]):
             # 3D data - need to loop through z and slice location will be z location
             for slc_location in range(nz):
                 data_2d = data_3d[slc_location, :, :]
-                df = get_df_for_2d_data(mri_data, data_2d)
+                df = get_df_for_2d_data(mri_data, data_2d, compact=compact)
                 df["slc_location"] = slc_location  # Need to do this again here, since it was probably null before
                 # df["slc"] = slc_location
                 # df["nslc"] = nz
@@ -266,7 +271,7 @@ def turn_mri_data_into_dfs_by_slice(mri_data_objs: List[MRIData]):
                     all_dfs_by_slice[slc_location].append(df)
         elif len(data_shape) == 2:
             data_2d = mri_data.pixel_array
-            df = get_df_for_2d_data(mri_data, data_2d)
+            df = get_df_for_2d_data(mri_data, data_2d, compact=compact)
 
             slc_location = mri_data.SliceLocation
             if slc_location not in all_dfs_by_slice:
@@ -290,17 +295,22 @@ def turn_mri_data_into_dfs_by_slice(mri_data_objs: List[MRIData]):
                 df["nslc"] = nslc
         # compress them all
         dfs_by_slice[slc_location] = pd.concat(dfs)
+        if compact:
+            # The acquisition columns are made categorical once all acquisitions of the slice are together
+            dfs_by_slice[slc_location] = compact_dataframe(dfs_by_slice[slc_location])
         slc_idx += 1
     print("Finished processing", n_mridata, "loaded files")
     return dfs_by_slice
 
 
-def get_df_for_2d_data(mri_data, data_2d):
+def get_df_for_2d_data(mri_data, data_2d, compact=False):
     nx, ny = np.shape(data_2d)
     # First create a dataframe with the data
     df = pd.DataFrame(data_2d)
     df = df.unstack().reset_index()  # This unstacks y first, then x
     df.columns = ["y", "x", "data"]
+    if compact:
+        df = df.astype({c: compact_dtypes[c] for c in df.columns})
     df["nx"] = nx
     df["ny"] = ny
 
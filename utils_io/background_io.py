@@ -0,0 +1,84 @@
+import queue
+import threading
+
+
+def iterate_in_background(iterable, depth=1):
+    """ Iterate over an iterable (e.g. a generator that loads slices) in a background thread, which stays at most
+    depth items ahead of the consumer, so at most depth + 2 items are in memory at once (the queued items, the item
+    being produced and the item being consumed). Errors in the background thread are raised in the consumer """
+    items = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Wait for space in the queue, unless the consumer stopped
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWriter:
+    ''' Calls a write function (e.g. saving the fits of a slice) in a background thread, in the order the items are
+    submitted, with at most max_pending items waiting to be written. Errors in the background thread are raised by
+    the next submit or by close '''
+
+    def __init__(self, write_function, max_pending=1):
+        self.write_function = write_function
+        self._items = queue.Queue(maxsize=max(1, max_pending))
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            args = self._items.get()
+            if args is None:
+                return
+            if self._error is None:
+                try:
+                    self.write_function(*args)
+                except BaseException as e:
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, *args):
+        """ Queue the arguments of a write, waiting if max_pending writes are already queued """
+        self._raise_error()
+        self._items.put(args)
+
+    def close(self):
+        """ Wait for all queued writes to finish """
+        self._items.put(None)
+        self._thread.join()
+        self._raise_error()
@@ -0,0 +1,101 @@
+import threading
+import numpy as np
+import pandas as pd
+from profiling.run_report import add_counts
+
+# Compact dtypes of the columns of the long-format data (see get_df_for_2d_data): the voxel and slice coordinates
+# as 16-bit integers, and the signal as 32-bit floats
+compact_dtypes = {"x": "int16", "y": "int16", "slc": "int16", "nx": "uint16", "ny": "uint16", "nslc": "uint16",
+                  "data": "float32"}
+
+# Columns that only change between acquisitions (or slices), which are stored as categoricals: one small code per
+# row, and each distinct value once
+acquisition_cols = ["slc_location", "tr", "te", "ti", "b_value", "target_b_value", "b_vec_0", "b_vec_1", "b_vec_2"]
+
+
+def get_compact_csv_dtypes(usecols=None):
+    """ Get the dtypes to read the compact columns of the saved data with (pd.read_csv(..., dtype=...)). The
+    categorical columns are read with their own dtype and then made categorical (see compact_dataframe), so their
+    categories are numbers rather than strings """
+    return {c: d for c, d in compact_dtypes.items() if (usecols is None) or (c in usecols)}
+
+
+def compact_dataframe(data_pd):
+    """ Convert the columns of the data to their compact dtypes (see compact_dtypes and acquisition_cols), checking
+    that the coordinates fit in them """
+    data_pd = data_pd.copy()
+    for c, dtype in compact_dtypes.items():
+        if (c not in data_pd.columns) or (data_pd[c].dtype == dtype):
+            continue
+        if np.issubdtype(np.dtype(dtype), np.integer) and (len(data_pd) > 0):
+            info = np.iinfo(dtype)
+            if (data_pd[c].min() < info.min) or (data_pd[c].max() > info.max):
+                raise Exception(f"The values of {c} ({data_pd[c].min()} to {data_pd[c].max()}) do not fit in {dtype}")
+        data_pd[c] = data_pd[c].astype(dtype)
+    for c in acquisition_cols:
+        if (c in data_pd.columns) and not isinstance(data_pd[c].dtype, pd.CategoricalDtype):
+            data_pd[c] = data_pd[c].astype("category")
+    return data_pd
+
+
+def read_compact_csv(filename, usecols=None):
+    """ Read saved data with the compact dtypes """
+    return compact_dataframe(pd.read_csv(filename, usecols=usecols, dtype=get_compact_csv_dtypes(usecols)))
+
+
+def expand_categorical_columns(data_pd):
+    """ Convert the categorical columns of the data back to the dtype of their values, e.g. before fitting, since the
+    models compute with the acquisition parameters. The data should be a copy, since it is changed in place """
+    for c in data_pd.columns:
+        if isinstance(data_pd[c].dtype, pd.CategoricalDtype):
+            data_pd[c] = data_pd[c].astype(data_pd[c].cat.categories.dtype)
+    return data_pd
+
+
+def get_memory_bytes(data_pd):
+    return int(data_pd.memory_usage(deep=True).sum())
+
+
+def get_default_memory_bytes(data_pd):
+    """ Get the memory the data would use with the default 64-bit dtypes (int64 and float64) of its numeric and
+    categorical columns """
+    n_bytes = int(data_pd.index.memory_usage(deep=True))
+    for c in data_pd.columns:
+        if pd.api.types.is_numeric_dtype(data_pd[c]) or isinstance(data_pd[c].dtype, pd.CategoricalDtype):
+            n_bytes += 8 * len(data_pd)
+        else:
+            n_bytes += int(data_pd[c].memory_usage(deep=True, index=False))
+    return n_bytes
+
+
+class MemoryUsage:
+    ''' Tallies the memory of the data at each stage (e.g. load, mask, fit), and what it would be with the default
+    dtypes, to report the memory saved by the compact dtypes '''
+
+    def __init__(self):
+        self.stages = {}
+        # Slices may be loaded in a background thread while others are fit
+        self._lock = threading.Lock()
+
+    def add(self, name, data_pd, stage=None):
+        """ Add the memory of the data at a stage, and to the counters of the run report stage, if given """
+        memory_bytes = get_memory_bytes(data_pd)
+        default_memory_bytes = get_default_memory_bytes(data_pd)
+        with self._lock:
+            stage_memory = self.stages.setdefault(name, {"memory_bytes": 0, "default_memory_bytes": 0})
+            stage_memory["memory_bytes"] += memory_bytes
+            stage_memory["default_memory_bytes"] += default_memory_bytes
+        add_counts(stage, memory_bytes=memory_bytes, default_memory_bytes=default_memory_bytes)
+
+    def get_summary(self):
+        return {name: {**stage_memory,
+                       "reduction": 1 - stage_memory["memory_bytes"] / stage_memory["default_memory_bytes"]
+                       if stage_memory["default_memory_bytes"] > 0 else 0.}
+                for name, stage_memory in self.stages.items()}
+
+    def print(self):
+        print("\nMemory of the data with compact dtypes (and with the default dtypes):")
+        for name, stage_memory in self.get_summary().items():
+            print(f"\t{name}: {stage_memory['memory_bytes'] / 1024 / 1024:.1f} MB "
+                  f"({stage_memory['default_memory_bytes'] / 1024 / 1024:.1f} MB), "
+                  f"{stage_memory['reduction'] * 100:.0f}% less")
@@ -1,8 +1,14 @@
 
-def get_fit_pd_to_save(fit_pd, columns_to_remove):
-    fit_pd_to_save = fit_pd.drop(columns=columns_to_remove)
+def get_fit_pd_to_save(fit_pd, columns_to_remove, subset=None):
+    # Columns that are not in the fits (e.g. the solver evaluations of models that are not fit iteratively) are skipped
+    fit_pd_to_save = fit_pd.drop(columns=[c for c in columns_to_remove if c in fit_pd.columns])
     extra_cols_to_remove = ["te", "tr", "ti", "b_value"]
+    if "num_directions" in fit_pd.columns:
+        # Diffusion data is averaged over the directions of each target b-value (see average_diffusion_directions), so
+        # the target b-value and the number of averaged directions are per measurement too
+        extra_cols_to_remove += ["target_b_value", "num_directions"]
     extra_cols_to_remove = [e for e in extra_cols_to_remove if e in fit_pd.columns]
     fit_pd_to_save = fit_pd_to_save.drop(columns=extra_cols_to_remove)
-    fit_pd_to_save = fit_pd_to_save.drop_duplicates()
+    # If subset is given (e.g. the voxel columns), only it is used to find duplicate rows, which is much faster
+    fit_pd_to_save = fit_pd_to_save.drop_duplicates(subset=subset)
     return fit_pd_to_save
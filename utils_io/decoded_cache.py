@@ -0,0 +1,120 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pydicom
+from utils_io.MRIData import MRIData
+
+# Version of the decoding and rescaling in MRIData.readDicom/readFDF. Change it when they change, so that images
+# decoded by the previous version are not used
+decoded_cache_version = 1
+
+# Fields of MRIData that are stored along with the pixel array (the full DICOM/FDF header is not stored)
+cached_fields = ["bValue", "targetBValue", "bVector", "Columns", "ColumnDirection", "DataType", "EchoTime", "FileType",
+                 "FlipAngle", "FoVX", "FoVY", "ImageOrientationPatient", "InversionTime", "fmt", "Manufacturer",
+                 "matrix", "PixelSpacing", "ProtocolName", "RepetitionTime", "Rows", "RowDirection", "StudyDate",
+                 "SeriesDescription", "SliceLocation", "SliceThickness", "ro", "pe"]
+
+
+def to_json_value(value):
+    """ Convert pydicom and numpy values (e.g. DSfloat, MultiValue) to plain JSON values """
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue, np.ndarray)):
+        return [to_json_value(v) for v in value]
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value)
+    return str(value)
+
+
+class DecodedImageCache:
+    """ Cache of decoded (and rescaled) scanner images, so that reading the same files again (e.g. with other
+    sub-directories or datatypes) skips decoding them. Each image is keyed by its path, size and modification time,
+    the datatype (which the rescaling depends on), the reader and decoded_cache_version, and stored as a .npy pixel
+    array, which is memory-mapped when read, and a .json file of the header fields. Once the cache is larger than
+    max_bytes, the least recently used images are removed """
+    def __init__(self, cache_dir, max_bytes=10e9):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = int(np.sum([size for _, _, size in self.get_entries()]))
+
+    def get_key(self, filename, datatype, reader):
+        file_stat = os.stat(filename)
+        key = (os.path.abspath(filename), file_stat.st_size, file_stat.st_mtime_ns, datatype, reader,
+               decoded_cache_version)
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get_paths(self, key):
+        return os.path.join(self.cache_dir, key + ".npy"), os.path.join(self.cache_dir, key + ".json")
+
+    def get_entries(self):
+        """ Get the key, last use time and size of each cached image """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            array_path, fields_path = self.get_paths(key)
+            try:
+                entries.append((key, os.path.getmtime(fields_path),
+                                os.path.getsize(array_path) + os.path.getsize(fields_path)))
+            except OSError:
+                # E.g. removed by another process
+                continue
+        return entries
+
+    def get(self, filename, datatype, reader):
+        """ Get the cached image of the file as an MRIData object (with a read-only memory-mapped pixel array), or
+        None if it is not cached """
+        key = self.get_key(filename, datatype, reader)
+        array_path, fields_path = self.get_paths(key)
+        try:
+            with open(fields_path, "r") as f:
+                fields = json.load(f)
+            pixel_array = np.load(array_path, mmap_mode="r")
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        mri_data = MRIData()
+        for name, value in fields.items():
+            setattr(mri_data, name, value)
+        mri_data.pixel_array = pixel_array
+        # Mark the image as recently used
+        os.utime(fields_path)
+        self.hits += 1
+        return mri_data
+
+    def put(self, filename, datatype, reader, mri_data):
+        """ Cache the decoded image of the file, and remove the least recently used images if the cache is full """
+        key = self.get_key(filename, datatype, reader)
+        array_path, fields_path = self.get_paths(key)
+        fields = {name: to_json_value(getattr(mri_data, name)) for name in cached_fields}
+        # Write the pixel array first, since the fields file marks a complete entry
+        with open(array_path + ".tmp", "wb") as f:
+            np.save(f, np.asarray(mri_data.pixel_array))
+        os.replace(array_path + ".tmp", array_path)
+        with open(fields_path + ".tmp", "w") as f:
+            json.dump(fields, f)
+        os.replace(fields_path + ".tmp", fields_path)
+        self.total_bytes += os.path.getsize(array_path) + os.path.getsize(fields_path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Remove the least recently used images until the cache is at most max_bytes """
+        entries = sorted(self.get_entries(), key=lambda entry: entry[1])
+        self.total_bytes = int(np.sum([size for _, _, size in entries]))
+        for key, _, size in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            for path in self.get_paths(key)[::-1]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.total_bytes -= size
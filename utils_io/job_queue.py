@@ -0,0 +1,66 @@
+import os
+import json
+import time
+import uuid
+
+# A job moves from pending/ to running/ when a worker claims it, and then to done/ or failed/
+queue_states = ["pending", "running", "done", "failed"]
+
+
+def make_queue_dirs(queue_dir):
+    for state in queue_states + ["logs"]:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+
+def write_job(filename, job):
+    """ Write a job file atomically, so a worker never reads a partly written job """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_filename, filename)
+
+
+def submit_job(queue_dir, script, script_args):
+    """ Add a job to run a pipeline script with the given command line arguments. Returns the job id """
+    make_queue_dirs(queue_dir)
+    # Job ids start with the submission time, so jobs are run in the order they were submitted
+    job_id = f"{time.strftime('%Y%m%d-%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    job = {"id": job_id, "script": script, "args": list(script_args), "cwd": os.getcwd(), "submitted": time.time()}
+    write_job(os.path.join(queue_dir, "pending", f"{job_id}.json"), job)
+    return job_id
+
+
+def claim_next_job(queue_dir):
+    """ Claim the oldest pending job by moving it to running/. Returns None if there are no pending jobs """
+    pending_dir = os.path.join(queue_dir, "pending")
+    for filename in sorted([f for f in os.listdir(pending_dir) if f.endswith(".json")]):
+        running_filename = os.path.join(queue_dir, "running", filename)
+        try:
+            # Renaming is atomic, so only one worker can claim each job
+            os.rename(os.path.join(pending_dir, filename), running_filename)
+        except FileNotFoundError:
+            continue
+        with open(running_filename, "r") as f:
+            return json.load(f)
+    return None
+
+
+def finish_job(queue_dir, job, succeeded):
+    """ Move a claimed job to done/ or failed/, with its results """
+    state = "done" if succeeded else "failed"
+    write_job(os.path.join(queue_dir, state, f"{job['id']}.json"), job)
+    os.remove(os.path.join(queue_dir, "running", f"{job['id']}.json"))
+
+
+def wait_for_job(queue_dir, job_id, poll_interval=0.5, timeout=None):
+    """ Wait for a job to finish. Returns the finished job """
+    start_time = time.time()
+    while True:
+        for state in ["done", "failed"]:
+            filename = os.path.join(queue_dir, state, f"{job_id}.json")
+            if os.path.exists(filename):
+                with open(filename, "r") as f:
+                    return json.load(f)
+        if (timeout is not None) and (time.time() - start_time > timeout):
+            raise Exception(f"Timed out waiting for job {job_id} in {queue_dir}")
+        time.sleep(poll_interval)
@@ -0,0 +1,104 @@
+import json
+import numpy as np
+import pandas as pd
+
+# Columns that locate a voxel, and columns that only depend on the slice (as built by turn_mri_data_into_dfs_by_slice)
+voxel_cols = ["x", "y", "slc"]
+slice_cols = ["slc_location", "target_b_value", "b_vec_0", "b_vec_1", "b_vec_2", "nx", "ny", "nslc"]
+
+
+def get_parametric_maps(fit_pd):
+    """ Convert the fits (one row per voxel, as saved by get_fit_pd_to_save) into dense (nx, ny, nslc) float32 maps of
+    each numeric column, a bitmask of the fitted voxels and of each boolean column, and per-slice values of the slice
+    columns """
+    nx, ny, nslc = [int(fit_pd[c].values[0]) for c in ["nx", "ny", "nslc"]]
+    x = fit_pd["x"].to_numpy(dtype=int)
+    y = fit_pd["y"].to_numpy(dtype=int)
+    slc = fit_pd["slc"].to_numpy(dtype=int)
+
+    columns = [c for c in fit_pd.columns if c not in voxel_cols]
+    bool_cols = [c for c in columns if pd.api.types.is_bool_dtype(fit_pd[c])]
+    slice_value_cols = [c for c in columns if c in slice_cols]
+    map_cols = [c for c in columns if (c not in bool_cols) and (c not in slice_value_cols)]
+    dtypes = {c: str(fit_pd[c].dtype) for c in fit_pd.columns}
+    for c in map_cols:
+        if not pd.api.types.is_numeric_dtype(fit_pd[c]):
+            # E.g. stderrs that are all None, since lmfit could not estimate them
+            try:
+                fit_pd = fit_pd.assign(**{c: pd.to_numeric(fit_pd[c])})
+            except (ValueError, TypeError):
+                raise Exception(f"Cannot store non-numeric column {c} as a parametric map")
+            dtypes[c] = "float64"
+    # Bit 0 marks the fitted voxels, and the next bits the boolean columns
+    if len(bool_cols) + 1 > 16:
+        raise Exception(f"Cannot store more than 15 boolean columns in the bitmask, found: {bool_cols}")
+    mask_dtype = np.uint8 if len(bool_cols) + 1 <= 8 else np.uint16
+
+    maps = {}
+    mask = np.zeros((nx, ny, nslc), dtype=mask_dtype)
+    mask[x, y, slc] = 1
+    for bit, c in enumerate(bool_cols, start=1):
+        mask[x, y, slc] |= (fit_pd[c].to_numpy(dtype=bool).astype(mask_dtype) << bit)
+    maps["mask"] = mask
+    for c in map_cols:
+        volume = np.full((nx, ny, nslc), np.nan, dtype=np.float32)
+        volume[x, y, slc] = fit_pd[c].to_numpy(dtype=np.float32)
+        maps["map_" + c] = volume
+    first_row_by_slice = fit_pd.drop_duplicates(subset="slc")
+    for c in slice_value_cols:
+        values = np.full(nslc, np.nan)
+        values[first_row_by_slice["slc"].to_numpy(dtype=int)] = first_row_by_slice[c].to_numpy(dtype=float)
+        maps["slice_" + c] = values
+
+    metadata = {
+        "columns": list(fit_pd.columns),
+        "dtypes": dtypes,
+        "bool_columns": bool_cols,
+        "map_columns": map_cols,
+        "slice_columns": slice_value_cols,
+    }
+    maps["metadata"] = np.array(json.dumps(metadata))
+    return maps
+
+
+def save_parametric_maps(fit_pd, filename):
+    """ Save the fits as compressed parametric maps """
+    np.savez_compressed(filename, **get_parametric_maps(fit_pd))
+
+
+def load_parametric_maps(filename):
+    """ Load the parametric maps, bitmask and metadata saved by save_parametric_maps """
+    with np.load(filename) as f:
+        maps = {k: f[k] for k in f.files}
+    maps["metadata"] = json.loads(str(maps["metadata"]))
+    return maps
+
+
+def parametric_maps_to_fit_pd(maps):
+    """ Reconstruct the fits, with one row per fitted voxel (ordered by slc, x, y) and the columns of the saved fits.
+    Numeric columns have float32 precision """
+    metadata = maps["metadata"]
+    mask = maps["mask"]
+    nx, ny, nslc = mask.shape
+    # Find the fitted voxels in (slc, x, y) order
+    slc, x, y = np.nonzero(np.transpose(mask & 1, (2, 0, 1)))
+    fit_dict = {"x": x, "y": y, "slc": slc}
+    for c in metadata["slice_columns"]:
+        fit_dict[c] = maps["slice_" + c][slc]
+    for c in metadata["map_columns"]:
+        fit_dict[c] = maps["map_" + c][x, y, slc]
+    for bit, c in enumerate(metadata["bool_columns"], start=1):
+        fit_dict[c] = ((mask[x, y, slc] >> bit) & 1).astype(bool)
+    fit_pd = pd.DataFrame(fit_dict)[metadata["columns"]]
+    for c, dtype in metadata["dtypes"].items():
+        if fit_pd[c].dtype != dtype:
+            if np.issubdtype(np.dtype(dtype), np.integer):
+                fit_pd[c] = np.round(fit_pd[c]).astype(dtype)
+            else:
+                fit_pd[c] = fit_pd[c].astype(dtype)
+    return fit_pd
+
+
+def load_fit_pd_from_maps(filename):
+    """ Load parametric maps saved by save_parametric_maps as a fit dataframe """
+    return parametric_maps_to_fit_pd(load_parametric_maps(filename))
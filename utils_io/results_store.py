@@ -0,0 +1,277 @@
+import os
+import json
+import sqlite3
+import datetime
+import numpy as np
+import pandas as pd
+from fitting.roi_statistics import get_label_statistics
+
+# Session information (e.g. the study date) that preformat_data.py saves next to the preformatted data, and
+# save_data.py copies next to the saved data, for process_saved_data.py to store the results by
+session_info_filename = "session_info.json"
+
+# Columns of the statistics of each summary, as get_label_statistics (and ROIStatistics) gets them
+statistics_cols = ["num_voxels", "num_valid", "mean", "std", "min", "p5", "p25", "median", "p75", "p95", "max"]
+
+summary_levels = ["dataset", "slice", "roi"]
+
+# Columns that identify a run: storing a run with the same values replaces it. Runs without a study date are
+# identified by their session (e.g. the directory of their data) instead
+run_key_cols = ["dataset", "datatype", "study_date", "session", "protocol_values", "voxel_threshold", "fit_engine"]
+
+schema = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dataset TEXT NOT NULL,
+    datatype TEXT NOT NULL,
+    study_date TEXT NOT NULL,
+    protocol_name TEXT NOT NULL,
+    protocol_values TEXT NOT NULL,
+    voxel_threshold REAL NOT NULL,
+    fit_engine TEXT NOT NULL,
+    session TEXT NOT NULL,
+    output_dir TEXT,
+    created TEXT,
+    UNIQUE (dataset, datatype, study_date, session, protocol_values, voxel_threshold, fit_engine)
+);
+CREATE INDEX IF NOT EXISTS runs_by_date ON runs (datatype, study_date);
+CREATE INDEX IF NOT EXISTS runs_by_dataset ON runs (datatype, dataset, study_date);
+CREATE INDEX IF NOT EXISTS runs_by_protocol ON runs (datatype, protocol_values, study_date);
+CREATE TABLE IF NOT EXISTS summaries (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    level TEXT NOT NULL,
+    slc INTEGER,
+    slc_location REAL,
+    roi_label INTEGER,
+    roi_name TEXT,
+    quantity TEXT NOT NULL,
+    {", ".join([f"{c} {'INTEGER' if c.startswith('num_') else 'REAL'}" for c in statistics_cols])}
+);
+CREATE INDEX IF NOT EXISTS summaries_by_run ON summaries (run_id, quantity, level);
+CREATE INDEX IF NOT EXISTS summaries_by_quantity ON summaries (quantity, level, roi_label, slc, run_id);
+"""
+
+
+def format_study_date(study_date):
+    """ Format a study date (e.g. the DICOM StudyDate 20240101) as an ISO date (2024-01-01), or an empty string if it
+    is not known """
+    if (study_date is None) or (str(study_date).strip() == ""):
+        return ""
+    study_date = str(study_date).strip()
+    for date_format in ["%Y%m%d", "%Y-%m-%d"]:
+        try:
+            return datetime.datetime.strptime(study_date, date_format).date().isoformat()
+        except ValueError:
+            pass
+    raise Exception(f"Unable to read the study date {study_date}, expected YYYYMMDD or YYYY-MM-DD")
+
+
+def format_protocol_values(values):
+    """ Format the values of the acquisitions (e.g. the inversion times) as the output directories are named, without
+    the leading underscore (e.g. 100.0_800.0) """
+    return "_".join([str(float(v)) for v in sorted(values)])
+
+
+def get_session_info(mri_data_objs):
+    """ Get the study date (the earliest, if the scans have more than one), protocol names and manufacturer of the
+    scans of a session """
+    study_dates = sorted(set([format_study_date(m.StudyDate) for m in mri_data_objs]) - {""})
+    protocol_names = sorted(set([str(m.ProtocolName) for m in mri_data_objs]) - {""})
+    manufacturers = sorted(set([str(m.Manufacturer) for m in mri_data_objs]) - {""})
+    return {"study_date": study_dates[0] if len(study_dates) > 0 else "",
+            "study_dates": study_dates,
+            "protocol_name": "_".join(protocol_names),
+            "manufacturer": "_".join(manufacturers)}
+
+
+def save_session_info(session_info, directory):
+    with open(os.path.join(directory, session_info_filename), "w") as f:
+        json.dump(session_info, f, indent=2)
+
+
+def load_session_info(directory):
+    """ Load the session information saved next to the data of a dataset, or an empty one if there is none """
+    filename = os.path.join(directory, session_info_filename)
+    if not os.path.exists(filename):
+        return {"study_date": "", "protocol_name": ""}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def get_fit_summaries(fit_pds, quantities, roi_statistics=None):
+    """ Get the statistics of each quantity over the valid fits (by all valid_fit_by_* columns, with finite values) of
+    all voxels of a dataset, of each slice, and of each ROI (if the ROI statistics of the fits are given). fit_pds are
+    the fits of each slice, as saved. Returns one row per level, quantity, and slice or ROI """
+    fit_pd = pd.concat(fit_pds, ignore_index=True) if len(fit_pds) > 0 else pd.DataFrame(columns=["slc"])
+    fit_pd = fit_pd.drop_duplicates(subset=[c for c in ["slc", "x", "y"] if c in fit_pd.columns])
+    valid = np.ones(len(fit_pd), dtype=bool)
+    for c in [c for c in fit_pd.columns if c.startswith("valid_fit_by_")]:
+        valid &= fit_pd[c].to_numpy(dtype=bool)
+    slc = fit_pd["slc"].to_numpy(dtype=int)
+    slc_locations = fit_pd.drop_duplicates(subset="slc").set_index("slc")["slc_location"] \
+        if "slc_location" in fit_pd.columns else None
+
+    summary_pds = []
+    for quantity in [q for q in quantities if q in fit_pd.columns]:
+        values = pd.to_numeric(fit_pd[quantity]).to_numpy(dtype=float)
+        use = valid & np.isfinite(values)
+        for level, labels in [("dataset", np.zeros(len(fit_pd), dtype=int)), ("slice", slc)]:
+            unique_labels, num_voxels = np.unique(labels, return_counts=True)
+            summary_pd = pd.merge(pd.DataFrame({"label": unique_labels, "num_voxels": num_voxels}),
+                                  get_label_statistics(labels[use], values[use]), on="label", how="left")
+            summary_pd["num_valid"] = summary_pd["num_valid"].fillna(0).astype(int)
+            summary_pd["level"] = level
+            summary_pd["quantity"] = quantity
+            if level == "slice":
+                summary_pd["slc"] = summary_pd["label"]
+                if slc_locations is not None:
+                    summary_pd["slc_location"] = pd.to_numeric(summary_pd["slc"].map(slc_locations))
+            summary_pds.append(summary_pd.drop(columns="label"))
+    if roi_statistics is not None:
+        roi_pd = roi_statistics.get_statistics()
+        if len(roi_pd) > 0:
+            roi_pd = roi_pd.rename(columns={"label": "roi_label", "name": "roi_name"})
+            roi_pd["level"] = "roi"
+            summary_pds.append(roi_pd)
+    summary_cols = ["level", "slc", "slc_location", "roi_label", "roi_name", "quantity"] + statistics_cols
+    if len(summary_pds) == 0:
+        return pd.DataFrame(columns=summary_cols)
+    summary_pd = pd.concat(summary_pds, ignore_index=True)
+    return summary_pd.reindex(columns=summary_cols)
+
+
+class ResultsStore:
+    ''' A local SQLite store of the summaries of the fits of each run (dataset, datatype, study date or session,
+    protocol values, voxel threshold and fit engine), for trend queries over many sessions without reading the fits
+    again. Storing a run again (e.g. after refitting a dataset) replaces it '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        # Several runs (e.g. pipeline workers) may store their results at once
+        self.connection = sqlite3.connect(filename, timeout=60)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        with self.connection:
+            self.connection.executescript(schema)
+        run_cols = [row[1] for row in self.connection.execute("PRAGMA table_info(runs)")]
+        if any([c not in run_cols for c in run_key_cols]):
+            self.connection.close()
+            raise Exception(f"The results store {filename} was created without the {run_key_cols} key of the runs, "
+                            f"store the results in a new file")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_run(self, summary_pd, dataset, datatype, voxel_threshold, protocol_values, study_date="",
+                protocol_name="", fit_engine="lmfit", session="", output_dir=None):
+        """ Store the summaries of a run (see get_fit_summaries), replacing any run with the same run_key_cols. A run
+        without a study date needs a session (e.g. the directory of its data) to be stored by. Returns the id of the
+        run """
+        study_date = format_study_date(study_date)
+        session = "" if session is None else str(session)
+        if (study_date == "") and (session == ""):
+            raise Exception(f"Unable to store the run of {dataset} {datatype} without a study date or a session")
+        run = {"dataset": dataset, "datatype": datatype, "study_date": study_date,
+               "protocol_name": protocol_name if protocol_name is not None else "",
+               "protocol_values": protocol_values if isinstance(protocol_values, str)
+               else format_protocol_values(protocol_values),
+               "voxel_threshold": float(voxel_threshold), "fit_engine": fit_engine, "session": session,
+               "output_dir": output_dir, "created": datetime.datetime.now().isoformat(timespec="seconds")}
+        summary_pd = summary_pd.astype(object).where(summary_pd.notna(), None)
+        summary_cols = list(summary_pd.columns)
+        with self.connection:
+            self.connection.execute(f"DELETE FROM runs WHERE {' AND '.join([f'{c} = ?' for c in run_key_cols])}",
+                                    [run[c] for c in run_key_cols])
+            cursor = self.connection.execute(f"INSERT INTO runs ({', '.join(run.keys())}) VALUES "
+                                             f"({', '.join(['?'] * len(run))})", list(run.values()))
+            run_id = cursor.lastrowid
+            self.connection.executemany(f"INSERT INTO summaries (run_id, {', '.join(summary_cols)}) VALUES "
+                                        f"(?, {', '.join(['?'] * len(summary_cols))})",
+                                        [[run_id] + list(row) for row in summary_pd.itertuples(index=False)])
+        return run_id
+
+    def get_runs(self, datatype=None, dataset=None):
+        """ Get the stored runs, by study date """
+        conditions, params = get_conditions(datatype=datatype, dataset=dataset)
+        where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+        return pd.read_sql_query(f"SELECT * FROM runs r {where} ORDER BY r.study_date, r.dataset", self.connection,
+                                 params=params)
+
+    def get_trend(self, datatype, quantity, level="dataset", datasets=None, roi_label=None, slc=None,
+                  protocol_values=None, start_date=None, end_date=None, voxel_threshold=None, fit_engine=None):
+        """ Get the summaries of a quantity of each run over time (by study date), at a level (dataset, slice or
+        roi), optionally only for some datasets, an ROI label or slice, protocol values, dates (inclusive), voxel
+        threshold and fit engine """
+        if level not in summary_levels:
+            raise Exception(f"Unknown summary level: {level}, expected one of {summary_levels}")
+        conditions, params = get_conditions(datatype=datatype, datasets=datasets, protocol_values=protocol_values,
+                                            start_date=start_date, end_date=end_date, voxel_threshold=voxel_threshold,
+                                            fit_engine=fit_engine)
+        conditions += ["s.quantity = ?", "s.level = ?"]
+        params += [quantity, level]
+        for c, value in [("roi_label", roi_label), ("slc", slc)]:
+            if value is not None:
+                conditions.append(f"s.{c} = ?")
+                params.append(int(value))
+        query = f"""SELECT r.dataset, r.study_date, r.session, r.protocol_name, r.protocol_values, r.voxel_threshold,
+                    r.fit_engine, s.* FROM runs r JOIN summaries s ON s.run_id = r.run_id
+                    WHERE {' AND '.join(conditions)} ORDER BY r.study_date, r.session, r.dataset, s.roi_label, s.slc"""
+        trend_pd = pd.read_sql_query(query, self.connection, params=params)
+        # Statistics that are all missing (e.g. with no valid fits) are read as objects
+        trend_pd[statistics_cols] = trend_pd[statistics_cols].apply(pd.to_numeric)
+        return trend_pd
+
+
+def get_conditions(datatype=None, dataset=None, datasets=None, protocol_values=None, start_date=None, end_date=None,
+                   voxel_threshold=None, fit_engine=None):
+    """ Get the conditions (and their parameters) to select runs (as r) by """
+    conditions = []
+    params = []
+    if datatype is not None:
+        conditions.append("r.datatype = ?")
+        params.append(datatype)
+    if dataset is not None:
+        datasets = [dataset]
+    if datasets is not None:
+        conditions.append(f"r.dataset IN ({', '.join(['?'] * len(datasets))})")
+        params.extend(datasets)
+    if protocol_values is not None:
+        conditions.append("r.protocol_values = ?")
+        params.append(protocol_values if isinstance(protocol_values, str) else format_protocol_values(protocol_values))
+    if start_date is not None:
+        conditions.append("r.study_date >= ?")
+        params.append(format_study_date(start_date))
+    if end_date is not None:
+        conditions.append("r.study_date <= ?")
+        params.append(format_study_date(end_date))
+    if voxel_threshold is not None:
+        conditions.append("r.voxel_threshold = ?")
+        params.append(float(voxel_threshold))
+    if fit_engine is not None:
+        conditions.append("r.fit_engine = ?")
+        params.append(fit_engine)
+    return conditions, params
+
+
+def get_control_limits(trend_pd, statistic="median", n_baseline=None, n_sigma=3.):
+    """ Add Shewhart control limits to a trend (e.g. of one ROI): the center line and standard deviation of the
+    statistic over the first n_baseline runs (or all runs), and whether each run is outside the center line +/-
+    n_sigma standard deviations. The trend should have one row per run """
+    trend_pd = trend_pd.copy()
+    values = pd.to_numeric(trend_pd[statistic]).to_numpy(dtype=float)
+    baseline = values[:n_baseline] if n_baseline is not None else values
+    baseline = baseline[np.isfinite(baseline)]
+    center = float(np.mean(baseline)) if len(baseline) > 0 else np.nan
+    sigma = float(np.std(baseline, ddof=1)) if len(baseline) > 1 else np.nan
+    trend_pd["center"] = center
+    trend_pd["lower_limit"] = center - n_sigma * sigma
+    trend_pd["upper_limit"] = center + n_sigma * sigma
+    with np.errstate(invalid="ignore"):
+        trend_pd["out_of_control"] = (values < trend_pd["lower_limit"]) | (values > trend_pd["upper_limit"])
+    return trend_pd
@@ -0,0 +1,292 @@
+import os
+import struct
+import numpy as np
+import pandas as pd
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+from fitting.t1_fitting import model_T1_2
+from fitting.t2_fitting import model_T2
+from fitting.epg_fitting import simulate_cpmg_epg
+from utils_io.MRIData import MRIData
+
+# Ground truth compartments of the synthetic phantom, with approximate 3T values (times in ms, ADC in mm^2/s). The
+# diffusivity along x is (1 + 2 * ADC_anisotropy) * ADC, and along y and z (1 - ADC_anisotropy) * ADC
+phantom_compartments = pd.DataFrame([
+    {"label": 0, "name": "background", "PD": 0.0, "T1": np.nan, "T2": np.nan, "ADC": np.nan, "ADC_anisotropy": 0.},
+    {"label": 1, "name": "scalp", "PD": 0.9, "T1": 380., "T2": 70., "ADC": 1.0e-3, "ADC_anisotropy": 0.},
+    {"label": 2, "name": "gray_matter", "PD": 0.8, "T1": 1400., "T2": 100., "ADC": 0.8e-3, "ADC_anisotropy": 0.},
+    {"label": 3, "name": "white_matter", "PD": 0.7, "T1": 830., "T2": 80., "ADC": 0.7e-3, "ADC_anisotropy": 0.5},
+    {"label": 4, "name": "csf", "PD": 1.0, "T1": 4000., "T2": 1800., "ADC": 3.0e-3, "ADC_anisotropy": 0.},
+    {"label": 5, "name": "vial_1", "PD": 1.0, "T1": 250., "T2": 20., "ADC": 0.4e-3, "ADC_anisotropy": 0.},
+    {"label": 6, "name": "vial_2", "PD": 1.0, "T1": 600., "T2": 45., "ADC": 0.8e-3, "ADC_anisotropy": 0.},
+    {"label": 7, "name": "vial_3", "PD": 1.0, "T1": 1100., "T2": 150., "ADC": 1.2e-3, "ADC_anisotropy": 0.},
+    {"label": 8, "name": "vial_4", "PD": 1.0, "T1": 2000., "T2": 400., "ADC": 2.0e-3, "ADC_anisotropy": 0.},
+])
+
+# Diffusion directions of the synthetic diffusion data, for each non-zero b-value
+diffusion_directions = [[1., 0., 0.], [0., 1., 0.], [0., 0., 1.]]
+
+
+def get_phantom_labels(matrix_size, n_slices):
+    """ Get an (nx, ny, nslc) compartment label map of a head-like phantom with calibration vials """
+    nx, ny = matrix_size, matrix_size
+    x, y = np.meshgrid(np.linspace(-1, 1, nx), np.linspace(-1, 1, ny), indexing="ij")
+    labels = np.zeros((nx, ny, n_slices), dtype=np.int16)
+    for slc in range(n_slices):
+        # The head gets smaller towards the first and last slices
+        z = 0. if n_slices == 1 else 2 * slc / (n_slices - 1) - 1
+        scale = np.sqrt(1 - 0.5 * z ** 2)
+        head = (x / (0.75 * scale)) ** 2 + (y / (0.6 * scale)) ** 2
+        label = labels[:, :, slc]
+        label[head <= 1] = 1
+        label[head <= 0.85] = 2
+        label[head <= 0.55] = 3
+        # Ventricles
+        label[((x / (0.25 * scale)) ** 2 + ((np.abs(y) - 0.12 * scale) / (0.07 * scale)) ** 2) <= 1] = 4
+        # Calibration vials around the head
+        for vial_idx, angle in enumerate(np.linspace(0.25, 1.75, 4) * np.pi):
+            vial = ((x - 0.88 * np.cos(angle)) ** 2 + (y - 0.88 * np.sin(angle)) ** 2) <= 0.08 ** 2
+            label[vial] = 5 + vial_idx
+    return labels
+
+
+def get_b1_map(shape, b1_min=0.7):
+    """ Get a smooth relative B1 (refocusing angle scale) map, which is 1 in the center and b1_min at the corners """
+    nx, ny, n_slices = shape
+    x, y = np.meshgrid(np.linspace(-1, 1, nx), np.linspace(-1, 1, ny), indexing="ij")
+    b1 = 1 - (1 - b1_min) * (x ** 2 + y ** 2) / 2
+    return np.repeat(b1[:, :, None], n_slices, axis=2)
+
+
+def get_ground_truth_maps(labels):
+    """ Get the ground truth PD, T1, T2, ADC, ADC anisotropy and B1 maps for a label map """
+    compartments = phantom_compartments.set_index("label")
+    ground_truth_maps = {c: compartments[c].to_numpy()[labels] for c in ["PD", "T1", "T2", "ADC", "ADC_anisotropy"]}
+    ground_truth_maps["B1"] = get_b1_map(labels.shape)
+    return ground_truth_maps
+
+
+def add_rician_noise(signal, noise_sigma, rng):
+    """ Get the magnitude of the signal with complex Gaussian noise added (Rician noise) """
+    noise_real = rng.normal(0, noise_sigma, np.shape(signal))
+    noise_imag = rng.normal(0, noise_sigma, np.shape(signal))
+    return np.sqrt((signal + noise_real) ** 2 + noise_imag ** 2)
+
+
+def simulate_echo_train(ground_truth_maps, echo_spacing, n_echos):
+    """ Simulate the (nx, ny, nslc, n_echos) CPMG echo train with stimulated echoes from the B1 map """
+    t2 = np.nan_to_num(ground_truth_maps["T2"], nan=1.)
+    echos = simulate_cpmg_epg(t2.ravel(), ground_truth_maps["B1"].ravel(), echo_spacing, n_echos,
+                              T1=np.nanmedian(ground_truth_maps["T1"]))
+    return echos.reshape(t2.shape + (n_echos,))
+
+
+def get_diffusivity(ground_truth_maps, direction):
+    """ Get the diffusivity along a unit diffusion direction, from the ADC and its anisotropy along x """
+    anisotropy = ground_truth_maps["ADC_anisotropy"]
+    return ground_truth_maps["ADC"] * (1 + anisotropy * (3 * direction[0] ** 2 - 1))
+
+
+def simulate_signal(datatype, ground_truth_maps, value, tr, signal_scale, delta=0.9, echo_train=None,
+                    echo_spacing=None, direction=None):
+    """ Simulate the noiseless (signed) signal for the inversion time (t1), echo time (t2, t2_epg) or b-value (adc)
+    given by value. For t2_epg, the echo is taken from the echo train simulated with the given echo spacing, and for
+    adc, the signal is for the given diffusion direction """
+    si = ground_truth_maps["PD"] * signal_scale
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if datatype == "t1":
+            signal = model_T1_2(Si=si, delta=delta, TI=value, T1=ground_truth_maps["T1"], TR=tr)
+            # Keep the sign, so the noise is added to the complex signal before taking the magnitude
+            signal = signal * np.sign(1 - (1 + delta) * np.exp(-value / ground_truth_maps["T1"]) +
+                                      np.exp(-tr / ground_truth_maps["T1"]))
+        elif datatype == "t2":
+            signal = model_T2(Si=si, TE=value, T2=ground_truth_maps["T2"])
+        elif datatype == "t2_epg":
+            signal = si * echo_train[..., int(np.round(value / echo_spacing)) - 1]
+        elif datatype == "adc":
+            signal = si * np.exp(-value * get_diffusivity(ground_truth_maps, direction))
+        else:
+            raise Exception(f"Cannot simulate data for datatype {datatype}")
+    return np.nan_to_num(signal)
+
+
+def get_synthetic_mri_data(datatype, labels, values, tr=5000., te=10., noise_sigma=10., signal_scale=1000.,
+                           slice_thickness=5., seed=0):
+    """ Get the MRIData objects for each slice and inversion time (t1), echo time (t2, t2_epg) or b-value and
+    diffusion direction (adc) of a synthetic phantom """
+    rng = np.random.default_rng(seed)
+    ground_truth_maps = get_ground_truth_maps(labels)
+    nx, ny, n_slices = labels.shape
+    mri_data_objs = []
+    echo_train = None
+    if datatype == "t2_epg":
+        echo_train = simulate_echo_train(ground_truth_maps, np.min(values), int(np.round(np.max(values) /
+                                                                                         np.min(values))))
+    acquisitions = [(value, [0., 0., 0.]) for value in values]
+    if datatype == "adc":
+        acquisitions = [(value, direction) for value in values
+                        for direction in (diffusion_directions if value > 0 else [[0., 0., 0.]])]
+    for value, direction in acquisitions:
+        signal = simulate_signal(datatype, ground_truth_maps, value, tr, signal_scale, echo_train=echo_train,
+                                 echo_spacing=np.min(values), direction=direction)
+        signal = add_rician_noise(signal, noise_sigma, rng)
+        for slc in range(n_slices):
+            mri_data = MRIData()
+            mri_data.Manufacturer = "Synthetic"
+            mri_data.StudyDate = "20240101"
+            mri_data.SeriesDescription = f"synthetic_{datatype}_{value}"
+            mri_data.ProtocolName = f"synthetic_{datatype}"
+            mri_data.RepetitionTime = float(tr)
+            mri_data.EchoTime = float(value) if datatype in ["t2", "t2_epg"] else float(te)
+            mri_data.InversionTime = float(value) if datatype == "t1" else 0.0
+            if datatype == "adc":
+                mri_data.bValue = float(value)
+                mri_data.targetBValue = float(value)
+                mri_data.bVector = list(direction)
+            mri_data.Rows = nx
+            mri_data.Columns = ny
+            mri_data.ro = nx
+            mri_data.pe = ny
+            mri_data.FoVX = mri_data.PixelSpacing[0] * nx
+            mri_data.FoVY = mri_data.PixelSpacing[1] * ny
+            mri_data.SliceThickness = slice_thickness
+            mri_data.SliceLocation = slc * slice_thickness
+            mri_data.pixel_array = signal[:, :, slc]
+            mri_data_objs.append(mri_data)
+    return mri_data_objs
+
+
+def write_dicom(mri_data, filename, instance_number=1):
+    """ Write an MRIData object as an uncompressed 16-bit MR DICOM file """
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MRImageStorage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.preamble = b"\0" * 128
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = "MR"
+    ds.Manufacturer = mri_data.Manufacturer
+    ds.StudyDate = mri_data.StudyDate
+    ds.SeriesDescription = mri_data.SeriesDescription
+    ds.ProtocolName = mri_data.ProtocolName
+    ds.InstanceNumber = instance_number
+    ds.RepetitionTime = mri_data.RepetitionTime
+    ds.EchoTime = mri_data.EchoTime
+    ds.InversionTime = mri_data.InversionTime
+    ds.DiffusionBValue = mri_data.bValue
+    ds.DiffusionGradientOrientation = list(mri_data.bVector)
+    ds.FlipAngle = mri_data.FlipAngle
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = list(mri_data.PixelSpacing)
+    ds.SliceThickness = mri_data.SliceThickness
+    ds.SliceLocation = mri_data.SliceLocation
+    pixel_array = np.clip(np.round(mri_data.pixel_array), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+    ds.Rows, ds.Columns = pixel_array.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = pixel_array.tobytes()
+    if int(pydicom.__version__.split(".")[0]) >= 3:
+        pydicom.dcmwrite(filename, ds, enforce_file_format=True)
+    else:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        pydicom.dcmwrite(filename, ds, write_like_original=False)
+
+
+def write_fdf(mri_data, filename, slice_number=1, n_slices=1):
+    """ Write an MRIData object as a Varian fdf file (float32 data, location and span in cm) """
+    nx, ny = np.shape(mri_data.pixel_array)
+    header_lines = [
+        "#!/usr/local/fdf/startup",
+        "float  rank = 2;",
+        'char  *spatial_rank = "2dfov";',
+        'char  *storage = "float";',
+        "float  bits = 32;",
+        'char  *type = "absval";',
+        f"float  matrix[] = {{{nx}, {ny}}};",
+        f"float  span[] = {{{mri_data.FoVX / 10.:.6f},{mri_data.FoVY / 10.:.6f}}};",
+        # The slice location is stored with trailing zeros, since the reader drops the last two characters
+        f"float  location[] = {{0.000000,0.000000,{mri_data.SliceLocation / 10.:.6f}00}};",
+        "float  orientation[] = {1.0,0.0,0.0,0.0,1.0,0.0,0.0,0.0,1.0};",
+        f'char  *studyid = "{mri_data.SeriesDescription}";',
+        f'char  *sequence = "{mri_data.ProtocolName}";',
+        f"float  TR = {mri_data.RepetitionTime};",
+        f"float  TE = {mri_data.EchoTime};",
+        f"float  TI = {mri_data.InversionTime};",
+        f"int  ro_size = {mri_data.ro};",
+        f"int  pe_size = {mri_data.pe};",
+        f"int  slice_no = {slice_number};",
+        f"int  nslices = {n_slices};",
+        "int  echo_no = 1;",
+        "int  echos = 1;",
+        f"float  bvalue = {mri_data.bValue};",
+        "int  bigendian = 0;",
+    ]
+    # The reader reads the pixel data from the end of the file, (ny, nx) in C order
+    data = np.asarray(mri_data.pixel_array, dtype=float).T.ravel()
+    with open(filename, "wb") as f:
+        f.write(("\n".join(header_lines) + "\n\f\n").encode("ascii"))
+        f.write(b"\0")
+        f.write(struct.pack("<%df" % data.size, *data))
+
+
+def get_load_subdir(datatype, value, direction_number=None):
+    value_name = {"t1": "TI", "adc": "B"}.get(datatype, "TE")
+    load_subdir = f"{datatype.upper()}_{value_name}{value:g}"
+    if direction_number is not None:
+        load_subdir = f"{load_subdir}_DIR{direction_number}"
+    return load_subdir
+
+
+def write_synthetic_scans(mri_data_objs, datatype, load_dir, file_format="dicom"):
+    """ Write the scans into one sub-directory per inversion/echo time (or b-value and diffusion direction), as
+    expected by preformat_data.py. Returns the sub-directory names and the total number of bytes written """
+    load_subdirs = []
+    n_bytes = 0
+    slice_numbers = {}
+    direction_numbers = {}
+    for mri_data in mri_data_objs:
+        direction_number = None
+        if datatype == "adc":
+            value = mri_data.bValue
+            # Number the diffusion directions of each b-value in the order they are acquired
+            directions = direction_numbers.setdefault(value, [])
+            if tuple(mri_data.bVector) not in directions:
+                directions.append(tuple(mri_data.bVector))
+            direction_number = directions.index(tuple(mri_data.bVector)) + 1
+        elif datatype == "t1":
+            value = mri_data.InversionTime
+        else:
+            value = mri_data.EchoTime
+        load_subdir = get_load_subdir(datatype, value, direction_number=direction_number)
+        if load_subdir not in load_subdirs:
+            load_subdirs.append(load_subdir)
+            os.makedirs(os.path.join(load_dir, load_subdir), exist_ok=True)
+        slice_numbers[load_subdir] = slice_numbers.get(load_subdir, 0) + 1
+        slice_number = slice_numbers[load_subdir]
+        if file_format == "dicom":
+            filename = os.path.join(load_dir, load_subdir, f"slc_{slice_number:04d}.dcm")
+            write_dicom(mri_data, filename, instance_number=slice_number)
+        elif file_format == "fdf":
+            filename = os.path.join(load_dir, load_subdir, f"slice{slice_number:03d}image001echo001.fdf")
+            write_fdf(mri_data, filename, slice_number=slice_number)
+        else:
+            raise Exception(f"Unknown file format: {file_format}")
+        n_bytes += os.path.getsize(filename)
+    return load_subdirs, n_bytes
+
+
+def save_ground_truth(labels, filename):
+    """ Save the label map, ground truth maps and compartment table for comparing fits against """
+    ground_truth_maps = get_ground_truth_maps(labels)
+    np.savez_compressed(filename, labels=labels, **ground_truth_maps)
+    phantom_compartments.to_csv(os.path.splitext(filename)[0] + "_compartments.csv", index=False)
@@ -0,0 +1,378 @@
+import os
+import glob
+import sys
+import time
+import argparse
+import numpy as np
+from preformat_data import read_scan, save_preformatted_data
+from save_data import load_slice_data, save_slice_data
+from process_saved_data import preprocess_data, fit_slices, get_slice_saver, save_all_slice_fits, make_save_dir, \
+    get_saved_data_filenames
+from fitting.fitting_utils import get_fit_by_str
+from fitting.overall_fitting import fit_engines, get_limited_value_column
+from fitting.subset_sweep import get_values_str
+from utils_io.MRIData import turn_mri_data_into_dfs_by_slice
+from utils_io.decoded_cache import DecodedImageCache
+from utils_io.background_io import BackgroundWriter
+from utils_io.compact_dtypes import MemoryUsage
+from profiling.run_report import RunReport, optional_stage, add_counts
+
+# Header field of the value (e.g. inversion time) of each scan, by the column it is stored in
+scan_value_fields = {"ti": "InversionTime", "te": "EchoTime", "target_b_value": "targetBValue"}
+
+
+def parse_args(args):
+    # Input arguments
+    parser = argparse.ArgumentParser(description='Watch a directory for the scanner files of a session as they arrive, '
+                                                 'and pre-format, save and fit each slice as soon as all of its '
+                                                 'values (e.g. inversion times) have arrived.')
+    parser.add_argument('--watch-dir', dest='watch_dir',
+                        type=str, action='store', required=True,
+                        help='Directory to watch for raw data files, including its sub-directories')
+    parser.add_argument('--load-data-extension', dest='load_data_extension',
+                        type=str, action='store', required=True, choices=[".dcm", ".dim", "", ".fdf", ".IMA"],
+                        help='File extension of the raw data. A file extension of an empty string will load dicom '
+                             'data.')
+    parser.add_argument('--dataset', dest='dataset',
+                        type=str, action='store', required=True,
+                        help='Dataset name - data will be saved with this name')
+    parser.add_argument('--datatype', dest='datatype',
+                        type=str, action='store', required=True, choices=["t1", "t2", "t2_epg", "adc"],
+                        help='Type of data to process')
+    parser.add_argument('--datatype-values', dest='values_to_use',
+                        type=float, nargs="+", action='store', required=True,
+                        help='Values of the session (inversion times for t1, echo times for t2, b-values for adc). '
+                             'A slice is fit once the files of all of these values have arrived, with the data '
+                             'limited to these values, as with --datatype-values of process_saved_data.py')
+    parser.add_argument('--num-slices', dest='num_slices',
+                        type=int, action='store', required=True,
+                        help='Number of slices of the session. Slices are numbered by their location, so slices are '
+                             'only fit once the files of all slice locations have started to arrive')
+    parser.add_argument('--acquisitions-per-value', dest='acquisitions_per_value',
+                        type=int, default=1, action='store',
+                        help='(Optional) Number of acquisitions of each value (e.g. diffusion directions of each '
+                             'b-value) that a slice needs. The default value is 1')
+    parser.add_argument('--preformat-dir', dest='preformat_dir',
+                        type=str, action='store', required=True,
+                        help='Directory to save the pre-formatted data to, as preformat_data.py does: '
+                             '<preformat-dir>/<datatype>/<dataset>/raw_{slc}.csv')
+    parser.add_argument('--saved-data-dir', dest='saved_data_dir',
+                        type=str, action='store', required=True,
+                        help='Directory to save the saved data to, as save_data.py does: '
+                             '<saved-data-dir>/<datatype>/<dataset>/raw_{slc}.csv')
+    parser.add_argument('--output-dir', dest='output_dir',
+                        type=str, action='store', required=True,
+                        help='Directory to save the fits to, as process_saved_data.py does with --datatype-values: '
+                             '<output-dir>/<datatype>/<dataset>_<values>/')
+    parser.add_argument('--output-format', dest='output_format',
+                        type=str, default="csv", action='store', choices=["csv", "maps", "both"],
+                        help='(Optional) Save the fits of all slices as csv files (csv), compressed parametric maps '
+                             '(maps), or both. The default value is csv')
+    parser.add_argument('--fit-by-voxel-threshold', dest='fit_by_voxel_threshold',
+                        type=float, default=0.2, action='store',
+                        help='(Optional) Threshold to mask the data by when fitting by voxel. The default value is 0.2')
+    parser.add_argument("--fit-engine", dest="fit_engine",
+                        type=str, default="lmfit", action="store", choices=fit_engines,
+                        help="(Optional) Engine to fit the voxels with, as for process_saved_data.py. The default "
+                             "value is lmfit")
+    parser.add_argument("--fit-workers", dest="fit_workers",
+                        type=int, default=1, action="store",
+                        help="(Optional) Number of worker processes to fit the voxels of each slice with. The default "
+                             "value is 1")
+    parser.add_argument("--poll-interval", dest="poll_interval",
+                        type=float, default=1., action="store",
+                        help="(Optional) Time in seconds between checks for new files. The default value is 1")
+    parser.add_argument("--settle-time", dest="settle_time",
+                        type=float, default=2., action="store",
+                        help="(Optional) Time in seconds that the size and modification time of a new file must not "
+                             "change for before it is read, so files that are still being written are not read. The "
+                             "default value is 2")
+    parser.add_argument("--idle-timeout", dest="idle_timeout",
+                        type=float, action="store",
+                        help="(Optional) Stop watching after this many seconds without new files, and fit the slices "
+                             "whose files have all arrived. By default, the watch only stops once all slices are fit")
+    parser.add_argument("--decoded-cache-dir", dest="decoded_cache_dir",
+                        action="store",
+                        help="(Optional) Directory to cache the decoded images in, as for preformat_data.py")
+    parser.add_argument("--decoded-cache-max-gb", dest="decoded_cache_max_gb",
+                        type=float, default=10., action="store",
+                        help="(Optional) Maximum size of the decoded image cache in GB. The default value is 10")
+    parser.add_argument("--compact-dtypes", dest="compact_dtypes",
+                        action="store_true",
+                        help="(Optional) Pre-format, load and fit the data with compact dtypes, as for "
+                             "process_saved_data.py, and report the memory they save")
+    parser.add_argument("--run-report", dest="run_report",
+                        action="store",
+                        help="(Optional) JSON file to store a run report in, with the wall/CPU time, rows, voxels, "
+                             "bytes read/written and peak memory of each stage and slice")
+    return parser.parse_args(args)
+
+
+def get_scan_value(mri_data, datatype):
+    """ Get the value of a scan (e.g. its inversion time) that the data of the datatype can be limited to """
+    return float(getattr(mri_data, scan_value_fields[get_limited_value_column(datatype)]))
+
+
+def get_scan_locations(mri_data):
+    """ Get the slice locations of a scan, as turn_mri_data_into_dfs_by_slice finds them """
+    if np.ndim(mri_data.pixel_array) == 3:
+        return list(range(np.shape(mri_data.pixel_array)[0]))
+    return [mri_data.SliceLocation]
+
+
+class ScanCatalog:
+    """ Catalog of the scanner files of a session in a directory, which are read (decoded) as they arrive. Each file is
+    read once its size and modification time have not changed for settle_time seconds, and the slice locations and
+    value (e.g. inversion time) of its scan are cataloged. A slice location is complete once the scans of all values
+    (with acquisitions_per_value scans of each value, e.g. diffusion directions) have arrived """
+    def __init__(self, watch_dir, load_data_extension, datatype, values, acquisitions_per_value=1, settle_time=2.,
+                 decoded_cache=None):
+        self.watch_dir = watch_dir
+        self.load_data_extension = load_data_extension
+        self.datatype = datatype
+        self.values = list(values)
+        self.acquisitions_per_value = acquisitions_per_value
+        self.settle_time = settle_time
+        self.decoded_cache = decoded_cache
+        # Size, modification time and time of the last change of each file that has not been read yet
+        self.pending = {}
+        self.read_filenames = set()
+        # Scan and slice locations of each read file whose slices are not all done
+        self.scans = {}
+        self.scan_locations = {}
+        # Acquisitions of each value that have arrived for each slice location
+        self.acquisitions = {}
+        self.done_locations = set()
+
+    def get_value_idx(self, value):
+        matches = np.flatnonzero(np.isclose(self.values, value))
+        return int(matches[0]) if len(matches) > 0 else None
+
+    def poll(self, run_report=None):
+        """ Read the files that arrived and settled since the last poll. Returns the number of new or changed files
+        and the number of files read """
+        filenames = glob.glob(os.path.join(self.watch_dir, "**", "*" + self.load_data_extension), recursive=True)
+        n_changed = 0
+        now = time.time()
+        for filename in filenames:
+            if (filename in self.read_filenames) or not os.path.isfile(filename):
+                continue
+            file_stat = os.stat(filename)
+            state = (file_stat.st_size, file_stat.st_mtime_ns)
+            if (filename not in self.pending) or (self.pending[filename][:2] != state):
+                self.pending[filename] = state + (now,)
+                n_changed += 1
+
+        settled = sorted([f for f, (_, _, change_time) in self.pending.items()
+                          if now - change_time >= self.settle_time])
+        if len(settled) == 0:
+            return n_changed, 0
+        with optional_stage(run_report, "read_scans") as stage:
+            for filename in settled:
+                del self.pending[filename]
+                self.read_filenames.add(filename)
+                mri_data, from_cache = read_scan(filename, self.load_data_extension, self.datatype,
+                                                 decoded_cache=self.decoded_cache)
+                self.add_scan(filename, mri_data)
+                add_counts(stage, files=1, bytes_read=os.path.getsize(filename), cache_hits=int(from_cache))
+        return n_changed, len(settled)
+
+    def add_scan(self, filename, mri_data):
+        value_idx = self.get_value_idx(get_scan_value(mri_data, self.datatype))
+        if value_idx is None:
+            # Not one of the values of the session (e.g. a localizer)
+            return
+        locations = get_scan_locations(mri_data)
+        self.scans[filename] = mri_data
+        self.scan_locations[filename] = locations
+        acquisition = (value_idx, tuple(np.round(np.asarray(mri_data.bVector, dtype=float), 6)))
+        for location in locations:
+            self.acquisitions.setdefault(location, set()).add(acquisition)
+
+    def get_locations(self):
+        """ Get all slice locations that scans have arrived for, in order """
+        return sorted(self.acquisitions.keys())
+
+    def get_complete_locations(self):
+        """ Get the slice locations that are not done and whose scans have all arrived """
+        complete = []
+        for location in self.get_locations():
+            if location in self.done_locations:
+                continue
+            counts = np.bincount([value_idx for value_idx, _ in self.acquisitions[location]],
+                                 minlength=len(self.values))
+            if np.all(counts >= self.acquisitions_per_value):
+                complete.append(location)
+        return complete
+
+    def get_slices_data(self, locations, compact=False):
+        """ Get the data of the scans of the slice locations (in order of their filenames), by slice location, with
+        the compact dtypes if compact. The scans are combined once for all the slice locations, since a 3D scan
+        covers many slice locations """
+        filenames = sorted([f for f, scan_locations in self.scan_locations.items()
+                            if any([loc in locations for loc in scan_locations])])
+        mri_dfs_by_slice = turn_mri_data_into_dfs_by_slice([self.scans[f] for f in filenames], compact=compact)
+        return {location: mri_dfs_by_slice[location] for location in locations}
+
+    def set_done(self, location):
+        """ Mark a slice location as done, and release the scans whose slice locations are all done """
+        self.done_locations.add(location)
+        for filename in [f for f, locations in self.scan_locations.items()
+                         if all([loc in self.done_locations for loc in locations])]:
+            del self.scans[filename]
+            del self.scan_locations[filename]
+
+
+class SessionFitter:
+    """ Pre-formats, saves and fits each slice as it is submitted, as preformat_data.py, save_data.py and
+    process_saved_data.py (with the values of the session as --datatype-values) do. Slices are masked with the max
+    value of the slices fit so far, which may be lower than the max value of all slices, so finish refits the slices
+    that the max value of all slices would not have masked (see mask_slice) """
+    def __init__(self, args, run_report=None):
+        self.args = args
+        self.run_report = run_report
+        self.labels = {"dataset": args.dataset, "datatype": args.datatype}
+        self.memory_usage = MemoryUsage() if args.compact_dtypes else None
+        self.preformat_dir = os.path.join(args.preformat_dir, args.datatype, args.dataset)
+        self.saved_data_dir = os.path.join(args.saved_data_dir, args.datatype, args.dataset)
+        self.save_dir = make_save_dir(args.output_dir, args.datatype,
+                                      f"{args.dataset}{get_values_str(args.values_to_use)}")
+        self.extra_str = get_fit_by_str("voxel", args.fit_by_voxel_threshold)
+        os.makedirs(self.saved_data_dir, exist_ok=True)
+        self.max_val = -1
+        self.slice_max_vals = {}
+        self.masked = {}
+        self.fit_pds_to_save = {}
+
+    def fit_slice(self, slc, data_pd, max_val):
+        """ Fit the (limited) data of a slice, and save its fits. Returns whether the slice was masked """
+        save_slice, fit_pds_to_save = get_slice_saver(self.save_dir, self.extra_str, self.args.output_format,
+                                                      run_report=self.run_report, **self.labels)
+        fit_slices({slc: data_pd}, self.args.datatype, max_val=max_val,
+                   voxel_threshold=self.args.fit_by_voxel_threshold, fit_engine=self.args.fit_engine,
+                   fit_workers=self.args.fit_workers, save_slice=save_slice, keep_fits=False,
+                   memory_usage=self.memory_usage, run_report=self.run_report, dataset=self.args.dataset)
+        if len(fit_pds_to_save) > 0:
+            self.fit_pds_to_save[slc] = fit_pds_to_save[0]
+        slc_max_val = self.slice_max_vals[slc]
+        return bool(slc_max_val > (np.min([0.1, self.args.fit_by_voxel_threshold]) * max_val))
+
+    def load_limited_slice(self, slc):
+        data_pd = load_slice_data(self.saved_data_dir, slc, compact=self.args.compact_dtypes,
+                                  memory_usage=self.memory_usage, run_report=self.run_report, **self.labels)
+        data_pd_dict, slc_max_val = preprocess_data({slc: data_pd}, self.args.datatype,
+                                                    values_to_use=self.args.values_to_use,
+                                                    memory_usage=self.memory_usage, run_report=self.run_report,
+                                                    dataset=self.args.dataset)
+        return data_pd_dict[slc], slc_max_val
+
+    def process_slice(self, location, mri_df):
+        """ Pre-format, save and fit the data of a slice """
+        slc = mri_df["slc"].values[0]
+        print(f"\nProcessing slice {slc} at {location}")
+        save_preformatted_data({location: mri_df}, self.preformat_dir, run_report=self.run_report)
+        data_pd = load_slice_data(self.preformat_dir, slc, compact=self.args.compact_dtypes,
+                                  run_report=self.run_report, **self.labels)
+        save_slice_data(data_pd, self.saved_data_dir, slc, run_report=self.run_report, **self.labels)
+        data_pd, slc_max_val = self.load_limited_slice(slc)
+        self.slice_max_vals[slc] = slc_max_val
+        self.max_val = max(self.max_val, slc_max_val)
+        self.masked[slc] = self.fit_slice(slc, data_pd, self.max_val)
+
+    def finish(self):
+        """ Refit the slices that the max value of all slices would not have masked, and save the fits of all
+        slices """
+        for slc, masked in self.masked.items():
+            if masked and not (self.slice_max_vals[slc] > (np.min([0.1, self.args.fit_by_voxel_threshold]) *
+                                                           self.max_val)):
+                print(f"\nRefitting slice {slc} without a mask, as its max value is low compared to all slices")
+                data_pd, _ = self.load_limited_slice(slc)
+                self.fit_pds_to_save.pop(slc, None)
+                self.masked[slc] = self.fit_slice(slc, data_pd, self.max_val)
+        # Save the fits of all slices in the order process_saved_data.py loads the slices in
+        slice_order = [os.path.basename(f)[len("raw_"):-len(".csv")]
+                       for f in get_saved_data_filenames(self.args.saved_data_dir, self.args.datatype,
+                                                         self.args.dataset)]
+        fit_pds_to_save = [self.fit_pds_to_save[slc] for slc in sorted(self.fit_pds_to_save.keys(),
+                                                                       key=lambda s: slice_order.index(str(s)))]
+        save_all_slice_fits(fit_pds_to_save, self.save_dir, self.extra_str, self.args.output_format,
+                            run_report=self.run_report, **self.labels)
+
+
+def watch(args, run_report=None):
+    """ Watch the directory until all slices are fit (or it is idle for idle_timeout seconds), fitting each slice in a
+    background thread as soon as its files have all arrived """
+    decoded_cache = None
+    if args.decoded_cache_dir is not None:
+        decoded_cache = DecodedImageCache(args.decoded_cache_dir, max_bytes=args.decoded_cache_max_gb * 1e9)
+    catalog = ScanCatalog(args.watch_dir, args.load_data_extension, args.datatype, args.values_to_use,
+                          acquisitions_per_value=args.acquisitions_per_value, settle_time=args.settle_time,
+                          decoded_cache=decoded_cache)
+    fitter = SessionFitter(args, run_report=run_report)
+    writer = BackgroundWriter(fitter.process_slice, max_pending=args.num_slices)
+    num_slices = args.num_slices
+    start_time = time.time()
+    last_change_time = time.time()
+    print(f"Watching {args.watch_dir} for {args.num_slices} slices of {args.datatype} with values:",
+          " ".join([str(v) for v in args.values_to_use]))
+    while True:
+        n_changed, n_read = catalog.poll(run_report=run_report)
+        if n_changed + n_read > 0:
+            last_change_time = time.time()
+        idle = (args.idle_timeout is not None) and (time.time() - last_change_time > args.idle_timeout) and \
+            (len(catalog.pending) == 0)
+        locations = catalog.get_locations()
+        if len(locations) > num_slices:
+            raise Exception(f"Found {len(locations)} slice locations, but expected {num_slices}: {locations}")
+        if idle and (len(locations) < num_slices):
+            print(f"No new files for {args.idle_timeout} s, and only {len(locations)} of {num_slices} slice locations "
+                  f"arrived. Numbering the slices by the locations that arrived")
+            num_slices = len(locations)
+
+        # Slices can only be numbered by their location once all locations have arrived
+        if (len(locations) == num_slices) and (num_slices > 0):
+            complete_locations = catalog.get_complete_locations()
+            mri_dfs_by_slice = catalog.get_slices_data(complete_locations, compact=args.compact_dtypes) \
+                if len(complete_locations) > 0 else {}
+            for location, mri_df in mri_dfs_by_slice.items():
+                mri_df["slc"] = locations.index(location)
+                mri_df["nslc"] = num_slices
+                print(f"All files arrived for slice {locations.index(location)} at {location} after "
+                      f"{time.time() - start_time:.1f} s")
+                catalog.set_done(location)
+                writer.submit(location, mri_df)
+        if len(catalog.done_locations) == num_slices > 0:
+            break
+        if idle:
+            incomplete = [loc for loc in locations if loc not in catalog.done_locations]
+            print(f"Stopping the watch with {len(incomplete)} incomplete slice(s) at: {incomplete}")
+            break
+        time.sleep(args.poll_interval)
+
+    writer.close()
+    fitter.finish()
+    if decoded_cache is not None:
+        print(f"Read {decoded_cache.hits} files from the decoded image cache, and decoded {decoded_cache.misses} "
+              f"files")
+    print(f"Fit {len(fitter.masked)} slices of the session {time.time() - start_time:.1f} s after the watch started")
+    return fitter
+
+
+def main(args):
+    run_report = None
+    if args.run_report is not None:
+        run_report = RunReport("watch_session", filename=args.run_report)
+        run_report.add_info(args=vars(args))
+    fitter = watch(args, run_report=run_report)
+    if fitter.memory_usage is not None:
+        fitter.memory_usage.print()
+        if run_report is not None:
+            run_report.add_info(memory_usage=fitter.memory_usage.get_summary())
+    print("\nFinished Watching Session!")
+    if run_report is not None:
+        run_report.save()
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    main(args)